@@ -0,0 +1,264 @@
+"""
+Stub HTTP local de las APIs de OpenAQ v3, REE e INCLASNS para los benchmarks.
+
+Las respuestas son sintéticas pero con la misma forma que las reales y se
+escalan con el número de sensores y de días. Son deterministas: la misma
+petición devuelve siempre el mismo cuerpo. Cada petición se cuenta por
+endpoint para poder informar de las llamadas a la API de cada Lambda.
+
+Las Lambdas se apuntan al stub con las variables `openaq_base_url`,
+`ree_base_url` e `inclasns_base_url`.
+
+Con `openaq_rate_limit` el stub aplica a OpenAQ un límite compartido por todos
+los clientes (ventana deslizante de `rate_period` segundos), informa del saldo
+en `x-ratelimit-remaining` / `x-ratelimit-reset` y responde 429 al superarlo,
+como la API real. Los catálogos de OpenAQ (parámetros y ubicaciones) llevan
+`ETag` y responden 304 a un `If-None-Match` que coincida. `latency` (segundos) retrasa cada respuesta para simular la
+red: sin ella el trabajo es solo CPU y la concurrencia apenas se nota en una
+máquina con pocos núcleos. Con `open_found` las mediciones informan de un total
+abierto ('>1000'), como hace la API real en los rangos largos. Las páginas de
+mediciones de `fail_pages` responden 500 (se puede cambiar entre ejecuciones)
+para probar los reintentos y las reanudaciones desde el punto de control.
+"""
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SENSORS_PER_LOCATION = 4
+PARAMETERS = 10
+LOCALITIES = ['Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Bilbao', 'Zaragoza', 'Málaga', 'Murcia']
+CCAA = ['Andalucía', 'Aragón', 'Asturias', 'Cataluña', 'Galicia', 'Madrid', 'País Vasco', 'Total Nacional']
+
+
+def _parse_date(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _page(results, params, found=None):
+    limit = int(params.get('limit', 100))
+    page = int(params.get('page', 1))
+    total = len(results) if found is None else found
+    return {
+        'meta': {'name': 'openaq-api', 'page': page, 'limit': limit, 'found': total},
+        'results': results[(page - 1) * limit:page * limit],
+    }
+
+
+class ApiStub:
+
+    def __init__(self, sensors, days, indicators=20, first_day='2024-01-01', openaq_rate_limit=None,
+                 rate_period=60, latency=0.0, open_found=False, fail_pages=()):
+        self.sensors = sensors
+        self.days = days
+        self.indicators = indicators
+        self.first_day = _parse_date(first_day)
+        self.last_day = self.first_day + timedelta(days=days)
+        self.calls = Counter()
+        self.openaq_rate_limit = openaq_rate_limit
+        self.rate_period = rate_period
+        self.latency = latency
+        self.open_found = open_found
+        self.fail_pages = set(fail_pages)
+        self._window = deque()
+        self._lock = threading.Lock()
+        self._server = None
+
+    # ----------------------------- OpenAQ -----------------------------
+    def sensor_ids(self):
+        return [str(100000 + i) for i in range(self.sensors)]
+
+    def parameters(self, params):
+        results = [{'id': i, 'name': f'param_{i}', 'units': 'µg/m³', 'displayName': f'P{i}',
+                    'description': f'Parámetro {i}'} for i in range(1, PARAMETERS + 1)]
+        return _page(results, params)
+
+    def locations(self, params):
+        results = []
+        for location_id in range(math.ceil(self.sensors / SENSORS_PER_LOCATION)):
+            first = location_id * SENSORS_PER_LOCATION
+            sensors = [{'id': 100000 + i, 'name': f'sensor {i}',
+                        'parameter': {'id': 1 + i % PARAMETERS, 'name': f'param_{1 + i % PARAMETERS}'}}
+                       for i in range(first, min(first + SENSORS_PER_LOCATION, self.sensors))]
+            results.append({
+                'id': location_id, 'name': f'Estación {location_id}',
+                'locality': LOCALITIES[location_id % len(LOCALITIES)], 'timezone': 'Europe/Madrid',
+                'country': {'id': 67, 'code': 'ES', 'name': 'Spain'},
+                'owner': {'id': 1, 'name': 'owner'}, 'provider': {'id': 1, 'name': 'provider'},
+                'isMobile': False, 'isMonitor': True, 'instruments': [{'id': 2, 'name': 'Monitor'}],
+                'sensors': sensors,
+                'coordinates': {'latitude': 40.0 + location_id % 100 / 100, 'longitude': -3.0},
+                'licenses': None, 'bounds': [-3.0, 40.0, -3.0, 40.0], 'distance': None,
+                'datetimeFirst': {'utc': self.first_day.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                  'local': self.first_day.strftime('%Y-%m-%dT%H:%M:%S+01:00')},
+                'datetimeLast': {'utc': self.last_day.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                 'local': self.last_day.strftime('%Y-%m-%dT%H:%M:%S+01:00')},
+            })
+        return _page(results, params)
+
+    def measurements(self, sensor_id, params, step=timedelta(days=1)):
+        """
+        Mediciones diarias u horarias (`step`) con datetimeFrom en [datetime_from, datetime_to).
+        El valor de cada periodo depende solo del sensor y de la fecha, de modo
+        que dos peticiones que se solapan devuelven las mismas filas.
+        """
+        start = max(_parse_date(params['datetime_from']), self.first_day) if 'datetime_from' in params \
+            else self.first_day
+        end = min(_parse_date(params['datetime_to']), self.last_day) if 'datetime_to' in params \
+            else self.last_day
+        periods = max(int((end - start) / step), 0)
+        limit = int(params.get('limit', 100))
+        page = int(params.get('page', 1))
+        label, interval = ('1 day', '24:00:00') if step == timedelta(days=1) else ('1 hour', '01:00:00')
+        results = []
+        for period in range((page - 1) * limit, min(page * limit, periods)):
+            moment = start + step * period
+            value = random.Random(f'{sensor_id}-{moment.isoformat()}').random() * 50
+            results.append({
+                'value': value,
+                'parameter': {'id': 2, 'name': 'pm25', 'units': 'µg/m³'},
+                'period': {
+                    'label': label, 'interval': interval,
+                    'datetimeFrom': {'utc': moment.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                     'local': moment.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+                    'datetimeTo': {'utc': (moment + step).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                   'local': (moment + step).strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+                },
+                'summary': {'min': value * 0.5, 'q02': value * 0.55, 'q25': value * 0.8, 'median': value,
+                            'q75': value * 1.2, 'q98': value * 1.45, 'max': value * 1.5, 'avg': value,
+                            'sd': value * 0.1},
+            })
+        # Como la API real, con muchos resultados el total puede llegar abierto ('>1000')
+        found = f'>{limit}' if self.open_found and periods > limit else periods
+        return {'meta': {'name': 'openaq-api', 'page': page, 'limit': limit, 'found': found}, 'results': results}
+
+    # ------------------------------- REE ------------------------------
+    def ree(self, params):
+        start = _parse_date(params['start_date'])
+        end = _parse_date(params['end_date'])
+        included = []
+        for serie_id, title in (('10027', 'Demanda real'), ('10044', 'Demanda programada')):
+            values = []
+            for day in range((end - start).days + 1):
+                moment = start + timedelta(days=day)
+                values.append({'value': 700000 + (day * 7919) % 100000, 'percentage': 1,
+                               'datetime': moment.strftime('%Y-%m-%dT%H:%M:%S.000+01:00')})
+            included.append({'type': title, 'id': serie_id,
+                             'attributes': {'title': title, 'last-update': None, 'values': values}})
+        return {'data': {'type': 'Demanda', 'id': 'dem1'}, 'included': included}
+
+    # ----------------------------- INCLASNS ---------------------------
+    def indicadores(self):
+        nombres = ['Tasa de hospitalización por EPOC', 'Prevalencia de asma', 'Casos de tosferina', 'Otro']
+        return [{'codigo': codigo, 'nombre': f'{nombres[codigo % len(nombres)]} {codigo}'}
+                for codigo in range(1, self.indicators + 1)]
+
+    def datos(self, params):
+        codigo = int(params['indicador'])
+        rows = [{'anio': anio, 'ccaa': ccaa, 'sexo': sexo, 'valor': round((anio * codigo) % 97 + 0.5, 2)}
+                for anio in range(2005, 2024) for ccaa in CCAA for sexo in ('Hombres', 'Mujeres', 'Total')]
+        return [{'codigo': codigo, 'datos': rows}]
+
+    # ------------------------------ Servidor --------------------------
+    def rate_limit(self, endpoint):
+        """
+        Registra la petición en la ventana de OpenAQ. Devuelve (admitida,
+        restantes, segundos hasta el reseteo).
+        """
+        if self.openaq_rate_limit is None or not endpoint or not endpoint.startswith('openaq/'):
+            return True, 1000000, 60
+        now = time.monotonic()
+        with self._lock:
+            while self._window and now - self._window[0] >= self.rate_period:
+                self._window.popleft()
+            allowed = len(self._window) < self.openaq_rate_limit
+            if allowed:
+                self._window.append(now)
+            reset = self.rate_period - (now - self._window[0]) if self._window else self.rate_period
+            if not allowed:
+                self.calls['openaq/429'] += 1
+            return allowed, self.openaq_rate_limit - len(self._window), max(1, math.ceil(reset))
+
+    def route(self, path, params):
+        if path == '/v3/parameters':
+            return 'openaq/parameters', self.parameters(params)
+        if path == '/v3/locations':
+            return 'openaq/locations', self.locations(params)
+        if path.startswith('/v3/sensors/') and path.endswith('/measurements/daily'):
+            return 'openaq/measurements', self.measurements(path.split('/')[3], params)
+        if path.startswith('/v3/sensors/') and path.endswith('/measurements/hourly'):
+            return 'openaq/measurements', self.measurements(path.split('/')[3], params, timedelta(hours=1))
+        if '/datos/' in path:
+            return 'ree', self.ree(params)
+        if path == '/api/v2/indicador':
+            return 'inclasns/indicador', self.indicadores()
+        if path == '/api/v2/datos':
+            return 'inclasns/datos', self.datos(params)
+        return None, None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+                endpoint, payload = stub.route(url.path, params)
+                allowed, remaining, reset = stub.rate_limit(endpoint)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if allowed and endpoint == 'openaq/measurements' and int(params.get('page', 1)) in stub.fail_pages:
+                    with stub._lock:
+                        stub.calls['openaq/500'] += 1
+                    body, status = b'{"message": "Internal Server Error"}', 500
+                elif allowed:
+                    with stub._lock:
+                        stub.calls[endpoint or 'desconocido'] += 1
+                    body = json.dumps(payload).encode('utf-8') if endpoint else b'{"message": "Not Found"}'
+                    status = 200 if endpoint else 404
+                else:
+                    body, status = b'{"message": "Too Many Requests"}', 429
+                etag = None
+                if status == 200 and endpoint in ('openaq/parameters', 'openaq/locations'):
+                    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        body, status = b'', 304
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('x-ratelimit-remaining', str(remaining))
+                self.send_header('x-ratelimit-reset', str(reset))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def take_calls(self):
+        """
+        Devuelve y pone a cero el contador de llamadas por endpoint.
+        """
+        with self._lock:
+            calls, self.calls = dict(self.calls), Counter()
+        return calls
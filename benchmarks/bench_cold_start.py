@@ -0,0 +1,129 @@
+"""
+Informe de arranque en frío de las Lambdas: tiempo de importación del módulo
+del handler (lo que Lambda cuenta como Init Duration), pico de memoria tras
+importarlo y los paquetes que más pesan en la importación.
+
+Cada medición se hace en un intérprete nuevo con `python -X importtime`, de
+modo que no se reutiliza nada de una importación anterior; se toma el mínimo
+de `--repeat` ejecuciones. Con `--ref` se mide también el código de esa
+revisión de git (extraída con `git archive`) para comparar antes y después.
+
+Uso:
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --ref HEAD~1 --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HANDLERS = ['getHealthData', 'get_ree_data', 'get_openaq_sensors', 'DividirSensoresEnLotes', 'get_open_aq_data',
+            'CompactarMediciones']
+# Paquetes de terceros cuyo peso se desglosa en el informe
+HEAVY_PACKAGES = ['awswrangler', 'pandas', 'numpy', 'pyarrow', 'boto3', 'botocore', 'requests']
+
+PROBE = """
+import json, os, resource, sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+__import__({name!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{'import_seconds': seconds,
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Microsegundos acumulados de la importación de primer nivel de cada paquete.
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        package = name.strip().split('.')[0]
+        # La primera aparición de un paquete con menor sangría es su importación completa
+        depth = len(name) - len(name.lstrip())
+        if package not in packages or depth <= packages[package][1]:
+            packages[package] = (max(int(cumulative), packages.get(package, (0, 0))[0]), depth)
+    return {package: value for package, (value, _) in packages.items()}
+
+
+def measure(root, name):
+    paths = [os.path.join(root, 'lambda_layers', 'tfm_common'), os.path.join(root, 'lambda_functions', name)]
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.getenv('AWS_DEFAULT_REGION', 'us-east-1'))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(paths=paths, name=name)],
+                             capture_output=True, text=True, env=env, cwd=root)
+    if process.returncode != 0:
+        raise RuntimeError(f'{name}: {process.stderr.strip().splitlines()[-1]}')
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    packages = parse_importtime(process.stderr)
+    result['packages'] = {package: round(packages[package] / 1e6, 3)
+                          for package in HEAVY_PACKAGES if package in packages}
+    return result
+
+
+def measure_best(root, name, repeat):
+    runs = [measure(root, name) for _ in range(repeat)]
+    return min(runs, key=lambda run: run['import_seconds'])
+
+
+def export_ref(ref, target):
+    """
+    Extrae en `target` las Lambdas y la capa tal y como estaban en `ref`; las
+    revisiones anteriores a la capa tfm_common solo tienen lambda_functions.
+    """
+    archive = os.path.join(target, 'tree.tar')
+    listed = subprocess.run(['git', 'ls-tree', '--name-only', ref, 'lambda_functions', 'lambda_layers'],
+                            cwd=ROOT, check=True, capture_output=True, text=True).stdout.split()
+    subprocess.run(['git', 'archive', '--format=tar', '-o', archive, ref] + listed, cwd=ROOT, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(target)
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handlers', default=','.join(HANDLERS))
+    parser.add_argument('--repeat', type=int, default=3, help='ejecuciones por handler (se toma el mínimo)')
+    parser.add_argument('--ref', help='revisión de git con la que comparar')
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        roots = {'actual': ROOT}
+        if args.ref:
+            roots = {args.ref: export_ref(args.ref, tmp), 'actual': ROOT}
+        for label, root in roots.items():
+            for name in args.handlers.split(','):
+                if not os.path.isdir(os.path.join(root, 'lambda_functions', name)):
+                    print(f"{name} no existe en {label}: no se mide")
+                    continue
+                results.setdefault(name, {})[label] = measure_best(root, name, args.repeat)
+
+    print(f"{'lambda':<24} {'versión':<10} {'import s':>9} {'RSS MB':>8}  paquetes (s acumulados)")
+    for name, versions in results.items():
+        for label, result in versions.items():
+            packages = ', '.join(f'{package} {seconds:.2f}' for package, seconds in result['packages'].items())
+            print(f"{name:<24} {label:<10} {result['import_seconds']:>9.2f} {result['peak_rss_mb']:>8.1f}  "
+                  f"{packages}")
+        if args.ref in versions and 'actual' in versions:
+            before, after = versions[args.ref], versions['actual']
+            print(f"{'':<24} {'cambio':<10} {after['import_seconds'] - before['import_seconds']:>+9.2f} "
+                  f"{after['peak_rss_mb'] - before['peak_rss_mb']:>+8.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
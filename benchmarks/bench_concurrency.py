@@ -0,0 +1,121 @@
+"""
+Tiempo extremo a extremo de MainDataPipeline según el MaxConcurrency del Map.
+
+Ejecuta la máquina orquestadora con sfn_local.py (cada iteración del Map lanza
+la máquina trabajadora y esta su Lambda) contra el stub de api_stub.py y un
+servidor de moto, como bench_pipeline.py. Las Lambdas corren en un pool de
+procesos del tamaño de la concurrencia, un proceso por "contenedor".
+
+Se empieza en DividirSensoresEnLotes con la lista completa de sensores del stub
+para que el Map tenga la escala pedida; con `--full` se ejecuta desde el
+principio. El job de Glue no se lanza.
+
+`--rate-limit` aplica en el stub un límite compartido de peticiones por minuto
+a OpenAQ (el real es 60/min por clave) para ver a partir de qué concurrencia
+deja de mejorar el tiempo. `--latency` añade a cada respuesta del stub la
+latencia de red que en local no existe (por defecto 100 ms).
+
+Uso:
+    python benchmarks/bench_concurrency.py --sensors 1000 --concurrency 1,2,4,8
+    python benchmarks/bench_concurrency.py --sensors 200 --concurrency 1,4 --rate-limit 600
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+import boto3
+import requests
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from api_stub import ApiStub  # noqa: E402
+from bench_pipeline import BUCKET, REGION, free_port, lambda_env  # noqa: E402
+from sfn_local import LocalStateMachineRunner  # noqa: E402
+
+STATE_MACHINE = 'MainDataPipeline'
+
+
+def prepare_aws(moto_url):
+    requests.post(f'{moto_url}/moto-api/reset')
+    session = boto3.session.Session(aws_access_key_id='testing', aws_secret_access_key='testing',
+                                    region_name=REGION)
+    session.client('s3', endpoint_url=moto_url).create_bucket(Bucket=BUCKET)
+    session.client('secretsmanager', endpoint_url=moto_url).create_secret(
+        Name='tfm-ucm', SecretString=json.dumps({'openaq': 'bench', 'inclasns': 'bench'}))
+
+
+def run_concurrency(concurrency, args, moto_url):
+    prepare_aws(moto_url)
+    stub = ApiStub(sensors=args.sensors, days=args.days, openaq_rate_limit=args.rate_limit,
+                   latency=args.latency / 1000)
+    env = lambda_env(moto_url, stub.start(), args.days)
+    if args.rate_limit:
+        # Cada proceso parte del límite real y se recalibra con las cabeceras del stub
+        env['openaq_rate_limit'] = str(args.rate_limit)
+    env['batch_size'] = str(args.batch_size)
+    runner = LocalStateMachineRunner(processes=concurrency, max_concurrency=concurrency, env=env,
+                                     quiet=not args.verbose)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            start = time.perf_counter()
+            if args.full:
+                runner.start_execution(STATE_MACHINE, {})
+            else:
+                runner.start_execution(STATE_MACHINE, stub.sensor_ids(), start_at='DividirSensoresEnLotes')
+            seconds = time.perf_counter() - start
+    finally:
+        runner.close()
+        stub.stop()
+    summary = runner.summary()
+    calls = stub.take_calls()
+    return {
+        'seconds': round(seconds, 2),
+        'map_seconds': round(summary.get(f'{STATE_MACHINE}/Map', (0, 0.0))[1], 2),
+        'batches': summary.get(f'{STATE_MACHINE}/Map[]/OpenAQStepFunction', (0, 0.0))[0],
+        'api_calls': sum(calls.values()) - calls.get('openaq/429', 0),
+        'rate_limited': calls.get('openaq/429', 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=100, help='sensores por lote de DividirSensoresEnLotes')
+    parser.add_argument('--concurrency', default='1,2,4,8', help='valores de MaxConcurrency, separados por comas')
+    parser.add_argument('--latency', type=float, default=100, help='milisegundos de latencia por petición al stub')
+    parser.add_argument('--rate-limit', type=int, help='peticiones por minuto a OpenAQ en el stub')
+    parser.add_argument('--full', action='store_true', help='ejecuta la máquina desde getHealthData')
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    parser.add_argument('--verbose', action='store_true', help='muestra la salida de las Lambdas')
+    args = parser.parse_args()
+
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    results = {}
+    try:
+        print(f"{'concurrencia':>12} {'lotes':>6} {'segundos':>9} {'Map':>9} {'llamadas':>9} {'429':>6} {'aceleración':>12}")
+        for concurrency in [int(value) for value in args.concurrency.split(',')]:
+            metrics = run_concurrency(concurrency, args, f'http://127.0.0.1:{port}')
+            results[str(concurrency)] = metrics
+            speedup = next(iter(results.values()))['seconds'] / metrics['seconds']
+            print(f"{concurrency:>12} {metrics['batches']:>6} {metrics['seconds']:>9.2f} "
+                  f"{metrics['map_seconds']:>9.2f} {metrics['api_calls']:>9} {metrics['rate_limited']:>6} {speedup:>11.2f}x")
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Micro-benchmark del aplanado de mediciones diarias de OpenAQ.
+
+Compara el camino anterior de get_open_aq_data (DataFrame de dicts, varios
+`.apply` fila a fila, `json_normalize` + `concat` y el re-etiquetado de
+`sensor_id` tras cada página) con `flatten.flatten_daily_measurements`.
+Cada camino se ejecuta en un proceso aparte para medir su pico de memoria.
+
+Uso:
+    python benchmarks/bench_flatten.py --days 20000 --page-size 1000
+    python benchmarks/bench_flatten.py --fixture historial_sensor.json
+
+El fixture puede ser una lista de respuestas de la API (con `results`) o
+directamente una lista de registros.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_functions', 'get_open_aq_data'))
+
+SUMMARY = {'min': 1.0, 'q02': 1.2, 'q25': 3.5, 'median': 5.0, 'q75': 7.5, 'q98': 9.8, 'max': 10.0,
+           'avg': 5.1, 'sd': 2.2}
+
+
+def synthetic_pages(days, page_size):
+    """
+    Historial sintético con la forma de /measurements/daily (horario de verano incluido).
+    """
+    start = datetime(2016, 1, 1, tzinfo=timezone.utc)
+    pages, page = [], []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        offset = '+02:00' if 3 < day.month < 11 else '+01:00'
+        local_from = day.strftime('%Y-%m-%dT%H:%M:%S') + offset
+        local_to = (day + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S') + offset
+        page.append({
+            'value': 5.0 + i % 7,
+            'flagInfo': {'hasFlags': False},
+            'parameter': {'id': 2, 'name': 'pm25', 'units': 'µg/m³'},
+            'period': {'label': '1 day', 'interval': '24:00:00',
+                       'datetimeFrom': {'utc': day.strftime('%Y-%m-%dT%H:%M:%SZ'), 'local': local_from},
+                       'datetimeTo': {'utc': (day + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                      'local': local_to}},
+            'coordinates': None,
+            'summary': dict(SUMMARY),
+            'coverage': {'expectedCount': 24, 'observedCount': 24, 'percentComplete': 100.0},
+        })
+        if len(page) == page_size:
+            pages.append(page)
+            page = []
+    if page:
+        pages.append(page)
+    return pages
+
+
+def load_fixture(path, page_size):
+    with open(path) as f:
+        data = json.load(f)
+    if data and isinstance(data[0], dict) and 'results' in data[0]:
+        return [response['results'] for response in data]
+    return [data[i:i + page_size] for i in range(0, len(data), page_size)]
+
+
+def legacy_path(pages, sensor_id):
+    """
+    Copia del camino anterior. Solo se añade `utc=True` a `pd.to_datetime`, sin
+    el cual las versiones recientes de pandas rechazan desplazamientos mixtos.
+    """
+    import pandas as pd
+
+    all_daily_measurements = []
+    for page in pages:
+        all_daily_measurements.extend(page)
+        for i, _ in enumerate(all_daily_measurements):
+            all_daily_measurements[i]['sensor_id'] = sensor_id
+
+    sensor_df = pd.DataFrame(all_daily_measurements)
+    sensor_df['datetimeFrom'] = pd.to_datetime(sensor_df['period'].apply(
+        lambda x: x.get('datetimeFrom', {}).get('local')), errors='coerce', utc=True)
+    sensor_df['datetimeTo'] = pd.to_datetime(sensor_df['period'].apply(
+        lambda x: x.get('datetimeTo', {}).get('local')), errors='coerce', utc=True)
+    sensor_df['datetimeFrom'] = sensor_df['datetimeFrom'].apply(lambda x: x.tz_convert(None) if pd.notnull(x) else x)
+    sensor_df['datetimeTo'] = sensor_df['datetimeTo'].apply(lambda x: x.tz_convert(None) if pd.notnull(x) else x)
+    if 'summary' in sensor_df.columns:
+        normalized_summary = pd.json_normalize(sensor_df['summary'])
+        sensor_df = pd.concat([sensor_df.reset_index(drop=True), normalized_summary], axis=1)
+    sensor_df.drop(columns=['flagInfo', 'parameter', 'period', 'coordinates', 'summary', 'coverage'],
+                   inplace=True, errors='ignore')
+    return sensor_df
+
+
+def columnar_path(pages, sensor_id):
+    from flatten import flatten_daily_measurements
+    return flatten_daily_measurements(pages, sensor_id).to_pandas()
+
+
+def _run(name, args, queue):
+    import pandas  # noqa: F401  (la importación no cuenta en el pico medido)
+    import pyarrow  # noqa: F401
+    pages = load_fixture(args.fixture, args.page_size) if args.fixture else synthetic_pages(args.days, args.page_size)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    df = (legacy_path if name == 'legacy' else columnar_path)(pages, '12345')
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb
+    checksum = float(df['value'].sum()) + float(df['datetimeTo'].astype('int64').sum() % 1_000_003)
+    queue.put({'path': name, 'rows': len(df), 'seconds': elapsed, 'peak_mib': peak_kb / 1024,
+               'checksum': checksum})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=20000, help='registros diarios sintéticos')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--fixture', help='JSON grabado de la API en lugar de datos sintéticos')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for name in ('legacy', 'columnar'):
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run, args=(name, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    print(f"{'camino':<10} {'filas':>10} {'segundos':>10} {'filas/s':>12} {'pico MiB':>10}")
+    for r in results:
+        print(f"{r['path']:<10} {r['rows']:>10} {r['seconds']:>10.3f} {r['rows'] / r['seconds']:>12.0f} "
+              f"{r['peak_mib']:>10.1f}")
+    legacy, columnar = results
+    print(f"Aceleración: x{legacy['seconds'] / columnar['seconds']:.1f}. "
+          f"Resultados equivalentes: {abs(legacy['checksum'] - columnar['checksum']) < 1e-6}")
+
+
+if __name__ == '__main__':
+    main()
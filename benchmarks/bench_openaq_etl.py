@@ -0,0 +1,144 @@
+"""
+Compara en PySpark local el plan anterior de OpenAQ_ETL con el actual.
+
+El plan anterior se reproduce con DataFrames: joins con shuffle (sin broadcast),
+dos pasadas para year/month y `coalesce(1)` antes de escribir. El actual usa las
+funciones de glue_scripts/OpenAQ_ETL.py. Ambos leen los mismos datos de prueba.
+
+Uso:
+    python benchmarks/bench_openaq_etl.py --sensors 2000 --files 400 --days 365
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'glue_scripts'))
+
+LOCALITIES = ['Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Bilbao', 'Zaragoza', 'Málaga', 'Murcia']
+
+
+def build_fixture(root, sensors, files, days):
+    """
+    Datos de staging con la misma forma que escriben las Lambdas.
+    """
+    random.seed(42)
+    staging = os.path.join(root, 'staging', 'OpenAQ')
+    for sub in ('locations', 'parameters', 'measurements'):
+        os.makedirs(os.path.join(staging, sub), exist_ok=True)
+
+    parameters = pd.DataFrame({
+        'id': list(range(1, 11)),
+        'name': [f'param_{i}' for i in range(1, 11)],
+        'units': ['µg/m³'] * 10,
+        'displayName': [f'P{i}' for i in range(1, 11)],
+        'description': [f'Parámetro {i}' for i in range(1, 11)],
+    })
+    parameters.to_parquet(os.path.join(staging, 'parameters', 'parameters.parquet'))
+
+    locations = pd.DataFrame({
+        'id': [i // 4 for i in range(sensors)],
+        'name': [f'Estación {i // 4}' for i in range(sensors)],
+        'locality': [LOCALITIES[(i // 4) % len(LOCALITIES)] for i in range(sensors)],
+        'timezone': ['Europe/Madrid'] * sensors,
+        'country': ['Spain'] * sensors,
+        'isMonitor': [True] * sensors,
+        'latitud': [40.0 + random.random() for _ in range(sensors)],
+        'longitud': [-3.0 + random.random() for _ in range(sensors)],
+        'sensor_id': list(range(sensors)),
+        'parameter_id': [1 + i % 10 for i in range(sensors)],
+    })
+    locations.to_parquet(os.path.join(staging, 'locations', 'locations.parquet'))
+
+    start = datetime(2024, 1, 1)
+    sensor_ids = list(range(sensors))
+    per_file = max(sensors // files, 1)
+    for n in range(files):
+        chunk = sensor_ids[n * per_file:(n + 1) * per_file] or [sensor_ids[n % sensors]]
+        rows = [(float(random.random() * 50), str(s), start + timedelta(days=d), start + timedelta(days=d + 1))
+                for s in chunk for d in range(days)]
+        df = pd.DataFrame(rows, columns=['value', 'sensor_id', 'datetimeFrom', 'datetimeTo'])
+        for col in ('min', 'max', 'avg', 'sd'):
+            df[col] = df['value']
+        df.to_parquet(os.path.join(staging, 'measurements', f'lote_{n:05d}.parquet'))
+
+
+def legacy_plan(spark, root, output):
+    from pyspark.sql import functions as F
+
+    spark.conf.set('spark.sql.autoBroadcastJoinThreshold', -1)
+    staging = f'{root}/staging/OpenAQ'
+    locations = spark.read.parquet(f'{staging}/locations/locations.parquet').select(
+        'id', F.col('name').alias('locations_name'), 'locality', 'timezone', 'country',
+        F.col('isMonitor').alias('ismonitor'), 'latitud', 'longitud', 'sensor_id', 'parameter_id')
+    parameters = spark.read.parquet(f'{staging}/parameters/parameters.parquet').select(
+        F.col('id').alias('param_id'), F.col('name').alias('parameter_name'),
+        F.col('units').alias('parameter_units'), F.col('displayName').alias('parameter_displayname'),
+        F.col('description').alias('parameter_description'))
+    measurements = spark.read.option('recursiveFileLookup', 'true').parquet(f'{staging}/measurements/')
+    measurements = measurements.withColumn('year', F.year('datetimeTo'))
+    dimension = locations.join(parameters, locations.parameter_id == parameters.param_id).drop('param_id')
+    measurements = measurements.withColumn('month', F.month('datetimeTo'))
+    measurements = measurements.withColumn('sensor_id', F.col('sensor_id').cast('long'))
+    result = measurements.join(dimension, on='sensor_id')
+    if result.count() >= 1:
+        result = result.coalesce(1)
+    result.write.mode('append').partitionBy('locality', 'year', 'month').parquet(output)
+    spark.conf.unset('spark.sql.autoBroadcastJoinThreshold')
+
+
+def current_plan(spark, root, output):
+    import OpenAQ_ETL as etl
+
+    measurements, locations, parameters = etl.read_sources(spark, root)
+    result = etl.transform(measurements, locations, parameters)
+    etl.write_lake(spark, result, output, target_file_mb=128, bytes_per_row=64)
+
+
+def count_files(path):
+    return sum(1 for _, _, fs in os.walk(path) for f in fs if f.endswith('.parquet'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=400, help='ficheros de staging de mediciones')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--master', default='local[4]')
+    args = parser.parse_args()
+
+    from pyspark.sql import SparkSession
+    spark = (SparkSession.builder.master(args.master).appName('bench_openaq_etl')
+             .config('spark.ui.showConsoleProgress', 'false').getOrCreate())
+    spark.sparkContext.setLogLevel('ERROR')
+
+    root = tempfile.mkdtemp(prefix='bench_etl_')
+    try:
+        build_fixture(root, args.sensors, args.files, args.days)
+        print(f"Fixture: {args.sensors} sensores, {args.files} ficheros, {args.sensors * args.days} filas")
+        print(f"{'plan':<10} {'segundos':>10} {'stages':>8} {'tareas':>8} {'ficheros':>9}")
+        for name, plan in (('anterior', legacy_plan), ('actual', current_plan)):
+            output = os.path.join(root, f'out_{name}')
+            tracker = spark.sparkContext.statusTracker()
+            spark.sparkContext.setJobGroup(name, name)
+            start = time.perf_counter()
+            plan(spark, root, output)
+            elapsed = time.perf_counter() - start
+            stages = [tracker.getStageInfo(s) for j in tracker.getJobIdsForGroup(name)
+                      for s in (tracker.getJobInfo(j).stageIds if tracker.getJobInfo(j) else [])]
+            stages = [s for s in stages if s is not None]
+            tasks = sum(s.numTasks for s in stages)
+            print(f"{name:<10} {elapsed:>10.2f} {len(stages):>8} {tasks:>8} {count_files(output):>9}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        spark.stop()
+
+
+if __name__ == '__main__':
+    main()
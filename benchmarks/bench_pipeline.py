@@ -0,0 +1,260 @@
+"""
+Benchmark extremo a extremo y sin conexión de las Lambdas de ingesta.
+
+Las APIs se sustituyen por el stub local de api_stub.py y S3 y Secrets Manager
+por un servidor de moto. Cada `lambda_handler` se ejecuta en su propio proceso
+(para medir su pico de memoria) y en el orden del pipeline: getHealthData,
+get_ree_data, get_openaq_sensors, DividirSensoresEnLotes y get_open_aq_data
+(una invocación por lote, como en el Map de Step Functions).
+
+Para cada escala (número de sensores) se informa del tiempo, las llamadas a la
+API, los bytes escritos en S3 y el pico de RSS, y se compara con la línea base
+guardada en benchmarks/baselines/bench_pipeline.json.
+
+Requiere `moto[server]` y las dependencias de las Lambdas (awswrangler).
+
+Uso:
+    python benchmarks/bench_pipeline.py --scales 10,1000,10000
+    python benchmarks/bench_pipeline.py --scales 10,1000 --save-baseline
+    python benchmarks/bench_pipeline.py --scales 10 --days 20000 --env streaming_writer=true
+"""
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+from datetime import datetime, timedelta
+
+import boto3
+import requests
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from api_stub import ApiStub  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+LAYER_PATH = os.path.join(ROOT, 'lambda_layers', 'tfm_common')
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baselines', 'bench_pipeline.json')
+HANDLERS = ['getHealthData', 'get_ree_data', 'get_openaq_sensors', 'DividirSensoresEnLotes', 'get_open_aq_data']
+BUCKET = 'tfm-ucm-bench'
+FIRST_DAY = '2024-01-01'
+REGION = 'us-east-1'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_handler(name, events, env, conn, verbose=False):
+    """
+    Proceso hijo: importa la Lambda, la invoca con cada evento y devuelve tiempos,
+    pico de RSS y el resultado de la última invocación.
+    """
+    os.environ.update(env)
+    sys.path[:0] = [LAYER_PATH, os.path.join(ROOT, 'lambda_functions', name)]
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            start = time.perf_counter()
+            module = __import__(name)
+            import_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            results = [module.lambda_handler(event, None) for event in events]
+            seconds = time.perf_counter() - start
+        conn.send({
+            'seconds': round(seconds, 3),
+            'import_seconds': round(import_seconds, 3),
+            'invocations': len(events),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'result': results[-1] if results else None,
+        })
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+
+
+def list_objects(s3):
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['ETag'], obj['Size'])
+    return objects
+
+
+def written(before, after):
+    changed = [key for key, value in after.items() if before.get(key) != value]
+    return len(changed), sum(after[key][1] for key in changed)
+
+
+def lambda_env(moto_url, api_url, days):
+    end = datetime.fromisoformat(FIRST_DAY) + timedelta(days=days)
+    return {
+        'AWS_ENDPOINT_URL': moto_url,
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': REGION,
+        'secrets_region': REGION,
+        'bucket_name': BUCKET,
+        'openaq_base_url': api_url,
+        'ree_base_url': api_url,
+        'inclasns_base_url': api_url,
+        # El stub no limita la tasa: se mide el pipeline, no la espera al límite real
+        'openaq_rate_limit': '1000000',
+        'start_date': f'{FIRST_DAY}T00:00:00Z',
+        'end_date': end.strftime('%Y-%m-%dT00:00:00Z'),
+        'uri_definition': '/es/datos/demanda/evolucion',
+        'time_trunc': 'day',
+        # Una línea EMF por llamada, como en la línea base (en Lambda el valor por defecto es summary)
+        'telemetry_level': 'events',
+    }
+
+
+def get_events(name, stub, days, previous):
+    end = (datetime.fromisoformat(FIRST_DAY) + timedelta(days=days)).strftime('%Y-%m-%d')
+    if name == 'get_ree_data':
+        return [{'full_refresh': True, 'fecha_ini': FIRST_DAY, 'fecha_fin': end}]
+    if name == 'DividirSensoresEnLotes':
+        # Se reparte la lista completa del stub para medir la escala pedida
+        return [stub.sensor_ids()]
+    if name == 'get_open_aq_data':
+        return list(previous.get('DividirSensoresEnLotes') or [])
+    return [{}]
+
+
+def run_scale(scale, days, handlers, moto_url, verbose=False, extra_env=None):
+    requests.post(f'{moto_url}/moto-api/reset')
+    session = boto3.session.Session(aws_access_key_id='testing', aws_secret_access_key='testing',
+                                    region_name=REGION)
+    s3 = session.client('s3', endpoint_url=moto_url)
+    s3.create_bucket(Bucket=BUCKET)
+    session.client('secretsmanager', endpoint_url=moto_url).create_secret(
+        Name='tfm-ucm', SecretString=json.dumps({'openaq': 'bench', 'inclasns': 'bench'}))
+
+    stub = ApiStub(sensors=scale, days=days)
+    api_url = stub.start()
+    env = dict(lambda_env(moto_url, api_url, days), **(extra_env or {}))
+    context = multiprocessing.get_context('spawn')
+    metrics, previous = {}, {}
+    try:
+        for name in handlers:
+            events = get_events(name, stub, days, previous)
+            before = list_objects(s3)
+            stub.take_calls()
+            parent, child = context.Pipe(duplex=False)
+            process = context.Process(target=run_handler, args=(name, events, env, child, verbose))
+            process.start()
+            child.close()
+            result = parent.recv()
+            process.join()
+            if 'error' in result:
+                raise RuntimeError(f'{name} (escala {scale}): {result["error"]}')
+
+            calls = stub.take_calls()
+            objects, bytes_written = written(before, list_objects(s3))
+            previous[name] = result.pop('result')
+            metrics[name] = dict(result, api_calls=sum(calls.values()), api_calls_by_endpoint=calls,
+                                 objects_written=objects, bytes_written=bytes_written)
+    finally:
+        stub.stop()
+    return metrics
+
+
+def compare(current, baseline, tolerance):
+    """
+    Imprime las diferencias con la línea base y devuelve la lista de regresiones.
+    Las llamadas a la API deben coincidir; tiempo, bytes y memoria admiten `tolerance`.
+    """
+    regressions = []
+    print(f"\n{'escala':>7} {'lambda':<24} {'métrica':<14} {'base':>12} {'actual':>12} {'cambio':>8}")
+    for scale, handlers in current.items():
+        for name, metrics in handlers.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            for key in ('seconds', 'api_calls', 'bytes_written', 'peak_rss_mb'):
+                old, new = base.get(key), metrics.get(key)
+                if old is None or new is None:
+                    continue
+                change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+                limit = 0 if key == 'api_calls' else tolerance
+                # Tiempos por debajo de medio segundo son ruido
+                regression = change > limit and not (key == 'seconds' and new - old < 0.5)
+                if regression:
+                    regressions.append(f'{scale}/{name}/{key}')
+                if regression or abs(change) > tolerance:
+                    print(f"{scale:>7} {name:<24} {key:<14} {old:>12} {new:>12} {change:>+7.0%}"
+                          f"{'  REGRESIÓN' if regression else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10,1000', help='número de sensores, separados por comas')
+    parser.add_argument('--days', type=int, default=30, help='días de mediciones por sensor')
+    parser.add_argument('--handlers', default=','.join(HANDLERS))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='guarda los resultados como línea base')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='margen admitido en tiempo, bytes y memoria')
+    parser.add_argument('--output', help='fichero JSON donde guardar los resultados')
+    parser.add_argument('--verbose', action='store_true', help='muestra la salida de las Lambdas')
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR',
+                        help='variable de entorno adicional para las Lambdas (se puede repetir)')
+    args = parser.parse_args()
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    moto_url = f'http://127.0.0.1:{port}'
+    results = {}
+    try:
+        print(f"{'escala':>7} {'lambda':<24} {'segundos':>9} {'llamadas':>9} {'objetos':>8} "
+              f"{'bytes':>12} {'RSS MB':>8}")
+        for scale in [int(value) for value in args.scales.split(',')]:
+            metrics = run_scale(scale, args.days, args.handlers.split(','), moto_url, args.verbose,
+                                extra_env)
+            results[str(scale)] = metrics
+            for name, m in metrics.items():
+                print(f"{scale:>7} {name:<24} {m['seconds']:>9.2f} {m['api_calls']:>9} {m['objects_written']:>8} "
+                      f"{m['bytes_written']:>12} {m['peak_rss_mb']:>8.1f}")
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print(f"\nLínea base guardada en {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nRegresiones respecto a la línea base: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nSin regresiones respecto a la línea base.")
+
+
+if __name__ == '__main__':
+    main()
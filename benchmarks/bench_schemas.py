@@ -0,0 +1,128 @@
+"""
+Compara tamaño en parquet y memoria en pandas de las salidas de staging sin
+esquema (como se escribían antes: tipos inferidos por pandas y, en INCLASNS,
+todo como texto) y con los esquemas de tfm_common.schemas.
+
+Los datos de prueba imitan las respuestas de cada API.
+
+Uso:
+    python benchmarks/bench_schemas.py --sensors 500 --days 365
+"""
+import argparse
+import io
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'tfm_common'))
+
+from tfm_common import schemas  # noqa: E402
+
+LOCALITIES = ['Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Bilbao', 'Zaragoza', 'Málaga', 'Murcia']
+CCAA = ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias', 'Cantabria', 'Castilla y León',
+        'Castilla-La Mancha', 'Cataluña', 'C. Valenciana', 'Extremadura', 'Galicia', 'Madrid', 'Murcia',
+        'Navarra', 'País Vasco', 'La Rioja', 'Ceuta', 'Melilla']
+
+
+def measurements_fixture(sensors, days):
+    start = datetime(2024, 1, 1)
+    rows = []
+    for sensor_id in range(sensors):
+        for day in range(days):
+            value = random.random() * 50
+            row = {'value': value, 'sensor_id': str(100000 + sensor_id),
+                   'datetimeFrom': start + timedelta(days=day), 'datetimeTo': start + timedelta(days=day + 1)}
+            row.update({name: value for name in schemas.SUMMARY_FIELDS})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def locations_fixture(sensors):
+    rows = []
+    for i in range(sensors):
+        rows.append({
+            'id': i // 4, 'name': f'Estación {i // 4}', 'locality': LOCALITIES[(i // 4) % len(LOCALITIES)],
+            'timezone': 'Europe/Madrid', 'country': 'Spain', 'isMonitor': True,
+            'bounds': [-3.0, 40.0, -3.0, 40.0],
+            'datetimeFirst': '2016-11-30T01:00:00+01:00', 'datetimeLast': '2025-05-01T10:00:00+02:00',
+            'latitud': 40.0 + random.random(), 'longitud': -3.0 + random.random(),
+            'sensor_id': 100000 + i, 'parameter_id': 1 + i % 10,
+        })
+    return pd.DataFrame(rows)
+
+
+def parameters_fixture():
+    return pd.DataFrame({
+        'id': list(range(1, 41)),
+        'name': [f'param_{i % 12}' for i in range(1, 41)],
+        'units': ['µg/m³', 'ppm', 'ppb', '°C'] * 10,
+        'displayName': [f'P{i}' for i in range(1, 41)],
+        'description': [f'Descripción del parámetro {i}' for i in range(1, 41)],
+    })
+
+
+def ree_fixture(days):
+    start = datetime(2024, 1, 1)
+    rows = []
+    for serie_id, serie in (('10027', 'Demanda real'), ('10044', 'Demanda programada')):
+        for hour in range(days * 24):
+            moment = start + timedelta(hours=hour)
+            rows.append({'serie_id': serie_id, 'serie': serie, 'value': 25000 + random.random() * 10000,
+                         'percentage': random.random(),
+                         'datetime': moment.strftime('%Y-%m-%dT%H:%M:%S.000+01:00'),
+                         'year': moment.year, 'month': moment.month})
+    return pd.DataFrame(rows)
+
+
+def inclasns_fixture():
+    rows = []
+    for codigo, nombre in ((1, 'Tasa de hospitalización por EPOC'), (2, 'Prevalencia de asma')):
+        for anio in range(2005, 2024):
+            for ccaa in CCAA:
+                for sexo in ('Hombres', 'Mujeres', 'Total'):
+                    rows.append({'anio': anio, 'ccaa': ccaa, 'sexo': sexo, 'valor': random.random() * 100,
+                                 'codigo': codigo, 'nombre': nombre})
+    return pd.DataFrame(rows)
+
+
+def parquet_bytes(df):
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, compression='snappy')
+    return buffer.getbuffer().nbytes
+
+
+def memory_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sensors', type=int, default=500)
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+    random.seed(42)
+
+    datasets = [
+        ('openaq_measurements', measurements_fixture(args.sensors, args.days), schemas.OPENAQ_MEASUREMENTS),
+        ('openaq_locations', locations_fixture(args.sensors * 4), schemas.OPENAQ_LOCATIONS),
+        ('openaq_parameters', parameters_fixture(), schemas.OPENAQ_PARAMETERS),
+        ('ree_values', ree_fixture(args.days), schemas.REE_VALUES),
+        # Antes se guardaba todo como texto
+        ('inclasns_datos', inclasns_fixture().astype('str'), schemas.INCLASNS_DATOS),
+    ]
+
+    print(f"{'dataset':<22} {'filas':>9} {'parquet antes':>14} {'parquet ahora':>14} "
+          f"{'memoria antes':>14} {'memoria ahora':>14}")
+    for name, df, schema in datasets:
+        typed = schemas.apply_schema(df, schema)
+        print(f"{name:<22} {len(df):>9} {parquet_bytes(df):>14} {parquet_bytes(typed):>14} "
+              f"{memory_bytes(df):>14} {memory_bytes(typed):>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Coste de reescribir una partición con write_parquet(mode='upsert') según su
+tamaño, frente a añadir un fichero con mode='append'.
+
+Cada escenario crea una partición (`month=1`) con N mediciones ya escritas y
+escribe encima un lote de `--batch` filas, de las que `--overlap` repiten una
+clave (sensor_id, datetimeFrom) existente, como un reintento que vuelve a
+descargar parte del tramo. Se repite el lote para comprobar que un segundo
+upsert no cambia el resultado. Se escribe en un directorio temporal local
+(tfm_common.storage), de modo que el tiempo es el de leer, deduplicar y
+serializar la partición, sin la red de S3.
+
+Uso:
+    python benchmarks/bench_upsert.py --sizes 10000 100000 1000000 --batch 1000 --overlap 0.5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_layers', 'tfm_common'))
+# Sin las líneas EMF de cada escritura entre los resultados
+os.environ.setdefault('telemetry_level', 'off')
+
+from tfm_common.parquet import read_parquet, write_parquet  # noqa: E402
+from tfm_common.schemas import SUMMARY_FIELDS  # noqa: E402
+from tfm_common.storage import list_uris  # noqa: E402
+
+KEY = ['sensor_id', 'datetimeFrom']
+SENSORS = 1000
+
+
+def measurements(first, count):
+    """
+    `count` mediciones diarias consecutivas a partir de la fila `first`
+    (SENSORS sensores por día), con la columna de partición month.
+    """
+    start = datetime(2024, 1, 1)
+    rows = range(first, first + count)
+    values = [random.random() * 50 for _ in rows]
+    columns = {
+        'value': pa.array(values, pa.float64()),
+        'sensor_id': pa.array([str(100000 + row % SENSORS) for row in rows], pa.string()),
+        'datetimeFrom': pa.array([start + timedelta(days=row // SENSORS) for row in rows], pa.timestamp('us')),
+        'datetimeTo': pa.array([start + timedelta(days=row // SENSORS + 1) for row in rows], pa.timestamp('us')),
+    }
+    columns.update({name: pa.array(values, pa.float64()) for name in SUMMARY_FIELDS})
+    columns['month'] = pa.array([1] * count, pa.int8())
+    return pa.table(columns)
+
+
+def dataset_state(root):
+    files = list_uris(root)
+    rows = sum(read_parquet(uri, columns=['value']).num_rows for uri, _ in files)
+    return len(files), rows, sum(size for _, size in files)
+
+
+def run(size, batch, overlap, mode, workdir):
+    root = os.path.join(workdir, f'{mode}-{size}')
+    # Siempre se parte de un único fichero con `size` filas
+    write_parquet(root, measurements(0, size), partition_cols=['month'], mode='append')
+    repeated = int(batch * overlap)
+    new_rows = measurements(size - repeated, batch)
+
+    start = time.perf_counter()
+    write_parquet(root, new_rows, partition_cols=['month'], mode=mode, key_cols=KEY)
+    seconds = time.perf_counter() - start
+    files, rows, total_bytes = dataset_state(root)
+
+    # Un reintento del mismo lote
+    write_parquet(root, new_rows, partition_cols=['month'], mode=mode, key_cols=KEY)
+    _, rows_retry, _ = dataset_state(root)
+    return {'size': size, 'mode': mode, 'seconds': seconds, 'files': files, 'rows': rows,
+            'expected': size + batch - repeated, 'rows_retry': rows_retry, 'bytes': total_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='filas ya escritas en la partición')
+    parser.add_argument('--batch', type=int, default=1000, help='filas del lote que se escribe')
+    parser.add_argument('--overlap', type=float, default=0.5, help='fracción del lote con claves ya escritas')
+    args = parser.parse_args()
+    random.seed(42)
+
+    print(f"{'filas':>9} {'modo':>7} {'segundos':>9} {'filas/s':>11} {'ficheros':>9} {'filas tras':>11} "
+          f"{'esperadas':>10} {'tras reintento':>15} {'MB':>7}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            for mode in ('append', 'upsert'):
+                result = run(size, args.batch, args.overlap, mode, workdir)
+                print(f"{result['size']:>9} {result['mode']:>7} {result['seconds']:>9.3f} "
+                      f"{(result['size'] + args.batch) / result['seconds']:>11.0f} {result['files']:>9} "
+                      f"{result['rows']:>11} {result['expected']:>10} {result['rows_retry']:>15} "
+                      f"{result['bytes'] / 1e6:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+"""
+Ejecutor local de las máquinas de estados de step_function_definition/.
+
+Interpreta las definiciones tal y como las despliega template.yaml: las
+`DefinitionSubstitutions` del template resuelven cada `${...}` a su recurso
+(Lambda, máquina de estados anidada o job de Glue) y cada Lambda se ejecuta
+con su `lambda_handler` de lambda_functions/, en el propio proceso (hilos) o
+en un pool de procesos (un proceso por "contenedor").
+
+Cubre lo que usan nuestras definiciones: estados Task (lambda:invoke,
+states:startExecution.sync:2 y glue:startJobRun), Map (INLINE, con
+MaxConcurrency configurable), Pass, Choice, Wait, Succeed y Fail, bloques
+Retry/Catch, variables (`Assign`) y un subconjunto de JSONata: rutas sobre
+`$states` y las variables, literales, comparaciones, `and`/`or`, sumas,
+concatenación (`&`) y `$string`.
+
+Uso:
+    python benchmarks/sfn_local.py MainDataPipeline --input '{}' --max-concurrency 4
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TEMPLATE_PATH = os.path.join(ROOT, 'template.yaml')
+LAYER_PATH = os.path.join(ROOT, 'lambda_layers', 'tfm_common')
+SUBSTITUTION = re.compile(r'\$\{([^}]+)\}')
+JSONATA = re.compile(r'^\{%\s*(.*?)\s*%\}$', re.S)
+
+
+class TemplateLoader(yaml.SafeLoader):
+    pass
+
+
+def _intrinsic(loader, suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node)
+    else:
+        value = loader.construct_mapping(node)
+    return {suffix: value}
+
+
+# !Ref, !GetAtt, !Sub... se cargan como {'Ref': ...}, {'GetAtt': ...}
+TemplateLoader.add_multi_constructor('!', _intrinsic)
+
+
+class StatesError(Exception):
+    """
+    Error con nombre de Step Functions (p. ej. 'States.TaskFailed').
+    """
+
+    def __init__(self, error, cause=''):
+        super().__init__(f'{error}: {cause}')
+        self.error = error
+        self.cause = cause
+
+
+# ------------------------------------------------------------------ Lambdas
+def _prepare_process(env, paths, quiet=False):
+    os.environ.update(env)
+    sys.path[:0] = [path for path in paths if path not in sys.path]
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+
+def _invoke_handler(module_name, payload):
+    module = __import__(module_name)
+    return module.lambda_handler(payload, None)
+
+
+class LambdaInvoker:
+    """
+    Ejecuta los handlers en el propio proceso (`processes=0`, hilos que
+    comparten módulos como un contenedor caliente) o en un pool de procesos.
+    """
+
+    def __init__(self, functions, processes=0, env=None, quiet=False):
+        self.functions = functions
+        self.paths = [LAYER_PATH] + sorted({function['path'] for function in functions.values()})
+        self.env = dict(env or {})
+        self.pool = None
+        if processes:
+            import multiprocessing
+            self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_prepare_process, initargs=(self.env, self.paths, quiet))
+        else:
+            _prepare_process(self.env, self.paths)
+
+    def invoke(self, logical_id, payload):
+        function = self.functions[logical_id]
+        if self.pool is not None:
+            return self.pool.submit(_invoke_handler, function['module'], payload).result()
+        return _invoke_handler(function['module'], payload)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+# ---------------------------------------------------------------- Template
+def load_template(path=TEMPLATE_PATH):
+    with open(path) as f:
+        return yaml.load(f, Loader=TemplateLoader)
+
+
+def get_functions(template, root=ROOT):
+    """
+    {id lógico: {'module', 'path'}} de las funciones del template.
+    """
+    functions = {}
+    for logical_id, resource in template['Resources'].items():
+        if resource.get('Type') == 'AWS::Serverless::Function':
+            properties = resource['Properties']
+            functions[logical_id] = {
+                'module': properties['Handler'].rsplit('.', 1)[0],
+                'path': os.path.join(root, properties['CodeUri']),
+                'name': properties.get('FunctionName', logical_id),
+            }
+    return functions
+
+
+def load_definition(path):
+    """
+    Devuelve la definición ASL de un fichero, sea la definición sola o una
+    plantilla SAM completa como las de step_function_definition/.
+    """
+    with open(path) as f:
+        document = yaml.load(f, Loader=TemplateLoader)
+    for resource in (document.get('Resources') or {}).values():
+        definition = (resource.get('Properties') or {}).get('Definition')
+        if definition:
+            return definition
+    return document
+
+
+def substitute(value, substitutions):
+    if isinstance(value, str):
+        return SUBSTITUTION.sub(lambda match: substitutions.get(match.group(1), match.group(0)), value)
+    if isinstance(value, list):
+        return [substitute(item, substitutions) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, substitutions) for key, item in value.items()}
+    return value
+
+
+def get_state_machines(template, root=ROOT):
+    """
+    {nombre: definición} con los `${...}` sustituidos por `local:<id lógico>`.
+    """
+    machines = {}
+    for logical_id, resource in template['Resources'].items():
+        if resource.get('Type') != 'AWS::Serverless::StateMachine':
+            continue
+        properties = resource['Properties']
+        substitutions = {}
+        for key, value in (properties.get('DefinitionSubstitutions') or {}).items():
+            if isinstance(value, dict):
+                value = value.get('Ref') or str(value.get('GetAtt', '')).split('.')[0]
+            substitutions[key] = f'local:{value}'
+        definition = load_definition(os.path.join(root, properties['DefinitionUri']))
+        name = properties.get('Name', logical_id)
+        machines[name] = machines[logical_id] = substitute(definition, substitutions)
+    return machines
+
+
+# ----------------------------------------------------------------- JSONata
+JSONATA_TOKEN = re.compile(r"""\s*(?:(?P<number>\d+(?:\.\d+)?)|'(?P<single>[^']*)'|"(?P<double>[^"]*)"
+                              |(?P<path>\$[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+                              |(?P<word>[A-Za-z_]+)|(?P<op>!=|<=|>=|[=<>+\-()&]))""", re.X)
+JSONATA_OPERATORS = {
+    '=': lambda a, b: a == b, '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+    '+': lambda a, b: a + b, '-': lambda a, b: a - b,
+    '&': lambda a, b: _jsonata_string(a) + _jsonata_string(b),
+}
+
+
+def _jsonata_string(value):
+    # $string: los textos quedan igual y el resto se serializa como JSON
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+JSONATA_FUNCTIONS = {'string': _jsonata_string}
+
+
+def _tokenize(expression):
+    tokens, position = [], 0
+    while expression[position:].strip():
+        match = JSONATA_TOKEN.match(expression, position)
+        if not match:
+            raise NotImplementedError(f'Expresión JSONata no soportada en local: {expression}')
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+class _Expression:
+    """
+    Subconjunto de JSONata: rutas sobre `$states` y variables (`$lote.sensors`),
+    literales, comparaciones, `and`/`or`, sumas y restas, concatenación y
+    las funciones de JSONATA_FUNCTIONS.
+    """
+
+    def __init__(self, expression, context, variables):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.context = context
+        self.variables = variables
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        value = self.parse_binary(0)
+        if self.position != len(self.tokens):
+            raise NotImplementedError(f'Expresión JSONata no soportada en local: {self.tokens[self.position:]}')
+        return value
+
+    # De menor a mayor precedencia
+    LEVELS = [('or',), ('and',), ('=', '!=', '<', '<=', '>', '>='), ('+', '-', '&')]
+
+    def parse_binary(self, level):
+        if level == len(self.LEVELS):
+            return self.parse_primary()
+        value = self.parse_binary(level + 1)
+        while self.peek()[1] in self.LEVELS[level]:
+            operator = self.take()[1]
+            other = self.parse_binary(level + 1)
+            if operator == 'and':
+                value = bool(value) and bool(other)
+            elif operator == 'or':
+                value = bool(value) or bool(other)
+            else:
+                value = JSONATA_OPERATORS[operator](value, other)
+        return value
+
+    def parse_primary(self):
+        kind, text = self.take()
+        if kind == 'number':
+            return float(text) if '.' in text else int(text)
+        if kind in ('single', 'double'):
+            return text
+        if kind == 'word' and text in ('true', 'false', 'null'):
+            return {'true': True, 'false': False, 'null': None}[text]
+        if kind == 'op' and text == '(':
+            value = self.parse_binary(0)
+            self.take()
+            return value
+        if kind == 'path' and self.peek()[1] == '(' and text[1:] in JSONATA_FUNCTIONS:
+            self.take()
+            argument = self.parse_binary(0)
+            self.take()
+            return JSONATA_FUNCTIONS[text[1:]](argument)
+        if kind == 'path':
+            name, *keys = text[1:].split('.')
+            result = self.context if name == 'states' else self.variables.get(name)
+            for key in keys:
+                result = result.get(key) if isinstance(result, dict) else None
+            return result
+        raise NotImplementedError(f'Expresión JSONata no soportada en local: {text}')
+
+
+def evaluate(value, context, variables=None):
+    """
+    Evalúa las expresiones `{% ... %}` de un valor: rutas sobre `$states`
+    (p. ej. `$states.input`, `$states.result.Payload`) y sobre las variables
+    de `Assign`, literales, comparaciones, `and`/`or` y sumas y restas.
+    """
+    if isinstance(value, dict):
+        return {key: evaluate(item, context, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [evaluate(item, context, variables) for item in value]
+    if not isinstance(value, str):
+        return value
+    match = JSONATA.match(value)
+    if not match:
+        return value
+    return _Expression(match.group(1), context, variables or {}).parse()
+
+
+# -------------------------------------------------------------- Ejecución
+class LocalStateMachineRunner:
+
+    def __init__(self, template_path=TEMPLATE_PATH, processes=0, max_concurrency=None, env=None,
+                 glue_data_root=None, quiet=False, sleep=time.sleep):
+        template = load_template(template_path)
+        self.root = os.path.dirname(os.path.abspath(template_path))
+        self.resources = template['Resources']
+        self.machines = get_state_machines(template, self.root)
+        self.invoker = LambdaInvoker(get_functions(template, self.root), processes, env, quiet)
+        self.max_concurrency = max_concurrency
+        self.glue_data_root = glue_data_root
+        self.sleep = sleep
+        self.events = []
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.invoker.close()
+
+    def start_execution(self, name, state_input, start_at=None):
+        """
+        Ejecuta la máquina `name` y devuelve su salida. `start_at` permite
+        empezar en un estado intermedio (como al relanzar una ejecución).
+        """
+        return self.run_states(self.machines[name], state_input, path=name, start_at=start_at)
+
+    @staticmethod
+    def new_scope(name):
+        """
+        Contexto de una ejecución: `$states.context` y las variables de `Assign`.
+        """
+        execution_id = f'arn:aws:states:local:execution:{name}:{uuid.uuid4().hex}'
+        return {'context': {'Execution': {'Id': execution_id, 'Name': execution_id.rsplit(':', 1)[1]}},
+                'variables': {}}
+
+    def run_states(self, machine, state_input, path, start_at=None, scope=None):
+        scope = scope or self.new_scope(path)
+        state_name = start_at or machine['StartAt']
+        data = state_input
+        while True:
+            state = machine['States'][state_name]
+            start = time.perf_counter()
+            data, next_state = self.run_state(state_name, state, data, f'{path}/{state_name}', scope)
+            with self._lock:
+                self.events.append({'path': f'{path}/{state_name}', 'type': state['Type'],
+                                    'seconds': time.perf_counter() - start})
+            if next_state is None:
+                return data
+            state_name = next_state
+
+    @staticmethod
+    def assign(rule, context, scope):
+        # Todas las asignaciones de un estado ven los valores anteriores de las variables
+        if 'Assign' in rule:
+            scope['variables'].update(evaluate(rule['Assign'], context, scope['variables']))
+
+    def run_state(self, name, state, state_input, path, scope):
+        kind = state['Type']
+        variables = scope['variables']
+        context = {'input': state_input, 'context': scope['context']}
+        if kind == 'Succeed':
+            return state_input, None
+        if kind == 'Fail':
+            raise StatesError(evaluate(state.get('Error', 'States.Fail'), context, variables),
+                              evaluate(state.get('Cause', ''), context, variables))
+        if kind == 'Choice':
+            for rule in state.get('Choices', []):
+                if evaluate(rule['Condition'], context, variables):
+                    self.assign(rule, context, scope)
+                    return evaluate(rule.get('Output', state_input), context, variables), rule['Next']
+            if 'Default' not in state:
+                raise StatesError('States.NoChoiceMatched', f'Ninguna regla de {name} se cumple')
+            self.assign(state, context, scope)
+            return evaluate(state.get('Output', state_input), context, variables), state['Default']
+        try:
+            if kind in ('Pass', 'Wait'):
+                if kind == 'Wait':
+                    self.sleep(float(evaluate(state.get('Seconds', 0), context, variables)))
+                output = evaluate(state.get('Output', state_input), context, variables)
+                self.assign(state, context, scope)
+                return output, (None if state.get('End') else state['Next'])
+            if kind == 'Task':
+                result = self.with_retry(state, lambda: self.run_task(state, state_input, path, scope))
+            elif kind == 'Map':
+                result = self.with_retry(state, lambda: self.run_map(state, state_input, path, scope))
+            else:
+                raise NotImplementedError(f'Tipo de estado no soportado en local: {kind}')
+        except StatesError as e:
+            for catcher in state.get('Catch', []):
+                if self.matches(catcher['ErrorEquals'], e.error):
+                    output = {'Error': e.error, 'Cause': e.cause}
+                    context['errorOutput'] = output
+                    self.assign(catcher, context, scope)
+                    return evaluate(catcher.get('Output', output), context, variables), catcher['Next']
+            raise
+
+        context['result'] = result
+        output = evaluate(state['Output'], context, variables) if 'Output' in state else result
+        self.assign(state, context, scope)
+        return output, (None if state.get('End') else state['Next'])
+
+    @staticmethod
+    def matches(error_equals, error):
+        return error in error_equals or 'States.ALL' in error_equals or (
+            'States.TaskFailed' in error_equals and not error.startswith('States.'))
+
+    def with_retry(self, state, action):
+        attempts = {}
+        while True:
+            try:
+                return action()
+            except StatesError as e:
+                retrier = next((r for r in state.get('Retry', []) if self.matches(r['ErrorEquals'], e.error)), None)
+                if retrier is None:
+                    raise
+                index = state['Retry'].index(retrier)
+                attempts[index] = attempts.get(index, 0) + 1
+                if attempts[index] > retrier.get('MaxAttempts', 3):
+                    raise
+                delay = retrier.get('IntervalSeconds', 1) * retrier.get('BackoffRate', 2.0) ** (attempts[index] - 1)
+                delay = min(delay, retrier.get('MaxDelaySeconds', delay))
+                if retrier.get('JitterStrategy') == 'FULL':
+                    delay = random.uniform(0, delay)
+                print(f"Reintentando tras {e.error} ({attempts[index]}/{retrier.get('MaxAttempts', 3)}) "
+                      f"en {delay:.1f} s")
+                self.sleep(delay)
+
+    def run_task(self, state, state_input, path, scope):
+        arguments = evaluate(state.get('Arguments', {}), {'input': state_input, 'context': scope['context']},
+                             scope['variables'])
+        resource = state['Resource']
+        if resource.startswith('arn:aws:states:::lambda:invoke'):
+            logical_id = str(arguments['FunctionName']).replace('local:', '').split(':$')[0]
+            try:
+                payload = self.invoker.invoke(logical_id, arguments.get('Payload', state_input))
+            except Exception as e:
+                raise StatesError(type(e).__name__, str(e)) from e
+            return {'Payload': payload, 'StatusCode': 200}
+        if resource.startswith('arn:aws:states:::states:startExecution'):
+            name = str(arguments['StateMachineArn']).replace('local:', '')
+            machine = self.machines[self.resources.get(name, {}).get('Properties', {}).get('Name', name)]
+            output = self.run_states(machine, arguments.get('Input', state_input), path)
+            if resource.endswith(':2'):
+                return {'Output': output, 'Status': 'SUCCEEDED'}
+            return {'Output': json.dumps(output), 'Status': 'SUCCEEDED'}
+        if resource.startswith('arn:aws:states:::glue:startJobRun'):
+            job = str(arguments['JobName']).replace('local:', '')
+            if not self.glue_data_root:
+                print(f"Glue {job}: no se ejecuta en local (usa --glue-data-root para lanzarlo con Spark)")
+                return {'JobName': job, 'JobRunId': 'local-omitido'}
+            return self.run_glue_job(job)
+        raise NotImplementedError(f'Recurso no soportado en local: {resource}')
+
+    def run_glue_job(self, job):
+        """
+        Lanza el script del job con el Python local (Spark en modo local) y los
+        DefaultArguments del template, con `--data_root` sustituido.
+        """
+        import subprocess
+        properties = self.resources[job]['Properties']
+        script = os.path.join(self.root, 'glue_scripts', f"{properties['Name']}.py")
+        arguments = []
+        for key, value in (properties.get('DefaultArguments') or {}).items():
+            if key != '--data_root' and isinstance(value, str) and value:
+                arguments += [key, value]
+        subprocess.run([sys.executable, script, '--data_root', self.glue_data_root] + arguments, check=True,
+                       env=dict(os.environ, **self.invoker.env))
+        return {'JobName': properties['Name'], 'JobRunId': 'local', 'JobRunState': 'SUCCEEDED'}
+
+    def run_map(self, state, state_input, path, scope):
+        items = evaluate(state.get('Items', '{% $states.input %}'), {'input': state_input}, scope['variables'])
+        if not isinstance(items, list):
+            raise StatesError('States.QueryEvaluationError', 'Los Items del Map no son una lista')
+        processor = state.get('ItemProcessor') or state['Iterator']
+        concurrency = self.max_concurrency if self.max_concurrency is not None else state.get('MaxConcurrency', 0)
+        workers = len(items) if not concurrency else min(concurrency, len(items))
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            # Cada iteración ve las variables de fuera, pero sus asignaciones no salen del Map
+            futures = [executor.submit(self.run_states, processor, item, f'{path}[{i}]', None,
+                                       {'context': scope['context'], 'variables': dict(scope['variables'])})
+                       for i, item in enumerate(items)]
+            return [future.result() for future in futures]
+
+    def summary(self):
+        """
+        Segundos acumulados por estado (sin índices de iteración del Map).
+        """
+        totals = {}
+        for event in self.events:
+            key = re.sub(r'\[\d+\]', '[]', event['path'])
+            count, seconds = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, seconds + event['seconds'])
+        return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('state_machine', help='Name o id lógico de la máquina en template.yaml')
+    parser.add_argument('--input', default='{}', help='entrada JSON de la ejecución')
+    parser.add_argument('--start-at', help='estado por el que empezar')
+    parser.add_argument('--max-concurrency', type=int, help='sustituye el MaxConcurrency de todos los Map')
+    parser.add_argument('--processes', type=int, default=0, help='tamaño del pool de procesos (0: en proceso)')
+    parser.add_argument('--glue-data-root', help='lanza el job de Glue con Spark local sobre esta raíz')
+    args = parser.parse_args()
+
+    runner = LocalStateMachineRunner(processes=args.processes, max_concurrency=args.max_concurrency,
+                                     glue_data_root=args.glue_data_root)
+    try:
+        start = time.perf_counter()
+        output = runner.start_execution(args.state_machine, json.loads(args.input), args.start_at)
+        elapsed = time.perf_counter() - start
+    finally:
+        runner.close()
+    print(json.dumps(output, default=str)[:2000])
+    print(f"\n{'estado':<70} {'veces':>6} {'segundos':>9}")
+    for path, (count, seconds) in runner.summary().items():
+        print(f"{path:<70} {count:>6} {seconds:>9.2f}")
+    print(f"Total: {elapsed:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
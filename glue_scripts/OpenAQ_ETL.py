@@ -1,48 +1,542 @@
+import base64
+import hashlib
+import json
+import math
+import re
 import sys
-from awsglue.transforms import *
-from awsglue.utils import getResolvedOptions
-from pyspark.context import SparkContext
-from awsglue.context import GlueContext
-from awsglue.job import Job
-import gs_derived
+import time
+from datetime import datetime, timezone
 
-args = getResolvedOptions(sys.argv, ['JOB_NAME'])
-sc = SparkContext()
-glueContext = GlueContext(sc)
-spark = glueContext.spark_session
-job = Job(glueContext)
-job.init(args['JOB_NAME'], args)
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.window import Window
 
-# Script generated for node locations
-locations_node1756254701447 = glueContext.create_dynamic_frame.from_options(format_options={}, connection_type="s3", format="parquet", connection_options={"paths": ["s3://tfm-ucm/staging/OpenAQ/locations/locations.parquet"], "recurse": True}, transformation_ctx="locations_node1756254701447")
+# En Glue se usan GlueContext y Job (bookmarks, métricas); fuera de Glue el
+# mismo script corre sobre una SparkSession local para pruebas y benchmarks.
+try:
+    from awsglue.utils import getResolvedOptions
+    from awsglue.context import GlueContext
+    from awsglue.job import Job
+    from pyspark.context import SparkContext
+    EN_GLUE = True
+except ImportError:
+    EN_GLUE = False
 
-# Script generated for node parameters
-parameters_node1756255147815 = glueContext.create_dynamic_frame.from_options(format_options={}, connection_type="s3", format="parquet", connection_options={"paths": ["s3://tfm-ucm/staging/OpenAQ/parameters/parameters.parquet"], "recurse": True}, transformation_ctx="parameters_node1756255147815")
+PARTITION_KEYS = ["locality", "year", "month"]
+# Esquema declarado de las mediciones de staging. Debe coincidir con
+# tfm_common.schemas.OPENAQ_MEASUREMENTS, que es el que publican las Lambdas.
+MEASUREMENTS_SCHEMA = {
+    "name": "openaq_measurements",
+    "version": 1,
+    "fields": [
+        {"name": "value", "type": "double"},
+        {"name": "sensor_id", "type": "string"},
+        {"name": "datetimeFrom", "type": "timestamp"},
+        {"name": "datetimeTo", "type": "timestamp"},
+    ] + [{"name": name, "type": "double"}
+         for name in ("min", "q02", "q25", "median", "q75", "q98", "max", "avg", "sd")],
+}
+# Clave natural de una medición (diaria u horaria)
+MEASUREMENT_KEYS = ["sensor_id", "datetimeFrom"]
+# Orden de llegada de cada fila (manifiesto o fichero): gana la más reciente
+ORDINAL = "_ordinal"
+# Esquema y autoridad de una URI (s3://, s3a://, file:/...): input_file_name()
+# y los manifiestos no escriben igual la misma ruta
+URI_SCHEME = r"^[A-Za-z][A-Za-z0-9+.-]*:/*"
+DEFAULT_ARGS = {
+    "data_root": "s3://tfm-ucm",
+    # incremental: solo los manifiestos pendientes y las particiones afectadas;
+    # full: todo el histórico de staging
+    "mode": "incremental",
+    # Tamaño objetivo de los ficheros del lake y estimación de bytes por fila en parquet
+    "target_file_mb": "128",
+    "bytes_per_row": "64",
+    # daily o hourly: las horarias se leen de staging/OpenAQ_hourly y van a
+    # processed/openaq/measurements_hourly, con su propio índice y manifiestos
+    "granularity": "daily",
+    # Índice de ficheros del lake (processed/openaq/_index/measurements.json)
+    "index": "true",
+    # Probabilidad de falso positivo del filtro de Bloom de sensor_id por
+    # fichero en el índice; 0 lo desactiva
+    "index_bloom_fpp": "0",
+}
+# Columnas con mínimo y máximo por fichero en el índice
+INDEX_STATS = ["sensor_id", "parameter_id", "datetimeTo"]
+INDEX_VERSION = 1
 
-# Script generated for node measurements
-measurements_node1756172542186 = glueContext.create_dynamic_frame.from_options(format_options={}, connection_type="s3", format="parquet", connection_options={"paths": ["s3://tfm-ucm/staging/OpenAQ/measurements/"], "recurse": True}, transformation_ctx="measurements_node1756172542186")
 
-# Script generated for node Change Schema Locations
-ChangeSchemaLocations_node1756255337579 = ApplyMapping.apply(frame=locations_node1756254701447, mappings=[("id", "long", "id", "long"), ("name", "string", "locations_name", "string"), ("locality", "string", "locality", "string"), ("timezone", "string", "timezone", "string"), ("country", "string", "country", "string"), ("ismonitor", "boolean", "ismonitor", "boolean"), ("latitud", "double", "latitud", "double"), ("longitud", "double", "longitud", "double"), ("sensor_id", "long", "sensor_id", "long"), ("parameter_id", "long", "parameter_id", "long")], transformation_ctx="ChangeSchemaLocations_node1756255337579")
+def get_optional_args(argv, defaults):
+    """
+    Lee argumentos opcionales `--clave valor` (getResolvedOptions solo admite obligatorios).
+    """
+    args = dict(defaults)
+    for i, arg in enumerate(argv[:-1]):
+        if arg.startswith("--") and arg[2:] in defaults:
+            args[arg[2:]] = argv[i + 1]
+    return args
 
-# Script generated for node Change Schema Parameters
-ChangeSchemaParameters_node1756255241507 = ApplyMapping.apply(frame=parameters_node1756255147815, mappings=[("id", "long", "id", "long"), ("name", "string", "parameter_name", "string"), ("units", "string", "parameter_units", "string"), ("displayname", "string", "parameter_displayname", "string"), ("description", "string", "parameter_description", "string")], transformation_ctx="ChangeSchemaParameters_node1756255241507")
 
-# Script generated for node Derived Column year
-DerivedColumnyear_node1756428719394 = measurements_node1756172542186.gs_derived(colName="year", expr="year(datetimeto)")
+def get_fs(spark, path):
+    """
+    FileSystem de Hadoop para la ruta: sirve igual para s3:// en Glue que en local.
+    """
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
 
-# Script generated for node Join Loca-Param
-JoinLocaParam_node1756255502469 = Join.apply(frame1=ChangeSchemaLocations_node1756255337579, frame2=ChangeSchemaParameters_node1756255241507, keys1=["parameter_id"], keys2=["id"], transformation_ctx="JoinLocaParam_node1756255502469")
 
-# Script generated for node Derived Column month
-DerivedColumnmonth_node1756428788482 = DerivedColumnyear_node1756428719394.gs_derived(colName="month", expr="month(datetimeto)")
+def list_parquet_files(spark, path):
+    """
+    Devuelve {ruta: fecha de modificación en ms} de los parquet bajo `path` (recursivo).
+    """
+    fs, hadoop_path = get_fs(spark, path)
+    if not fs.exists(hadoop_path):
+        return {}
+    files = {}
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        file_path = status.getPath().toString()
+        if file_path.endswith(".parquet"):
+            files[file_path] = status.getModificationTime()
+    return files
 
-# Script generated for node Final Join
-FinalJoin_node1756257361750 = Join.apply(frame1=DerivedColumnmonth_node1756428788482, frame2=JoinLocaParam_node1756255502469, keys1=["sensor_id"], keys2=["sensor_id"], transformation_ctx="FinalJoin_node1756257361750")
 
-# Script generated for node Datalake
-if (FinalJoin_node1756257361750.count() >= 1):
-   FinalJoin_node1756257361750 = FinalJoin_node1756257361750.coalesce(1)
-Datalake_node1756257717126 = glueContext.write_dynamic_frame.from_options(frame=FinalJoin_node1756257361750, connection_type="s3", format="glueparquet", connection_options={"path": "s3://tfm-ucm/processed/openaq/measurements/", "partitionKeys": ["locality", "year", "month"]}, format_options={"compression": "snappy"}, transformation_ctx="Datalake_node1756257717126")
+def path_exists(spark, path):
+    fs, hadoop_path = get_fs(spark, path)
+    return fs.exists(hadoop_path)
 
-job.commit()
\ No newline at end of file
+
+def read_text(spark, path):
+    fs, hadoop_path = get_fs(spark, path)
+    if not fs.exists(hadoop_path):
+        return None
+    stream = fs.open(hadoop_path)
+    try:
+        reader = spark.sparkContext._jvm.java.io.BufferedReader(
+            spark.sparkContext._jvm.java.io.InputStreamReader(stream, "UTF-8"))
+        lines = []
+        line = reader.readLine()
+        while line is not None:
+            lines.append(line)
+            line = reader.readLine()
+        return "\n".join(lines)
+    finally:
+        stream.close()
+
+
+def write_text(spark, path, text):
+    fs, hadoop_path = get_fs(spark, path)
+    stream = fs.create(hadoop_path, True)
+    try:
+        stream.write(bytearray(text.encode("utf-8")))
+    finally:
+        stream.close()
+
+
+def read_manifests(spark, manifests_path):
+    """
+    Devuelve [(ruta, manifiesto)] de los manifiestos pendientes (sin subcarpetas),
+    del más antiguo al más reciente.
+    """
+    fs, hadoop_path = get_fs(spark, manifests_path)
+    if not fs.exists(hadoop_path):
+        return []
+    manifests = []
+    for status in fs.listStatus(hadoop_path):
+        path = status.getPath().toString()
+        if status.isFile() and path.endswith(".json"):
+            manifests.append((path, json.loads(read_text(spark, path))))
+    return sorted(manifests, key=lambda item: (item[1].get("created_at", ""), item[0]))
+
+
+def check_manifests(spark, manifests, schema):
+    """
+    Comprueba antes de leer ningún dato que cada manifiesto declara el esquema
+    esperado (nombres y tipos; las pistas de codificación no cuentan) y que
+    cada entrada indica su fichero. Solo se usa lo que publica el manifiesto:
+    los ficheros se leen después con el esquema declarado, y uno que falte o
+    no lo cumpla hace fallar esa lectura. Si algo no cuadra se imprime el
+    informe completo y el job falla.
+    """
+    problems = []
+    for path, manifest in manifests:
+        declared = manifest.get("schema") or {}
+        if (declared.get("name"), declared.get("version")) != (schema["name"], schema["version"]):
+            problems.append(f"{path}: esquema {declared.get('name')} v{declared.get('version')}, "
+                            f"se esperaba {schema['name']} v{schema['version']}")
+        elif ([(field["name"], field["type"]) for field in declared.get("fields", [])]
+              != [(field["name"], field["type"]) for field in schema["fields"]]):
+            problems.append(f"{path}: los campos declarados no coinciden con {schema['name']} v{schema['version']}")
+        for entry in manifest.get("files", []):
+            if not entry.get("uri"):
+                problems.append(f"{path}: entrada sin uri")
+    if problems:
+        print("Manifiestos de staging que no cumplen el esquema:")
+        for problem in problems:
+            print(f"  - {problem}")
+        raise ValueError(f"{len(problems)} problemas en {len(manifests)} manifiestos de staging")
+
+
+def archive_manifests(spark, manifests, archive_path):
+    """
+    Mueve los manifiestos procesados fuera de la carpeta de pendientes.
+    """
+    for path, _ in manifests:
+        fs, hadoop_path = get_fs(spark, path)
+        target = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(f"{archive_path}/{hadoop_path.getName()}")
+        fs.mkdirs(target.getParent())
+        fs.delete(target, False)
+        fs.rename(hadoop_path, target)
+
+
+def schema_ddl(schema):
+    return ", ".join(f"`{field['name']}` {field['type']}" for field in schema["fields"])
+
+
+def path_key(uri):
+    """
+    Ruta sin esquema (s3://bucket/x y s3a://bucket/x son la misma clave).
+    """
+    return re.sub(URI_SCHEME, "", uri)
+
+
+def tag_ordinals(spark, measurements, ordinals):
+    """
+    Añade a cada fila la columna ORDINAL con el orden de llegada del fichero
+    del que se leyó (`ordinals`: {uri: ordinal}). Se calcula sobre la lectura,
+    antes de cualquier join, que es donde input_file_name() tiene valor.
+    """
+    files = spark.createDataFrame([(path_key(uri), int(ordinal)) for uri, ordinal in ordinals.items()],
+                                  f"_file string, {ORDINAL} long")
+    measurements = measurements.withColumn("_file", F.regexp_replace(F.input_file_name(), URI_SCHEME, ""))
+    return measurements.join(F.broadcast(files), on="_file", how="left").drop("_file")
+
+
+def latest_per_key(df):
+    """
+    Una fila por MEASUREMENT_KEYS: la de mayor ORDINAL, es decir, la del
+    manifiesto (o fichero) más reciente. Quita la columna ORDINAL.
+    """
+    window = Window.partitionBy(*MEASUREMENT_KEYS).orderBy(F.col(ORDINAL).desc_nulls_last())
+    return (df.withColumn("_rank", F.row_number().over(window))
+              .where(F.col("_rank") == 1)
+              .drop("_rank", ORDINAL))
+
+
+def read_sources(spark, data_root, measurement_files=None, dataset="OpenAQ"):
+    """
+    Lee las dimensiones y las mediciones con el esquema declarado (sin
+    inferirlo); si se indican `measurement_files` ({uri: ordinal}) solo se leen
+    esos ficheros en lugar de listar todo el prefijo y cada fila lleva el
+    ordinal de su fichero en la columna ORDINAL. Las dimensiones son las
+    mismas para cualquier `dataset` y están siempre en staging/OpenAQ.
+    """
+    locations = spark.read.parquet(f"{data_root}/staging/OpenAQ/locations/locations.parquet")
+    parameters = spark.read.parquet(f"{data_root}/staging/OpenAQ/parameters/parameters.parquet")
+    staging = f"{data_root}/staging/{dataset}"
+    reader = spark.read.schema(schema_ddl(MEASUREMENTS_SCHEMA))
+    if measurement_files is None:
+        measurements = reader.option("recursiveFileLookup", "true").parquet(f"{staging}/measurements/")
+    else:
+        measurements = tag_ordinals(spark, reader.parquet(*measurement_files), measurement_files)
+    return measurements, locations, parameters
+
+
+def build_dimension(locations, parameters):
+    """
+    Dimensión sensor: ubicación + parámetro medido. Ambas tablas son pequeñas,
+    así que el resultado se difunde (broadcast) a todos los ejecutores.
+    """
+    locations = locations.select(
+        F.col("id").cast("long").alias("id"),
+        F.col("name").cast("string").alias("locations_name"),
+        F.col("locality").cast("string").alias("locality"),
+        F.col("timezone").cast("string").alias("timezone"),
+        F.col("country").cast("string").alias("country"),
+        F.col("isMonitor").cast("boolean").alias("ismonitor"),
+        F.col("latitud").cast("double").alias("latitud"),
+        F.col("longitud").cast("double").alias("longitud"),
+        F.col("sensor_id").cast("long").alias("sensor_id"),
+        F.col("parameter_id").cast("long").alias("parameter_id"),
+    )
+    parameters = parameters.select(
+        F.col("id").cast("long").alias("parameter_id"),
+        F.col("name").cast("string").alias("parameter_name"),
+        F.col("units").cast("string").alias("parameter_units"),
+        F.col("displayName").cast("string").alias("parameter_displayname"),
+        F.col("description").cast("string").alias("parameter_description"),
+    )
+    return locations.join(F.broadcast(parameters), on="parameter_id", how="inner")
+
+
+def transform(measurements, locations, parameters):
+    """
+    Une las mediciones con la dimensión sensor mediante broadcast join y
+    calcula las columnas de partición en una única proyección.
+    """
+    dimension = build_dimension(locations, parameters)
+    measurements = measurements.select(
+        *[F.col(c) for c in measurements.columns if c.lower() != "sensor_id"],
+        F.col("sensor_id").cast("long").alias("sensor_id"),
+        F.year("datetimeTo").alias("year"),
+        F.month("datetimeTo").alias("month"),
+    )
+    return measurements.join(F.broadcast(dimension), on="sensor_id", how="inner")
+
+
+def partition_filter(partitions):
+    """
+    Predicado (locality, year, month) IN (...) expresado con columnas de
+    partición para que Spark solo liste y lea esas carpetas del lake.
+    """
+    condition = None
+    for row in partitions:
+        clause = None
+        for key in PARTITION_KEYS:
+            column = F.col(key).isNull() if row[key] is None else F.col(key) == F.lit(row[key])
+            clause = column if clause is None else clause & column
+        condition = clause if condition is None else condition | clause
+    return condition
+
+
+def affected_partitions(df):
+    """
+    Valores (locality, year, month) distintos de `df` como lista de diccionarios.
+    """
+    return [row.asDict() for row in df.select(*PARTITION_KEYS).distinct().collect()]
+
+
+def merge_with_lake(spark, new_data, output_path, partitions):
+    """
+    Combina las mediciones nuevas con lo que ya hay en las particiones afectadas
+    del lake: entre las nuevas gana la de mayor ORDINAL y cualquiera de ellas
+    sustituye a la existente con la misma clave.
+    """
+    new_data = latest_per_key(new_data)
+    print(f"Particiones afectadas: {len(partitions)}")
+    if not partitions or not path_exists(spark, output_path):
+        return new_data
+
+    existing = spark.read.parquet(output_path).where(partition_filter(partitions))
+    existing = existing.join(new_data.select(*MEASUREMENT_KEYS), on=MEASUREMENT_KEYS, how="left_anti")
+    merged = existing.unionByName(new_data, allowMissingColumns=True)
+    # Se materializa antes de sobrescribir las mismas carpetas que se están leyendo
+    return merged.localCheckpoint(eager=True)
+
+
+def write_lake(spark, df, output_path, target_file_mb, bytes_per_row, mode="append", overwrite="dynamic"):
+    """
+    Reparte por las claves de partición (una tarea por partición de salida en
+    lugar de un único coalesce(1)) y limita las filas por fichero al tamaño objetivo.
+    Con mode="overwrite" y overwrite="dynamic" solo se reemplazan las particiones
+    presentes en `df`; con overwrite="static" se reescribe el lake completo.
+    """
+    max_records = max(int(target_file_mb) * 1024 * 1024 // int(bytes_per_row), 1)
+    # DataFrame.sparkSession no existe hasta PySpark 3.3 (Glue 3.0 usa Spark 3.1)
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", overwrite)
+    (df.repartition(*PARTITION_KEYS)
+       .write
+       .mode(mode)
+       .partitionBy(*PARTITION_KEYS)
+       .option("maxRecordsPerFile", max_records)
+       .option("compression", "snappy")
+       .parquet(output_path))
+
+
+def bloom_filter(values, fpp):
+    """
+    Filtro de Bloom de `values` (como texto) para una probabilidad de falso
+    positivo `fpp`. Las posiciones se obtienen por doble hash (h1 + i·h2) de
+    los dos primeros bloques de 8 bytes del MD5 del valor.
+    """
+    values = [str(value) for value in values]
+    bits = max(int(-len(values) * math.log(fpp) / (math.log(2) ** 2)), 8)
+    bits += -bits % 8
+    hashes = max(round(bits / max(len(values), 1) * math.log(2)), 1)
+    data = bytearray(bits // 8)
+    for value in values:
+        for position in _bloom_positions(value, bits, hashes):
+            data[position // 8] |= 1 << (position % 8)
+    return {"bits": bits, "hashes": hashes, "data": base64.b64encode(bytes(data)).decode("ascii")}
+
+
+def _bloom_positions(value, bits, hashes):
+    digest = hashlib.md5(str(value).encode("utf-8")).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little")
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def bloom_might_contain(bloom, value):
+    """
+    False si `value` seguro que no está en el filtro; True si puede estar.
+    """
+    data = base64.b64decode(bloom["data"])
+    return all(data[position // 8] & (1 << (position % 8))
+               for position in _bloom_positions(value, bloom["bits"], bloom["hashes"]))
+
+
+def _index_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def file_statistics(spark, output_path, partitions=None, bloom_fpp=0.0):
+    """
+    Una entrada de índice por fichero del lake (solo de `partitions` si se
+    indican): valores de partición, filas y mínimo/máximo de INDEX_STATS, y
+    opcionalmente el filtro de Bloom de sensor_id. Solo se leen esas columnas.
+    """
+    if partitions is not None and not partitions:
+        return []
+    lake = spark.read.parquet(output_path)
+    if partitions is not None:
+        lake = lake.where(partition_filter(partitions))
+    aggregations = [F.count(F.lit(1)).alias("rows")]
+    for name in INDEX_STATS:
+        aggregations += [F.min(name).alias(f"min_{name}"), F.max(name).alias(f"max_{name}")]
+    if bloom_fpp:
+        aggregations.append(F.collect_set("sensor_id").alias("sensor_ids"))
+    files = []
+    for row in lake.groupBy(F.input_file_name().alias("uri"), *PARTITION_KEYS).agg(*aggregations).collect():
+        entry = {
+            "uri": row["uri"],
+            "partition": {key: row[key] for key in PARTITION_KEYS},
+            "rows": row["rows"],
+            "min": {name: _index_value(row[f"min_{name}"]) for name in INDEX_STATS},
+            "max": {name: _index_value(row[f"max_{name}"]) for name in INDEX_STATS},
+        }
+        if bloom_fpp:
+            entry["bloom"] = bloom_filter(row["sensor_ids"], bloom_fpp)
+        files.append(entry)
+    return files
+
+
+def update_index(spark, index_path, output_path, partitions, bloom_fpp):
+    """
+    Actualiza el índice de ficheros del lake. Las particiones reescritas
+    (`partitions`; None = todo el lake) sustituyen sus entradas y el resto se
+    conserva sin listar S3. Si el índice aún no existe se construye con el
+    lake completo.
+
+    Formato (JSON): {"version", "updated_at", "root", "partition_keys",
+    "stats", "bloom": {"column", "fpp"} | null, "files": [{"uri", "partition",
+    "rows", "min": {columna: valor}, "max": {...}, "bloom"?: {"bits",
+    "hashes", "data"}}]}. Las fechas van en ISO 8601 sin zona, como en el lake.
+    `select_files` filtra las entradas.
+    """
+    text = read_text(spark, index_path)
+    index = json.loads(text) if text else None
+    if index is None or index.get("version") != INDEX_VERSION or index.get("root") != output_path:
+        partitions = None
+    kept = []
+    if partitions is not None:
+        rewritten = {tuple(partition[key] for key in PARTITION_KEYS) for partition in partitions}
+        kept = [entry for entry in index["files"]
+                if tuple(entry["partition"][key] for key in PARTITION_KEYS) not in rewritten]
+    if partitions is None and not path_exists(spark, output_path):
+        files = []
+    else:
+        files = file_statistics(spark, output_path, partitions, bloom_fpp)
+    index = {
+        "version": INDEX_VERSION,
+        "updated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "root": output_path,
+        "partition_keys": PARTITION_KEYS,
+        "stats": INDEX_STATS,
+        "bloom": {"column": "sensor_id", "fpp": bloom_fpp} if bloom_fpp else None,
+        "files": sorted(kept + files, key=lambda entry: entry["uri"]),
+    }
+    write_text(spark, index_path, json.dumps(index, separators=(",", ":")))
+    print(f"Índice actualizado: {len(files)} ficheros reindexados, {len(kept)} conservados "
+          f"({'lake completo' if partitions is None else f'{len(partitions)} particiones'})")
+    return index
+
+
+def select_files(index, sensor_id=None, start=None, end=None, **partition):
+    """
+    URIs de los ficheros del índice que pueden contener filas del sensor, con
+    datetimeTo en [start, end] (texto ISO 8601) y con los valores de partición
+    indicados (p. ej. locality="Madrid", year=2024).
+    """
+    uris = []
+    for entry in index["files"]:
+        if any(entry["partition"].get(key) != value for key, value in partition.items()):
+            continue
+        if sensor_id is not None:
+            if not entry["min"]["sensor_id"] <= int(sensor_id) <= entry["max"]["sensor_id"]:
+                continue
+            if "bloom" in entry and not bloom_might_contain(entry["bloom"], int(sensor_id)):
+                continue
+        if start is not None and entry["max"]["datetimeTo"] < start:
+            continue
+        if end is not None and entry["min"]["datetimeTo"] > end:
+            continue
+        uris.append(entry["uri"])
+    return uris
+
+
+def main():
+    args = get_optional_args(sys.argv, DEFAULT_ARGS)
+    if EN_GLUE:
+        args.update(getResolvedOptions(sys.argv, ["JOB_NAME"]))
+        sc = SparkContext()
+        glueContext = GlueContext(sc)
+        spark = glueContext.spark_session
+        job = Job(glueContext)
+        job.init(args["JOB_NAME"], args)
+    else:
+        spark = SparkSession.builder.appName("OpenAQ_ETL").getOrCreate()
+        job = None
+
+    data_root = args["data_root"].rstrip("/")
+    granularity = args["granularity"]
+    if granularity not in ("daily", "hourly"):
+        raise ValueError(f"granularity debe ser daily o hourly: {granularity}")
+    # Mismos nombres que las Lambdas para staging; el lake horario lleva sufijo
+    dataset = "OpenAQ" if granularity == "daily" else f"OpenAQ_{granularity}"
+    suffix = "" if granularity == "daily" else f"_{granularity}"
+    output_path = f"{data_root}/processed/openaq/measurements{suffix}/"
+    index_path = f"{data_root}/processed/openaq/_index/measurements{suffix}.json"
+    bloom_fpp = float(args["index_bloom_fpp"])
+    start = time.perf_counter()
+
+    manifests = read_manifests(spark, f"{data_root}/staging/{dataset}/_manifests")
+    check_manifests(spark, manifests, MEASUREMENTS_SCHEMA)
+    if args["mode"] == "full":
+        # Sin manifiestos para todo el histórico: el orden lo da la fecha de modificación
+        pending_files = list_parquet_files(spark, f"{data_root}/staging/{dataset}/measurements/")
+    else:
+        # Manifiestos del más antiguo al más reciente: si un fichero aparece en
+        # varios, cuenta el último
+        pending_files = {entry["uri"]: ordinal for ordinal, (_, manifest) in enumerate(manifests)
+                         for entry in manifest.get("files", [])}
+    print(f"Modo {args['mode']}: {len(manifests)} manifiestos pendientes, {len(pending_files)} ficheros por procesar")
+
+    # Particiones reescritas en esta ejecución (None: todo el lake)
+    partitions = []
+    if pending_files:
+        measurements, locations, parameters = read_sources(spark, data_root, pending_files, dataset)
+        result = transform(measurements, locations, parameters)
+        if args["mode"] == "full":
+            # Reconstrucción completa del lake
+            write_lake(spark, latest_per_key(result), output_path, args["target_file_mb"],
+                       args["bytes_per_row"], mode="overwrite", overwrite="static")
+            partitions = None
+        else:
+            partitions = affected_partitions(result)
+            write_lake(spark, merge_with_lake(spark, result, output_path, partitions), output_path,
+                       args["target_file_mb"], args["bytes_per_row"], mode="overwrite")
+    if args["index"].lower() in ("true", "1") and (partitions is None or partitions
+                                                    or not path_exists(spark, index_path)):
+        update_index(spark, index_path, output_path, partitions, bloom_fpp)
+    # Los manifiestos solo salen de pendientes cuando el lake y su índice ya están escritos
+    archive_manifests(spark, manifests, f"{data_root}/state/OpenAQ_ETL{suffix}/manifests")
+    print(f"OpenAQ_ETL completado en {time.perf_counter() - start:.1f} s")
+
+    if job is not None:
+        job.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import hashlib
+import io
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tfm_common.manifests import list_manifests, publish_manifest
+from tfm_common.parquet import deduplicate
+from tfm_common.schemas import OPENAQ_MEASUREMENTS, conform_table
+from tfm_common.storage import delete_uri, join_uri, list_uris, read_bytes, write_bytes
+from tfm_common.profiling import phase
+from tfm_common.telemetry import instrument_handler
+
+# Tamaño objetivo de cada fichero compactado y de sus row groups
+TARGET_FILE_BYTES = int(os.getenv('target_file_bytes', 128 * 1024 * 1024))
+ROW_GROUP_ROWS = int(os.getenv('row_group_rows', 128 * 1024))
+# Los ficheros por debajo de este tamaño se consideran pequeños y se compactan
+SMALL_FILE_BYTES = int(os.getenv('small_file_bytes', TARGET_FILE_BYTES // 2))
+# Volumen máximo de entrada por ejecución; lo que no quepa se compacta en la siguiente
+MAX_INPUT_BYTES = int(os.getenv('max_input_bytes', 512 * 1024 * 1024))
+
+# Misma granularidad que get_open_aq_data: las horarias se compactan en su
+# propio dataset (staging/OpenAQ_hourly)
+GRANULARITY = os.getenv('measurements_granularity', 'daily')
+OPENAQ_DATASET = 'OpenAQ' if GRANULARITY == 'daily' else f'OpenAQ_{GRANULARITY}'
+
+SORT_KEYS = [('sensor_id', 'ascending'), ('datetimeFrom', 'ascending')]
+OPENAQ_KEY_TYPES = {'sensor_id': pa.string(), 'datetimeFrom': pa.timestamp('us')}
+COMPACTED_DIR = 'compactado'
+
+
+def summarize(files):
+    return len(files), sum(entry.get('bytes') or 0 for entry in files)
+
+
+def finish_pending_commits(log_prefix):
+    """
+    Completa las compactaciones cuyo fichero de log sigue presente: los ficheros
+    compactados y su manifiesto ya están escritos, así que solo falta borrar los
+    originales y los manifiestos consumidos.
+    """
+    for log_uri, _ in list_uris(log_prefix):
+        log = json.loads(read_bytes(log_uri) or b'{}')
+        print(f"Completando compactación pendiente {log_uri} ({len(log.get('sources', []))} ficheros)")
+        for uri in log.get('sources', []) + log.get('manifests', []):
+            delete_uri(uri)
+        delete_uri(log_uri)
+
+
+def read_table(uri):
+    # Todos los ficheros del manifiesto se homogeneizan al esquema declarado
+    return conform_table(pq.read_table(io.BytesIO(read_bytes(uri))), OPENAQ_MEASUREMENTS)
+
+
+def write_compacted(table, output_prefix, run_id, bytes_per_row):
+    """
+    Ordena y escribe la tabla en ficheros de ~TARGET_FILE_BYTES con row groups
+    de ROW_GROUP_ROWS filas y devuelve sus entradas de manifiesto. Los nombres
+    dependen de los ficheros de entrada, por lo que repetir la misma
+    compactación sobrescribe los mismos objetos.
+    """
+    # sort_by no admite columnas de diccionario: se ordena por las claves decodificadas
+    keys = pa.table({name: table[name].cast(OPENAQ_KEY_TYPES[name]) for name, _ in SORT_KEYS})
+    table = table.take(pc.sort_indices(keys, sort_keys=SORT_KEYS))
+    rows_per_file = max(int(TARGET_FILE_BYTES / max(bytes_per_row, 1)), ROW_GROUP_ROWS)
+    outputs = []
+    for n, offset in enumerate(range(0, table.num_rows, rows_per_file)):
+        buffer = io.BytesIO()
+        pq.write_table(table.slice(offset, rows_per_file), buffer, row_group_size=ROW_GROUP_ROWS,
+                       compression='snappy')
+        uri = f'{output_prefix}/part-{run_id}-{n:05d}.parquet'
+        write_bytes(uri, buffer.getvalue())
+        outputs.append({'uri': uri, 'rows': min(rows_per_file, table.num_rows - offset),
+                        'bytes': buffer.getbuffer().nbytes})
+    return outputs
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    """
+    Fusiona los ficheros pequeños publicados en los manifiestos pendientes de
+    staging/OpenAQ (o staging/OpenAQ_hourly) en pocos ficheros grandes ordenados por sensor_id y fecha
+    antes del job de Glue, y publica un manifiesto con el resultado.
+
+    Es idempotente: el log de la compactación se escribe antes de borrar los
+    originales y una ejecución posterior termina cualquier borrado pendiente.
+    """
+    bucket_name = os.getenv('bucket_name')
+    staging_prefix = join_uri(bucket_name, 'staging', OPENAQ_DATASET)
+    measurements_prefix = join_uri(bucket_name, 'staging', OPENAQ_DATASET, 'measurements')
+    log_prefix = join_uri(bucket_name, 'state', OPENAQ_DATASET, 'compaction')
+
+    finish_pending_commits(log_prefix + '/')
+
+    # Solo se leen los manifiestos: no se lista el prefijo de datos
+    manifests = list_manifests(staging_prefix)
+    files = [entry for _, manifest in manifests for entry in manifest.get('files', [])]
+    files_before, bytes_before = summarize(files)
+
+    # Se consumen manifiestos completos, del más antiguo al más reciente, para que
+    # ante filas repetidas se conserve la versión de la ingesta más reciente.
+    # Solo se compacta un prefijo contiguo: si se saltara un manifiesto, el
+    # resultado (con la fecha del más reciente) quedaría por delante de él y
+    # sus filas, más antiguas, ganarían a las nuevas en el job de Glue
+    selected, selected_manifests, selected_bytes, created_at = [], [], 0, ''
+    for uri, manifest in manifests:
+        entries = manifest.get('files', [])
+        manifest_bytes = sum(entry.get('bytes') or 0 for entry in entries)
+        if not entries:
+            # Sin ficheros no hay filas que puedan quedar desordenadas
+            continue
+        if any((entry.get('bytes') or 0) >= SMALL_FILE_BYTES for entry in entries):
+            break
+        if selected and selected_bytes + manifest_bytes > MAX_INPUT_BYTES:
+            break
+        selected.extend(entry['uri'] for entry in entries)
+        selected_manifests.append(uri)
+        selected_bytes += manifest_bytes
+        created_at = max(created_at, manifest.get('created_at', ''))
+
+    print(f"Manifiestos pendientes: {len(manifests)} ({files_before} ficheros, {bytes_before} bytes). "
+          f"Ficheros seleccionados en esta ejecución: {len(selected)}")
+
+    if len(selected) < 2:
+        print("No hay ficheros suficientes para compactar.")
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Nada que compactar'),
+            'files_before': files_before,
+            'bytes_before': bytes_before,
+            'files_after': files_before,
+            'bytes_after': bytes_before
+        }
+
+    phase('fetch')
+    tables = [read_table(uri) for uri in selected]
+    phase('transform')
+    # Cada fichero trae su propio diccionario de sensor_id; group_by necesita uno común
+    table = deduplicate(pa.concat_tables(tables).unify_dictionaries(), OPENAQ_MEASUREMENTS['key'])
+    del tables
+    run_id = hashlib.sha1('\n'.join(selected).encode('utf-8')).hexdigest()[:12]
+    phase('write')
+    outputs = write_compacted(table, f'{measurements_prefix}/{COMPACTED_DIR}', run_id,
+                              bytes_per_row=selected_bytes / max(table.num_rows, 1))
+    sources = [uri for uri in selected if uri not in [output['uri'] for output in outputs]]
+
+    # Primero se publica el manifiesto del resultado y se registra la compactación;
+    # después se borran los originales y los manifiestos consumidos
+    # Hereda la fecha del manifiesto más reciente consumido para mantener el orden
+    output_manifest = publish_manifest(staging_prefix, f'{COMPACTED_DIR}-{run_id}', OPENAQ_MEASUREMENTS,
+                                       outputs, created_at=created_at or None)
+    consumed = [uri for uri in selected_manifests if uri != output_manifest]
+    log_uri = f'{log_prefix}/{run_id}.json'
+    write_bytes(log_uri, json.dumps({'sources': sources, 'manifests': consumed,
+                                     'outputs': [output['uri'] for output in outputs]}).encode('utf-8'))
+    for uri in sources + consumed:
+        delete_uri(uri)
+    delete_uri(log_uri)
+
+    files_after, bytes_after = summarize(
+        [entry for _, manifest in list_manifests(staging_prefix) for entry in manifest.get('files', [])])
+    print(f"Compactados {len(sources)} ficheros en {len(outputs)} ({table.num_rows} filas). "
+          f"Antes: {files_before} ficheros / {bytes_before} bytes. "
+          f"Después: {files_after} ficheros / {bytes_after} bytes.")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Compactados {len(sources)} ficheros en {len(outputs)}'),
+        'files_before': files_before,
+        'bytes_before': bytes_before,
+        'files_after': files_after,
+        'bytes_after': bytes_after
+    }
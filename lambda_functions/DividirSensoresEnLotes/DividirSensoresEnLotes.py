@@ -1,25 +1,167 @@
 import json
+import heapq
+import math
+import os
+from datetime import datetime, timezone
 
+import pandas as pd
+from tfm_common.parquet import read_parquet
+from tfm_common.storage import join_uri
+from tfm_common.profiling import phase
+from tfm_common.telemetry import instrument_handler
+from tfm_common.watermarks import WatermarkStore
+
+# Coste estimado (en segundos) de cada petición de página y de cada día descargado
+COSTE_PAGINA = float(os.getenv('coste_pagina', 1.0))
+COSTE_DIA = float(os.getenv('coste_dia', 0.001))
+# Límite de Step Functions: 256 KiB por entrada/salida de estado. Se deja margen.
+MAX_PAYLOAD_BYTES = int(os.getenv('max_payload_bytes', 200000))
+STEP_FUNCTIONS_LIMIT_BYTES = 262144
+# Misma granularidad que get_open_aq_data: fija los periodos por día y el
+# dataset del que se leen las marcas de agua
+GRANULARITY = os.getenv('measurements_granularity', 'daily')
+PERIODOS_POR_DIA = {'daily': 1, 'hourly': 24}[GRANULARITY]
+OPENAQ_DATASET = 'OpenAQ' if GRANULARITY == 'daily' else f'OpenAQ_{GRANULARITY}'
+
+
+def get_sensor_ids(event):
+    """
+    Acepta la lista de IDs de get_openaq_sensors o un diccionario {"sensors": [...]}.
+    """
+    if isinstance(event, dict):
+        event = event.get('sensors', [])
+    return [str(sensor_id) for sensor_id in event]
+
+
+def read_sensor_history(bucket_name):
+    """
+    Lee de locations.parquet el primer y último dato conocido de cada sensor.
+    """
+    path = join_uri(bucket_name, 'staging/OpenAQ/locations/locations.parquet')
+    try:
+        locations = read_parquet(path, columns=['sensor_id', 'datetimeFirst', 'datetimeLast'])
+        if locations is None:
+            raise FileNotFoundError(path)
+        locations = locations.to_pandas()
+    except Exception as e:
+        print(f"No se pudo leer {path} ({e}). Se asigna el mismo coste a todos los sensores.")
+        return pd.DataFrame(columns=['first', 'last'])
+
+    locations['sensor_id'] = locations['sensor_id'].astype('Int64').astype(str)
+    locations['first'] = pd.to_datetime(locations['datetimeFirst'], utc=True, errors='coerce')
+    locations['last'] = pd.to_datetime(locations['datetimeLast'], utc=True, errors='coerce')
+    return locations.groupby('sensor_id').agg({'first': 'min', 'last': 'max'})
+
+
+def estimate_sensor_costs(sensor_ids, history, start_date, end_date, watermarks, limit=1000):
+    """
+    Coste estimado por sensor: páginas a pedir y días a descargar en el rango
+    pendiente (desde su marca de agua, si la hay, hasta `end_date`). Con
+    mediciones horarias cada día son PERIODOS_POR_DIA resultados.
+    Los sensores sin historial conocido reciben la mediana del resto.
+    """
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    costs = {}
+    unknown = []
+    for sensor_id in sensor_ids:
+        if sensor_id not in history.index:
+            unknown.append(sensor_id)
+            continue
+        first, last = history.loc[sensor_id, 'first'], history.loc[sensor_id, 'last']
+        range_start = max(start, pd.Timestamp(watermarks[sensor_id])) if sensor_id in watermarks else start
+        if pd.notnull(first):
+            range_start = max(range_start, first)
+        range_end = min(end, last) if pd.notnull(last) else end
+        days = max((range_end - range_start).days, 0)
+        pages = max(math.ceil(days * PERIODOS_POR_DIA / limit), 1)
+        costs[sensor_id] = pages * COSTE_PAGINA + days * PERIODOS_POR_DIA * COSTE_DIA
+
+    default_cost = float(pd.Series(list(costs.values())).median()) if costs else COSTE_PAGINA
+    for sensor_id in unknown:
+        costs[sensor_id] = default_cost
+    return costs
+
+
+def plan_batches(costs, max_batch_size, max_payload_bytes):
+    """
+    Reparte los sensores en lotes de coste similar (LPT: del más caro al más
+    barato, cada uno al lote con menor carga) respetando un tamaño máximo en
+    bytes del lote serializado y un número máximo de sensores por lote.
+    """
+    sensor_bytes = {sensor_id: len(json.dumps(sensor_id)) + 2 for sensor_id in costs}
+    total_bytes = sum(sensor_bytes.values())
+    num_batches = max(math.ceil(len(costs) / max_batch_size), math.ceil(total_bytes / max_payload_bytes), 1)
+
+    batches = [{'sensors': [], 'estimated_cost': 0.0, 'bytes': 0} for _ in range(num_batches)]
+    heap = [(0.0, i) for i in range(num_batches)]
+    for sensor_id in sorted(costs, key=lambda s: (-costs[s], s)):
+        skipped = []
+        while heap:
+            load, i = heapq.heappop(heap)
+            batch = batches[i]
+            if (len(batch['sensors']) < max_batch_size
+                    and batch['bytes'] + sensor_bytes[sensor_id] <= max_payload_bytes):
+                break
+            skipped.append((load, i))
+        else:
+            # Ningún lote admite el sensor: se abre uno nuevo
+            batches.append({'sensors': [], 'estimated_cost': 0.0, 'bytes': 0})
+            i = len(batches) - 1
+            batch = batches[i]
+        batch['sensors'].append(sensor_id)
+        batch['estimated_cost'] += costs[sensor_id]
+        batch['bytes'] += sensor_bytes[sensor_id]
+        heapq.heappush(heap, (batch['estimated_cost'], i))
+        for item in skipped:
+            heapq.heappush(heap, item)
+
+    return [{'sensors': batch['sensors'], 'estimated_cost': round(batch['estimated_cost'], 3)}
+            for batch in batches if batch['sensors']]
+
+
+@instrument_handler
 def lambda_handler(event, context):
     """
-    Recibe una lista larga y la divide en una lista de listas más pequeñas (lotes).
+    Recibe una lista larga y la divide en una lista de lotes de coste estimado
+    similar, para que ningún lote del Map alargue la ejecución completa.
     """
     # La lista completa viene de la Lambda A
-    all_ids = event
-    
-    # Tamaño del lote. 500 sensores * 7 eventos/sensor = 3500 eventos. ¡Seguro!
-    batch_size = 500 
-    
-    # Lógica de división en lotes
-    batches = [all_ids[i:i + batch_size] for i in range(0, len(all_ids), batch_size)]
-    
-    print(f"Dividida la lista de {len(all_ids)} IDs en {len(batches)} lotes de tamaño ~{batch_size}.")
-    
-    # Devolvemos un diccionario que el Map State puede usar
-    # El formato es una lista de objetos, donde cada objeto contiene un lote
-
-    # return {
-    #     "batches": [{"sensors": batch} for batch in batches]
-    # }
-
-    return [batch for batch in batches]
\ No newline at end of file
+    all_ids = get_sensor_ids(event)
+    bucket_name = os.getenv('bucket_name')
+    start_date = os.getenv('start_date', "2024-01-01T00:00:00Z")
+    end_date = os.getenv('end_date', datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z'))
+    full_refresh = os.getenv('full_refresh', 'false').lower() in ('true', '1')
+
+    # Tamaño máximo del lote (sensores que procesa una invocación de get_open_aq_data)
+    batch_size = int(os.getenv('batch_size', 500))
+
+    phase('fetch')
+    history = read_sensor_history(bucket_name)
+    watermark_store = WatermarkStore(join_uri(bucket_name, 'state', OPENAQ_DATASET, 'watermarks'))
+    # Aún no se ha lanzado ningún lote: es el momento de consolidar los segmentos
+    watermarks = watermark_store.compact()
+    if full_refresh:
+        watermarks = {}
+    phase('transform')
+    costs = estimate_sensor_costs(all_ids, history, start_date, end_date, watermarks)
+    batches = plan_batches(costs, batch_size, MAX_PAYLOAD_BYTES)
+
+    batch_costs = [batch['estimated_cost'] for batch in batches]
+    if batch_costs:
+        mean_cost = sum(batch_costs) / len(batch_costs)
+        skew = max(batch_costs) / mean_cost if mean_cost else 1.0
+        print(f"Dividida la lista de {len(all_ids)} IDs en {len(batches)} lotes. "
+              f"Coste estimado por lote: min={min(batch_costs):.1f}, max={max(batch_costs):.1f}, "
+              f"media={mean_cost:.1f} (max/media={skew:.2f})")
+
+    # Devolvemos una lista de objetos que el Map State reparte entre ejecuciones,
+    # cada uno con su lote y su coste estimado. Step Functions rechazaría una
+    # salida mayor que su límite con un error genérico: se falla aquí con la causa
+    output_bytes = len(json.dumps(batches))
+    if output_bytes > STEP_FUNCTIONS_LIMIT_BYTES:
+        raise ValueError(f"La salida ({len(all_ids)} sensores en {len(batches)} lotes) ocupa {output_bytes} "
+                         f"bytes y supera el límite de Step Functions ({STEP_FUNCTIONS_LIMIT_BYTES}). "
+                         f"Reparte los sensores entre varias ejecuciones.")
+
+    return batches
@@ -1,39 +1,19 @@
-
 import requests
 import pandas as pd
 import time
-import boto3
-from botocore.exceptions import ClientError
-import awswrangler as wr
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from tfm_common.clients import get_secret, get_session, get_stats
+from tfm_common.parquet import write_parquet
+from tfm_common.storage import join_uri, read_bytes, write_bytes
+from tfm_common.profiling import phase
+from tfm_common.telemetry import annotate, endpoint_of, instrument_handler, record, timed
+from tfm_common.schemas import INCLASNS_DATOS, SchemaError
 import json
-import sys
 import os
 
-def get_secret(secret_name):
-
-    region_name = "us-east-1"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-
-    secret = get_secret_value_response['SecretString']
-    secret = json.loads(secret)
-
-    return secret
-
+BASE_API_URI = os.getenv('inclasns_base_url', 'https://inclasns.sanidad.gob.es').rstrip('/')
 
 def make_api_request(url, params=None, max_retries=5, initial_delay=1):
     """
@@ -44,31 +24,36 @@ def make_api_request(url, params=None, max_retries=5, initial_delay=1):
 
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, params=params, headers=headers)
+            with timed('api_request', api='inclasns', endpoint=endpoint_of(url), attempt=attempt) as call:
+                response = get_session().get(url, params=params, headers=headers)
+                call.update(status=response.status_code, bytes=len(response.content))
 
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 410:
                 print(
-                    f"Error 410 Gone: Versión de la API retirada. usar /v3/. Detalles: {response.text}")[2]
+                    f"Error 410 Gone: Versión de la API retirada. Detalles: {response.text}")
                 return None
             elif response.status_code == 429:
                 reset_time = int(response.headers.get('x-ratelimit-reset', 60))
                 print(
                     f"""Error 429 Too Many Requests: Límite de tasa excedido.
-                    Esperando {reset_time} segundos antes de reintentar.""")[1]
+                    Esperando {reset_time} segundos antes de reintentar.""")
+                record('backoff_sleep', api='inclasns', reason=429, sleep_s=reset_time + 1)
                 time.sleep(reset_time + 1)  # Esperar el tiempo de reseteo + 1 segundo
             else:
                 print(
                     f"Error al descargar datos (Intento {attempt + 1}/{max_retries}): {response.status_code} - {response.text}")
+                record('backoff_sleep', api='inclasns', reason=response.status_code, sleep_s=initial_delay * (2 ** attempt))
                 time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial [3, 4]
         except requests.exceptions.RequestException as e:
             print(f"Error de conexión (Intento {attempt + 1}/{max_retries}): {e}")
+            record('backoff_sleep', api='inclasns', reason=type(e).__name__, sleep_s=initial_delay * (2 ** attempt))
             time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial
     print(f"Fallo después de {max_retries} reintentos para URL: {url} con params: {params}")
     return None
 
-def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
+def put_s3_object(s3_path, df, partition_cols=None, prefix=None, schema=None):
     """
     Esta funcion recibe un dataframe y lo carga en s3 particionado
     por las columnas indicadas en partition_list
@@ -76,96 +61,138 @@ def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
         s3_path: path s3 donde se va a cargar
         df: Dataframe
         partition_cols: lista de columnas por las cuales particionar
+        schema: esquema de tfm_common.schemas con los tipos de cada columna
     :return:
     """
-
-    if partition_cols is not None:
-        resultado = wr.s3.to_parquet(
-            df=df,
-            path=s3_path,
-            dataset=True,  # ¡Esta es la clave para habilitar el particionamiento!
-            partition_cols=partition_cols,
-            mode="overwrite_partitions",
-            compression="snappy",
-            filename_prefix=prefix
-        )
-    else:
-        resultado = wr.s3.to_parquet(
-            df=df
-            , path=s3_path
-            # , mode='overwrite'
-        )
+    # pyarrow y el cliente de S3 compartido en lugar de awswrangler (ver tfm_common.parquet)
+    resultado = write_parquet(
+        s3_path,
+        df,
+        partition_cols=partition_cols,
+        mode="overwrite_partitions",
+        filename_prefix=prefix,
+        schema=schema
+    )
 
     return resultado
 
+def get_fingerprint(data):
+    """
+    Huella sha256 de la respuesta en JSON canónico (independiente del orden de las claves).
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def load_fingerprints(uri):
+    return json.loads(read_bytes(uri) or b'{}')
+
+
+def save_fingerprints(uri, fingerprints):
+    write_bytes(uri, json.dumps(fingerprints, sort_keys=True, indent=1).encode('utf-8'))
+
+
+def fetch_indicador(indicador, clave_api):
+    params = {'indicador': indicador, 'sexo': '', 'ccaa': '', 'anio': '', 'API_KEY': clave_api}
+    return make_api_request(f'{BASE_API_URI}/api/v2/datos', params=params)
+
+
+def build_indicador_df(data, df_indicadores):
+    tmp_df = pd.DataFrame(data[0]['datos'])
+    tmp_df['codigo'] = data[0]['codigo']
+    return tmp_df.merge(df_indicadores[['nombre', 'codigo']], how='left')
+
+
 # --- Función Handler para AWS Lambda ---
+@instrument_handler
 def lambda_handler(event, context):
 
     CLAVE_API = get_secret('tfm-ucm').get('inclasns')
     bucket_name = os.getenv('bucket_name')
+    max_workers = int(os.getenv('max_workers', 8))
+    full_refresh = (event.get('full_refresh') if isinstance(event, dict) and 'full_refresh' in event
+                    else os.getenv('full_refresh', 'false').lower() in ('true', '1'))
     print(f'Bucket: {bucket_name}')
-    
-    # declaramos el endpoint para la lista de variables
-    base_api_uri = f'https://inclasns.sanidad.gob.es'
-    comp_uri  = f'/api/v2/indicador?API_KEY={CLAVE_API}'
-    api_uri = base_api_uri + comp_uri
+    inicio = time.perf_counter()
 
     # obtenemos la lista de indicadores
-
-    try:
-        response = requests.get(api_uri)
-        if response.status_code == 200:
-            print('Indicadores obtenidos')
-            df_indicadores = pd.DataFrame(response.json())
-
-            # Ahora preguntamos por los datos de cada codigo, solo de aquellos que nos interesan
-            indicadores = list(df_indicadores[df_indicadores['nombre'].str.contains('EPOC|asma|tosferina', regex=True)]['codigo'])
-            print(f"Obteniendo datos para siguientes codigos de indicadores: {indicadores}")
-            datos_dict = {}
-            for indicador in indicadores:
-                print(f"Indicador: {indicador}")
-                comp_uri = f'/api/v2/datos?indicador={indicador}&sexo=&ccaa=&anio=&API_KEY={CLAVE_API}'
-                # comp_uri = f'/api/v2/datos?indicador={indicador}&anio=2023&anio=2024&API_KEY={CLAVE_API}'
-                api_uri = base_api_uri + comp_uri
-                response = requests.get(api_uri)
-                if response.status_code == 200:
-                    datos_dict[f'{indicador}'] = response.json()
-                else:
-                    print(response.text)
-                    continue
-
-            # los convertimos a df para guardarlos como parquet
-            datos = {}
-            for df in list(datos_dict.keys()):
-                tmp_df = pd.DataFrame(datos_dict[df][0]['datos'])
-                tmp_df['codigo'] = datos_dict[df][0]['codigo']
-                tmp_df =  tmp_df.merge(df_indicadores[['nombre', 'codigo']], how='left')
-                datos[df] = tmp_df
-
-            # guadamos en s3 cada df obtenido
-            for df in datos:
-                file_name = datos[df]['nombre'].unique()[0].replace(' ', '_').replace('.', '').replace(',', '')
-                s3_path = f"{bucket_name}/staging/inclasns/{file_name}.parquet"
-                print(f"Guardando : {s3_path}")
-                put_s3_object(
-                    s3_path=s3_path,
-                    df=datos[df].astype('str')
-                    # partition_cols=['year', 'month', 'day'],
-                    # prefix=f'measure_sensor_{sensor_id}' # Prefijo único por si acaso
-                )
-
-            return {
-                'statusCode': 200,
-                'body': json.dumps(f'Datos guardados en: {bucket_name}'),
-                'size': len(datos)
-            }
-            
-        else:
-            print(response.text)
-    except Exception as e:
-        print(e)
-
-    
-
-
-
+    phase('fetch')
+    catalogo = make_api_request(f'{BASE_API_URI}/api/v2/indicador', params={'API_KEY': CLAVE_API})
+    if catalogo is None:
+        print('No se pudo obtener la lista de indicadores')
+        return {
+            'statusCode': 500,
+            'body': json.dumps('No se pudo obtener la lista de indicadores')
+        }
+    print('Indicadores obtenidos')
+    df_indicadores = pd.DataFrame(catalogo)
+
+    # Ahora preguntamos por los datos de cada codigo, solo de aquellos que nos interesan,
+    # en paralelo y con los reintentos de make_api_request
+    indicadores = list(df_indicadores[df_indicadores['nombre'].str.contains('EPOC|asma|tosferina', regex=True)]['codigo'])
+    print(f"Obteniendo datos para siguientes codigos de indicadores: {indicadores}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        respuestas = dict(zip(indicadores, executor.map(lambda indicador: fetch_indicador(indicador, CLAVE_API),
+                                                        indicadores)))
+    segundos_descarga = time.perf_counter() - inicio
+
+    # Estos datos cambian muy pocas veces al año: solo se reescriben los
+    # indicadores cuya respuesta no coincide con la huella guardada
+    fingerprints_uri = join_uri(bucket_name, 'state/inclasns/fingerprints.json')
+    fingerprints = {} if full_refresh else load_fingerprints(fingerprints_uri)
+    fallidos, sin_cambios, reescritos = [], [], []
+    phase('write')
+    inicio_escritura = time.perf_counter()
+    for indicador, data in respuestas.items():
+        if not data:
+            fallidos.append(indicador)
+            continue
+        fingerprint = get_fingerprint(data)
+        if fingerprints.get(str(indicador), {}).get('sha256') == fingerprint:
+            sin_cambios.append(indicador)
+            continue
+
+        # los convertimos a df para guardarlos como parquet
+        df = build_indicador_df(data, df_indicadores)
+        file_name = df['nombre'].unique()[0].replace(' ', '_').replace('.', '').replace(',', '')
+        s3_path = join_uri(bucket_name, 'staging/inclasns', f'{file_name}.parquet')
+        print(f"Guardando : {s3_path}")
+        try:
+            put_s3_object(
+                s3_path=s3_path,
+                df=df,
+                schema=INCLASNS_DATOS
+            )
+        except SchemaError as e:
+            # Sin huella: se vuelve a intentar en la siguiente ejecución
+            print(f"El indicador {indicador} no cumple {INCLASNS_DATOS['name']}: {e}")
+            fallidos.append(indicador)
+            continue
+        fingerprints[str(indicador)] = {
+            'sha256': fingerprint,
+            'path': s3_path,
+            'updated_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+        reescritos.append(indicador)
+
+    if reescritos:
+        save_fingerprints(fingerprints_uri, fingerprints)
+    segundos_escritura = time.perf_counter() - inicio_escritura
+
+    resumen = {
+        'fetched': len(indicadores) - len(fallidos),
+        'unchanged': len(sin_cambios),
+        'rewritten': len(reescritos),
+        'failed': fallidos,
+        'fetch_seconds': round(segundos_descarga, 2),
+        'write_seconds': round(segundos_escritura, 2),
+        'total_seconds': round(time.perf_counter() - inicio, 2)
+    }
+    print(f"Resumen: {resumen}")
+    annotate(**resumen)
+    print(f"Estadísticas de clientes: {get_stats()}")
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Datos guardados en: {bucket_name}'),
+        'size': len(reescritos),
+        **resumen
+    }
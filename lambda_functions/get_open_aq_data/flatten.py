@@ -0,0 +1,90 @@
+"""
+Aplanado columnar de las páginas `results` de /v3/sensors/{id}/measurements/daily.
+
+Recorre los registros una sola vez acumulando cada campo en su propia lista y
+construye directamente columnas tipadas de Arrow; la conversión de zona
+horaria se hace sobre la columna completa en lugar de registro a registro.
+"""
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+SUMMARY_FIELDS = ('min', 'q02', 'q25', 'median', 'q75', 'q98', 'max', 'avg', 'sd')
+LOCAL_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def _to_naive_utc(local_values):
+    """
+    Convierte fechas ISO con desplazamiento (`period.*.local`) a timestamps UTC
+    sin zona, igual que el antiguo `tz_convert(None)`. Los valores que no se
+    pueden interpretar quedan como nulos.
+    """
+    array = pa.array(local_values, type=pa.string())
+    try:
+        parsed = pc.strptime(array, format=LOCAL_FORMAT, unit='us', error_is_null=True)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        parsed = None
+    # Con error_is_null un formato que Arrow no admite (p. ej. '+hh:mm' en %z
+    # en versiones antiguas) no falla, solo deja nulos: si hay más nulos que en
+    # la entrada se interpreta la columna con pandas
+    if parsed is None or parsed.null_count > array.null_count:
+        import pandas as pd
+        # pandas 2 deduce un único formato de la primera fecha salvo con 'ISO8601'
+        options = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+        parsed = pa.array(pd.to_datetime(pd.Series(local_values, dtype='object'), utc=True, errors='coerce',
+                                         **options))
+    return parsed.cast(pa.timestamp('us'))
+
+
+def flatten_daily_measurements(pages, sensor_id):
+    """
+    Convierte una o varias páginas de resultados en una tabla de Arrow con las
+    columnas value, sensor_id, datetimeFrom, datetimeTo y las del summary.
+
+    :param
+        pages: lista de páginas (cada una, la lista `results` de la API)
+        sensor_id: identificador del sensor, se añade como columna constante
+    :return: pyarrow.Table
+    """
+    values = []
+    datetime_from = []
+    datetime_to = []
+    summary = {field: [] for field in SUMMARY_FIELDS}
+
+    for page in pages:
+        for record in page:
+            values.append(record.get('value'))
+            period = record.get('period') or {}
+            datetime_from.append((period.get('datetimeFrom') or {}).get('local'))
+            datetime_to.append((period.get('datetimeTo') or {}).get('local'))
+            record_summary = record.get('summary') or {}
+            for field in SUMMARY_FIELDS:
+                summary[field].append(record_summary.get(field))
+
+    columns = {
+        'value': pa.array(values, type=pa.float64()),
+        'sensor_id': pa.repeat(pa.scalar(str(sensor_id)), len(values)),
+        'datetimeFrom': _to_naive_utc(datetime_from),
+        'datetimeTo': _to_naive_utc(datetime_to),
+    }
+    for field in SUMMARY_FIELDS:
+        columns[field] = pa.array(summary[field], type=pa.float64())
+    return pa.table(columns)
+
+
+def max_datetime_to(table, now=None):
+    """
+    Marca de agua de la tabla en formato ISO UTC, o None: el último
+    `datetimeTo` de los periodos ya cerrados en `now` (UTC sin zona; por
+    defecto, ahora). Un periodo aún abierto (el día o la hora en curso, con un
+    agregado parcial) deja la marca en su `datetimeFrom`, para que la
+    siguiente ejecución lo vuelva a pedir completo.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+    closed = pc.less_equal(table['datetimeTo'], pa.scalar(now, pa.timestamp('us')))
+    value = pc.max(pc.if_else(closed, table['datetimeTo'], table['datetimeFrom'])).as_py()
+    if value is None:
+        return None
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
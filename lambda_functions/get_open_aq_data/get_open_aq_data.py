@@ -1,42 +1,50 @@
-
-
 import requests
 import json
-import pandas as pd
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-import io
-import awswrangler as wr
-import boto3
-from botocore.exceptions import ClientError
+from tfm_common.clients import get_secret, get_session, get_stats
+from tfm_common.storage import join_uri
+from tfm_common.profiling import phase
+from tfm_common.telemetry import annotate, endpoint_of, instrument_handler, record, timed
+from tfm_common.manifests import publish_manifest
+from tfm_common.parquet import ParquetBufferWriter, ParquetStreamWriter
+from tfm_common.schemas import OPENAQ_MEASUREMENTS
+from tfm_common.checkpoints import IngestCheckpoint
+from tfm_common.watermarks import WatermarkStore, to_utc_iso
+from tfm_common.rate_limit import openaq_rate_limiter
+from tfm_common.pagination import iter_pages
+from flatten import flatten_daily_measurements, max_datetime_to
+from shards import DEFAULT_SHARD_DAYS, PERIODS, own_rows, split_windows
 import os 
 
-
-
-def get_secret(secret_name):
-
-    region_name = "us-east-1"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-
-    secret = get_secret_value_response['SecretString']
-    secret = json.loads(secret)
-
-    return secret
+# URL base de la API (se puede apuntar a un stub local para pruebas y benchmarks)
+OPENAQ_BASE_URL = os.getenv('openaq_base_url', 'https://api.openaq.org').rstrip('/')
+# Páginas de un mismo sensor que se piden en paralelo
+PAGE_WORKERS = int(os.getenv('page_workers', 4))
+# Con streaming_writer cada página se escribe en el parquet del lote en cuanto
+# llega, subiéndolo a S3 por partes de multipart_part_size bytes
+STREAMING_WRITER = os.getenv('streaming_writer', 'false').lower() in ('true', '1')
+MULTIPART_PART_SIZE = int(os.getenv('multipart_part_size', 8 * 1024 * 1024))
+# Granularidad de las mediciones (daily/hourly). El rango de cada sensor se
+# divide en ventanas de shard_days días (0: sin dividir) que se descargan en
+# paralelo, shard_workers a la vez por sensor
+GRANULARITY = os.getenv('measurements_granularity', 'daily')
+if GRANULARITY not in PERIODS:
+    raise ValueError(f"measurements_granularity debe ser uno de {sorted(PERIODS)}: {GRANULARITY}")
+SHARD_DAYS = int(os.getenv('shard_days', DEFAULT_SHARD_DAYS[GRANULARITY]))
+SHARD_WORKERS = int(os.getenv('shard_workers', 4))
+# Las mediciones horarias van a su propio dataset (staging/OpenAQ_hourly,
+# state/OpenAQ_hourly) con la misma estructura que las diarias
+OPENAQ_DATASET = 'OpenAQ' if GRANULARITY == 'daily' else f'OpenAQ_{GRANULARITY}'
+# Punto de control (con run_id en el evento): el segmento en curso se escribe
+# cada checkpoint_rows filas o checkpoint_interval_s segundos, y la descarga se
+# detiene cuando quedan menos de checkpoint_margin_s segundos de invocación
+CHECKPOINT_ROWS = int(os.getenv('checkpoint_rows', 500000))
+CHECKPOINT_INTERVAL_S = float(os.getenv('checkpoint_interval_s', 120))
+CHECKPOINT_MARGIN_S = float(os.getenv('checkpoint_margin_s', 60))
 
 
 def make_api_request(url, params, max_retries=5, initial_delay=1):
@@ -49,214 +57,439 @@ def make_api_request(url, params, max_retries=5, initial_delay=1):
         'content-type': 'application/json'}
     
     for attempt in range(max_retries):
+        openaq_rate_limiter.acquire()
         try:
-            response = requests.get(url, params=params, headers=headers)
-
-            # Imprimir cabeceras de límite de tasa para depuración (opcional)
-            # print(f"Headers: x-ratelimit-remaining={response.headers.get('x-ratelimit-remaining')}, x-ratelimit-reset={response.headers.get('x-ratelimit-reset')}")
+            with timed('api_request', api='openaq', endpoint=endpoint_of(url), attempt=attempt) as call:
+                response = get_session().get(url, params=params, headers=headers)
+                call.update(status=response.status_code, bytes=len(response.content))
+            openaq_rate_limiter.update(response.headers)
 
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 410:
                 print(
-                    f"Error 410 Gone: Versión de la API retirada. usar /v3/. Detalles: {response.text}")[2]
+                    f"Error 410 Gone: Versión de la API retirada. usar /v3/. Detalles: {response.text}")
                 return None
             elif response.status_code == 429:
                 reset_time = int(response.headers.get('x-ratelimit-reset', 60))
                 print(
                     f"Error 429 Too Many Requests: Límite de tasa excedido. \
                     Esperando {reset_time} segundos antes de reintentar.")
-                time.sleep(reset_time + 1)  # Esperar el tiempo de reseteo + 1 segundo
+                # El limitador detiene al resto de hilos hasta el reseteo
+                openaq_rate_limiter.block_until_reset(reset_time)
             else:
                 print(
                     f"Error al descargar datos (Intento {attempt + 1}/{max_retries}): {response.status_code} - {response.text}")
+                record('backoff_sleep', api='openaq', reason=response.status_code, sleep_s=initial_delay * (2 ** attempt))
                 time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial [3, 4]
         except requests.exceptions.RequestException as e:
+            openaq_rate_limiter.update()
             print(f"Error de conexión (Intento {attempt + 1}/{max_retries}): {e}")
+            record('backoff_sleep', api='openaq', reason=type(e).__name__, sleep_s=initial_delay * (2 ** attempt))
             time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial
     print(f"Fallo después de {max_retries} reintentos para URL: {url} con params: {params}")
     return None
 
 
-#============= Parametros de medicion ============
-
-
-def get_parameters():
-    parameters_base_url = 'https://api.openaq.org/v3/parameters'
-    params = {"limit": 1000}
-    data = make_api_request(parameters_base_url, params)
-    if data and 'results' in data:
-        return data
-
-
-
-def get_daily_measurements_for_sensor(sensor_id, datetime_from=None, datetime_to=None, limit=1000):
+def measurements_fetcher(sensor_id, datetime_from=None, datetime_to=None, limit=1000):
     """
-    Descarga mediciones diarias agregadas para un sensor específico,
-    manejando la paginación para obtener todos los datos dentro del rango.
+    Devuelve la función que pide una página de mediciones del sensor con la
+    granularidad configurada.
     """
-    daily_measurements_base_url = f"https://api.openaq.org/v3/sensors/{sensor_id}/measurements/daily"
-    all_daily_measurements = []
-    current_page = 1
-    total_pages = 1
-    page_limit = limit
+    measurements_base_url = f"{OPENAQ_BASE_URL}/v3/sensors/{sensor_id}/measurements/{GRANULARITY}"
 
-    while current_page <= total_pages:
+    def fetch_page(page):
         params = {
             "limit": limit,
-            "page": current_page
+            "page": page
         }
         # Usar 'datetime_from' y 'datetime_to' para endpoints agregados
         if datetime_from:
             params["datetime_from"] = datetime_from
         if datetime_to:
             params["datetime_to"] = datetime_to
+        return make_api_request(measurements_base_url, params)
 
-        data = make_api_request(daily_measurements_base_url, params)
+    return fetch_page
 
-        if data and 'results' in data:
-            daily_measurements_page = data['results']
-            all_daily_measurements.extend(daily_measurements_page)
 
-            # agregamos el id al diccionario
-            for i,j in enumerate(all_daily_measurements):
-                all_daily_measurements[i]['sensor_id'] = sensor_id
+class Deadline:
+    """
+    Tiempo que le queda a la invocación: el del `context` de Lambda o, en
+    local, el de la variable de entorno `time_budget_s`. Se da por agotado
+    cuando quedan menos de `margin_s` segundos, reservados para escribir el
+    segmento en curso y el punto de control.
+    """
 
-            total_results = data['meta'].get('found', 0)
-            if total_results == '>1000':
-                total_pages +=1
-            else:
-                total_pages = (total_results + page_limit - 1) // page_limit
+    def __init__(self, context, margin_s):
+        self.context = context if hasattr(context, 'get_remaining_time_in_millis') else None
+        budget = os.getenv('time_budget_s')
+        self.ends_at = time.monotonic() + float(budget) if budget and self.context is None else None
+        self.margin_s = margin_s
+        self.reached = False
+
+    def remaining(self):
+        if self.context is not None:
+            return self.context.get_remaining_time_in_millis() / 1000
+        if self.ends_at is not None:
+            return self.ends_at - time.monotonic()
+        return None
+
+    def expired(self):
+        if not self.reached:
+            remaining = self.remaining()
+            self.reached = remaining is not None and remaining < self.margin_s
+        return self.reached
 
-            page_limit = data['meta'].get('limit', limit)
-            print(
-                f"  Sensor {sensor_id}: Total de mediciones diarias encontradas: {total_results}. \
-                Total de páginas estimadas: {total_pages}")
 
-            current_page += 1
-            time.sleep(0.1)  # Pequeña pausa entre solicitudes de página [1]
+class SegmentWriter:
+    """
+    Escribe las páginas del lote en segmentos (ficheros parquet) y los
+    confirma en el punto de control. Una página solo cuenta como hecha cuando
+    su segmento está escrito: el segmento en curso se cierra al terminar, al
+    agotarse el tiempo o, si el punto de control se guarda, cada
+    `checkpoint_rows` filas o `checkpoint_interval_s` segundos.
+
+    El primer segmento se llama `{prefijo}.parquet` y los siguientes
+    `{prefijo}-{n}.parquet`, así que un reintento del mismo tramo los sobrescribe.
+    """
+
+    def __init__(self, prefix_uri, checkpoint, streaming=False):
+        self.prefix_uri = prefix_uri
+        self.checkpoint = checkpoint
+        self.streaming = streaming
+        self._writer = None
+        self._rows = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        index = self.checkpoint.next_segment_index()
+        uri = f"{self.prefix_uri}.parquet" if index == 0 else f"{self.prefix_uri}-{index}.parquet"
+        if self.streaming:
+            return ParquetStreamWriter(uri, OPENAQ_MEASUREMENTS, part_size=MULTIPART_PART_SIZE)
+        # En memoria se escribe ordenado: el fichero no depende del orden de llegada de las páginas
+        return ParquetBufferWriter(uri, OPENAQ_MEASUREMENTS,
+                                   sort_by=[('sensor_id', 'ascending'), ('datetimeFrom', 'ascending')])
+
+    def write_page(self, sensor_id, window_key, page, table, meta=None):
+        with self._lock:
+            if table.num_rows:
+                if self._writer is None:
+                    self._writer = self._open()
+                    self._opened_at = time.monotonic()
+                self._writer.write(table)
+                self._rows += table.num_rows
+            self.checkpoint.stage_page(sensor_id, window_key, page, table.num_rows,
+                                       max_datetime_to(table) if table.num_rows else None, meta)
+            if self.checkpoint.uri and self._writer is not None and (
+                    self._rows >= CHECKPOINT_ROWS
+                    or time.monotonic() - self._opened_at >= CHECKPOINT_INTERVAL_S):
+                self._flush()
+
+    def complete_window(self, sensor_id, window_key, meta=None):
+        with self._lock:
+            self.checkpoint.stage_window_complete(sensor_id, window_key, meta)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        written = self._writer.close() if self._writer is not None else None
+        self._writer = None
+        self._rows = 0
+        self.checkpoint.commit_segment(written)
+        if written:
+            print(f"  Segmento escrito: {written['uri']} ({written['rows']} mediciones).")
+
+    def abort(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.abort()
+                self._writer = None
+
+
+def window_key(window):
+    return f"{window['request_from']}/{window['request_to']}"
+
+
+def fetch_window(sensor_id, window, segments, deadline, limit=1000):
+    """
+    Descarga las páginas de una ventana que no estén ya en el punto de
+    control y escribe en `segments` la tabla de Arrow de cada una, limitada al
+    tramo propio de la ventana.
+
+    La ventana solo queda completa si se han recibido todas sus páginas: si
+    se agota el tiempo o una página falla tras los reintentos de
+    make_api_request, se deja a medias para retomarla en la siguiente
+    invocación. Devuelve un dict con rows, pages_skipped, complete, timeout y
+    failed_page.
+    """
+    key = window_key(window)
+    done_pages, meta, complete = segments.checkpoint.window(sensor_id, key)
+    status = {'rows': 0, 'pages_skipped': len(done_pages), 'complete': complete, 'timeout': False,
+              'failed_page': None}
+    if complete:
+        return status
+
+    fetch_page = measurements_fetcher(sensor_id, window['request_from'], window['request_to'], limit)
+    first_meta = {}
+    # Páginas no pedidas por falta de tiempo; el resto de páginas sin datos han fallado
+    expired_pages = set()
+    lock = threading.Lock()
+
+    def checked_fetch_page(page):
+        # Una página no pedida por falta de tiempo corta la paginación igual que un fallo
+        if deadline.expired():
+            with lock:
+                expired_pages.add(page)
+            return None
+        data = fetch_page(page)
+        if data and 'results' in data and page == 1:
+            first_meta.update(data.get('meta') or {})
+        return data
+
+    def on_missing(page):
+        # Solo cuentan las páginas que la paginación necesitaba: las pedidas por
+        # adelantado más allá de la última página real no dejan la ventana a medias
+        with lock:
+            if page in expired_pages:
+                status['timeout'] = True
+            else:
+                status['failed_page'] = page
+
+    sharded = window['lower'] is not None or window['upper'] is not None
+    description = f"  Sensor {sensor_id} [{window['request_from']}, {window['request_to']}): " if sharded \
+        else f"  Sensor {sensor_id}: "
+    # Como mucho 2 * PAGE_WORKERS páginas descargadas a la espera de escribirse
+    for page, results in iter_pages(checked_fetch_page, limit, max_workers=PAGE_WORKERS, description=description,
+                                    max_pending=2 * PAGE_WORKERS, skip_pages=done_pages, meta=meta,
+                                    on_missing=on_missing):
+        # El sensor_id se añade como columna constante al aplanar, no registro a registro
+        table = own_rows(flatten_daily_measurements([results], sensor_id), window)
+        segments.write_page(sensor_id, key, page, table, first_meta if page == 1 else None)
+        status['rows'] += table.num_rows
+
+    if status['failed_page'] is not None:
+        print(f"{description}falló la página {status['failed_page']}; la ventana queda pendiente.")
+    elif not status['timeout']:
+        segments.complete_window(sensor_id, key, first_meta or None)
+        status['complete'] = True
+    return status
+
+
+def ingest_sensor(sensor_id, start_date, end_date, segments, deadline, limit=1000):
+    """
+    Descarga las mediciones del sensor en [start_date, end_date), dividido en
+    ventanas que se piden en paralelo, y las escribe en `segments`. Devuelve
+    un dict con rows, pages_skipped, complete, timeout y failed_pages.
+    """
+    windows = split_windows(start_date, end_date, SHARD_DAYS, PERIODS[GRANULARITY])
+    if segments.checkpoint.sensor_complete(sensor_id, [window_key(window) for window in windows]):
+        return {'rows': 0, 'pages_skipped': 0, 'complete': True, 'timeout': False, 'failed_pages': 0}
+    if deadline.expired():
+        return {'rows': 0, 'pages_skipped': 0, 'complete': False, 'timeout': True, 'failed_pages': 0}
+
+    print(f"Procesando sensor ID: {sensor_id} (Rango: {start_date} a {end_date})...")
+    with timed('sensor_fetch', sensor_id=sensor_id, streaming=segments.streaming) as fetch:
+        if len(windows) == 1:
+            statuses = [fetch_window(sensor_id, windows[0], segments, deadline, limit)]
         else:
-            print(
-                f"  No se obtuvieron datos diarios para el sensor {sensor_id} en la página {current_page}.\
-                 Terminando la descarga para este sensor.")
-            break
+            with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+                futures = [executor.submit(fetch_window, sensor_id, window, segments, deadline, limit)
+                           for window in windows]
+                statuses = [future.result() for future in futures]
+        result = {
+            'rows': sum(status['rows'] for status in statuses),
+            'pages_skipped': sum(status['pages_skipped'] for status in statuses),
+            'complete': all(status['complete'] for status in statuses),
+            'timeout': any(status['timeout'] for status in statuses),
+            'failed_pages': sum(status['failed_page'] is not None for status in statuses),
+        }
+        fetch.update(rows=result['rows'], shards=len(windows), pages_skipped=result['pages_skipped'],
+                     complete=result['complete'])
 
-    return all_daily_measurements
+    print(f"  Sensor {sensor_id}: {result['rows']} mediciones en {len(windows)} ventanas"
+          f"{'' if result['complete'] else ' (incompleto)'}.")
+    return result
 
 
-def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
+def get_datetime_from(sensor_id, start_date, watermarks):
     """
-    Esta funcion recibe un dataframe y lo carga en s3 particionado
-    por las columnas indicadas en partition_list
-    :param
-        s3_path: path s3 donde se va a cargar
-        df: Dataframe
-        partition_cols: lista de columnas por las cuales particionar
-    :return:
+    Inicio del rango a pedir: la marca de agua del sensor si es posterior a `start_date`.
     """
+    watermark = watermarks.get(sensor_id)
+    if watermark and watermark > to_utc_iso(start_date):
+        return watermark
+    return start_date
 
-    if partition_cols is not None:
-        resultado = wr.s3.to_parquet(
-            df=df,
-            path=s3_path,
-            dataset=True,  # ¡Esta es la clave para habilitar el particionamiento!
-            partition_cols=partition_cols,
-            mode= "append", # "overwrite_partitions"
-            compression="snappy",
-            filename_prefix=prefix
-            # database="tfm-ucm",
-            # table="measurments"
-        )
-    else:
-        resultado = wr.s3.to_parquet(
-            df=df
-            , path=s3_path
-            # , mode='overwrite'
-        )
 
-    return resultado
+def is_full_refresh(event):
+    """
+    Recarga completa (backfill) si el evento trae `full_refresh` o la variable
+    de entorno `full_refresh` está activada: se ignoran las marcas de agua.
+    """
+    if isinstance(event, dict) and 'full_refresh' in event:
+        return bool(event['full_refresh'])
+    return os.getenv('full_refresh', 'false').lower() in ('true', '1')
+
+
+def get_sensor_ids(event):
+    """
+    Normaliza el evento de entrada a una lista de IDs de sensor.
+    Acepta un ID suelto (formato antiguo), una lista de IDs o {"sensors": [...]}.
+    """
+    if isinstance(event, dict):
+        event = event.get('sensors', [])
+    if not isinstance(event, list):
+        event = [event]
+    return [str(sensor_id) for sensor_id in event]
+
+
+def get_batch_name(sensor_ids):
+    """
+    Nombre determinista del fichero de un lote: un reintento del mismo lote
+    sobrescribe su salida en lugar de duplicarla.
+    """
+    digest = hashlib.sha1(','.join(sorted(sensor_ids)).encode('utf-8')).hexdigest()[:12]
+    return f"lote_{digest}"
+
 
 # --- Función Handler para AWS Lambda ---
+@instrument_handler
 def lambda_handler(event, context):
     print("Iniciando ejecución de la función Lambda para descargar datos de calidad del aire...")
 
     # Obtenemos las variables de evento
     bucket_name = os.getenv('bucket_name')
-    country_code = os.getenv('country_code', 'ES')
     start_date = os.getenv('start_date', "2024-01-01T00:00:00Z")
     end_date = os.getenv('end_date', datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z'))
-    sensor_id = event
-
-    # ======================== Measurements (Lógica Optimizada) ========================
-    
-    total_mediciones_cargadas = 0
-
-    # CAMBIO CLAVE: Ya no necesitamos la lista `all_spain_daily_measurements`. La eliminamos.
-    
-    # for i, sensor_id in enumerate(list(sensors)):
-    # print(f"[{i + 1}/{len(sensors)}] Procesando sensor ID: {sensor_id} (Rango: {start_date} a {end_date})...")
-    print(f"Procesando sensor ID: {sensor_id} (Rango: {start_date} a {end_date})...")
-    
-    daily_measurements_for_sensor = get_daily_measurements_for_sensor(
-        sensor_id=sensor_id,
-        datetime_from=start_date,
-        datetime_to=end_date,
-        limit=1000
-    )
-    
-    # CAMBIO CLAVE: Si no hay datos para este sensor, simplemente continuamos al siguiente.
-    if not daily_measurements_for_sensor:
-        print(f"  Sensor {sensor_id}: No se encontraron mediciones. Saltando.")
-        # pass # Pasa a la siguiente iteración del bucle
-    
-    # CAMBIO CLAVE: Creamos un DataFrame PEQUEÑO, solo para el sensor actual.
+    max_workers = int(os.getenv('max_workers', 8))
+    sensor_ids = get_sensor_ids(event)
+    batch_name = get_batch_name(sensor_ids)
+
+    # ======================== Punto de control ========================
+    # Con `run_id` (el Id de la ejecución de Step Functions) el progreso se
+    # guarda página a página: un reintento o una reanudación de la misma
+    # ejecución sigue donde lo dejó la invocación anterior
+    run_id = event.get('run_id') if isinstance(event, dict) else None
+    checkpoint = IngestCheckpoint(
+        join_uri(bucket_name, 'state', OPENAQ_DATASET, 'checkpoints', f'{batch_name}.json') if run_id else None,
+        run_id)
+    watermark_store = WatermarkStore(join_uri(bucket_name, 'state', OPENAQ_DATASET, 'watermarks'))
+    if checkpoint.load():
+        # Se retoman los rangos y la fecha de fin de la primera invocación,
+        # aunque las marcas de agua o el reloj hayan avanzado desde entonces
+        date_ranges = checkpoint.state['ranges']
+        end_date = checkpoint.state['end_date']
+        up_to_date = [sensor_id for sensor_id in sensor_ids if sensor_id not in date_ranges]
+        print(f"Reanudando el lote {batch_name} (ejecución {run_id}, "
+              f"intento {checkpoint.state['attempts'] + 1}).")
+    else:
+        # ======================== Marcas de agua ========================
+        # Solo se pide a la API el tramo posterior al último datetimeTo ingerido
+        full_refresh = is_full_refresh(event)
+        watermarks = {} if full_refresh else watermark_store.load()
+        date_ranges = {sensor_id: get_datetime_from(sensor_id, start_date, watermarks)
+                       for sensor_id in sensor_ids}
+        up_to_date = [sensor_id for sensor_id, datetime_from in date_ranges.items()
+                      if to_utc_iso(datetime_from) >= to_utc_iso(end_date)]
+        date_ranges = {sensor_id: datetime_from for sensor_id, datetime_from in date_ranges.items()
+                       if sensor_id not in up_to_date}
+        # Los ficheros del lote se nombran por los rangos pedidos: un reintento del
+        # mismo tramo los sobrescribe y un tramo posterior genera ficheros distintos
+        checkpoint.start(get_batch_name([f"{sensor_id}@{datetime_from}"
+                                         for sensor_id, datetime_from in date_ranges.items()]),
+                         date_ranges, end_date, datetime.now(timezone.utc).strftime('%Y-%m-%d'))
+        print(f"Recarga completa: {full_refresh}. Sensores al día: {len(up_to_date)}, pendientes: {len(date_ranges)}")
+    checkpoint.state['attempts'] += 1
+    pending = [sensor_id for sensor_id in sensor_ids if sensor_id in date_ranges]
+    file_name = checkpoint.state['name']
+
+    # ======================== Measurements (Lote de sensores) ========================
+    # Los sensores del lote se descargan en paralelo; el RateLimiter compartido
+    # mantiene el conjunto de hilos dentro del límite de la API.
+    print(f"Procesando lote de {len(pending)} sensores con {max_workers} hilos...")
+    deadline = Deadline(context, CHECKPOINT_MARGIN_S)
+    segments = SegmentWriter(join_uri(bucket_name, 'staging', OPENAQ_DATASET, 'measurements',
+                                      checkpoint.state['ingest_date'], file_name),
+                             checkpoint, streaming=STREAMING_WRITER)
+    results = {}
+    failed_sensors = []
+    phase('fetch')
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(ingest_sensor, sensor_id, date_ranges[sensor_id], end_date, segments,
+                                       deadline): sensor_id
+                       for sensor_id in pending}
+            for future in as_completed(futures):
+                sensor_id = futures[future]
+                try:
+                    results[sensor_id] = future.result()
+                except Exception as e:
+                    print(f"  Sensor {sensor_id}: Error procesando el sensor: {e}")
+                    failed_sensors.append(sensor_id)
+        # Lo descargado hasta aquí, también si se agotó el tiempo, queda escrito y confirmado
+        phase('write')
+        segments.flush()
+    except Exception:
+        # La subida por partes incompleta no debe quedarse en S3; lo ya
+        # confirmado en el punto de control se conserva para el reintento
+        segments.abort()
+        raise
+
+    # El manifiesto indica al resto del pipeline qué ficheros se han escrito y
+    # con qué esquema. Cada invocación publica solo sus segmentos nuevos.
+    files, manifest_index = checkpoint.take_unpublished()
+    if files:
+        manifest_name = file_name if manifest_index == 0 else f"{file_name}-{manifest_index}"
+        publish_manifest(join_uri(bucket_name, 'staging', OPENAQ_DATASET), manifest_name, OPENAQ_MEASUREMENTS, files)
+        print(f"Publicados {len(files)} ficheros con {sum(f['rows'] for f in files)} mediciones "
+              f"en el manifiesto {manifest_name}.")
+
+    # La marca de un sensor solo avanza cuando todas sus páginas están escritas:
+    # con páginas pendientes, avanzarla dejaría un hueco que ya no se pediría
+    complete = [sensor_id for sensor_id in pending if results.get(sensor_id, {}).get('complete')]
+    new_watermarks = checkpoint.take_watermarks(complete)
+    if new_watermarks:
+        watermark_store.commit(batch_name, new_watermarks)
+    checkpoint.save()
+
+    incomplete = [sensor_id for sensor_id in pending if sensor_id not in complete]
+    if not incomplete:
+        status, reason = 'complete', None
+    elif deadline.reached:
+        status, reason = 'partial', 'timeout'
+    elif any(result['failed_pages'] for result in results.values()):
+        status, reason = 'partial', 'api_error'
     else:
-        sensor_df = pd.DataFrame(daily_measurements_for_sensor)
-        # CAMBIO CLAVE: Aplicamos TODAS las transformaciones a este pequeño DataFrame.
-        # Esta es la misma lógica que tenías al final, pero aplicada a `sensor_df`.
-        sensor_df['datetimeFrom'] = pd.to_datetime(sensor_df['period'].apply(
-            lambda x: x.get('datetimeFrom', {}).get('local')), errors='coerce')
-        sensor_df['datetimeTo'] = pd.to_datetime(sensor_df['period'].apply(
-            lambda x: x.get('datetimeTo', {}).get('local')), errors='coerce')
-        
-        sensor_df['datetimeFrom'] = sensor_df['datetimeFrom'].apply(lambda x: x.tz_convert(None) if pd.notnull(x) else x)
-        sensor_df['datetimeTo'] = sensor_df['datetimeTo'].apply(lambda x: x.tz_convert(None) if pd.notnull(x) else x)
-
-        # Manejar el caso de que la columna summary no exista o esté vacía
-        if 'summary' in sensor_df.columns:
-            normalized_summary = pd.json_normalize(sensor_df['summary'])
-            sensor_df = pd.concat([sensor_df.reset_index(drop=True), normalized_summary], axis=1)
-
-        sensor_df.drop(columns=['flagInfo', 'parameter', 'period', 'coordinates', 'summary', 'coverage'],
-                        inplace=True, errors='ignore') # 'errors=ignore' por si alguna columna no existe
-
-        # Creamos las columnas de particion
-        # sensor_df['year'] = sensor_df['datetimeFrom'].dt.year
-        # sensor_df['month'] = sensor_df['datetimeFrom'].dt.month
-        # sensor_df['day'] = sensor_df['datetimeFrom'].dt.day
-        
-        # CAMBIO CLAVE: Cargamos el DataFrame de este único sensor a S3.
-        # `awswrangler` añadirá los archivos a las particiones correctas sin sobreescribir
-        # los datos de otros sensores que caigan en la misma partición.
-        print(f"  Sensor {sensor_id}: Encontradas {len(sensor_df)} mediciones. Cargando a S3...")
-        s3_path = f"s3://{bucket_name}/staging/OpenAQ/measurements/{sensor_id}.parquet"
-        put_s3_object(
-            s3_path= s3_path,
-            df=sensor_df
-            # partition_cols=['year', 'month', 'day'],
-            # prefix=f'measure_sensor_{sensor_id}' # Prefijo único por si acaso
-        )
-        
-        total_mediciones_cargadas += len(sensor_df)
-        print(f"  Sensor {sensor_id}: Carga completa.")
-        
-        # Al final de esta iteración, `sensor_df` es liberado de la memoria.
-        # time.sleep(0.1)
-
-        print(f"\nProceso completado. Total de mediciones diarias cargadas en S3: {total_mediciones_cargadas}")
-
-        return {
-            'statusCode': 200,
-            'body': json.dumps(f'Datos guardados en S3: s3://{bucket_name}'),
-            'size': len(sensor_df)
-        }
\ No newline at end of file
+        status, reason = 'partial', 'error'
+    sensors_without_data = [sensor_id for sensor_id in complete if not checkpoint.sensor(sensor_id).get('rows')]
+    total_mediciones_cargadas = sum(result['rows'] for result in results.values())
+    pages_skipped = sum(result['pages_skipped'] for result in results.values())
+
+    print(f"\nProceso {'completado' if status == 'complete' else f'parcial ({reason})'}. "
+          f"Total de mediciones diarias cargadas en S3: {total_mediciones_cargadas}. "
+          f"Sensores pendientes: {len(incomplete)}")
+    annotate(sensors=len(sensor_ids), sensors_fetched=len(complete), failed_sensors=len(failed_sensors),
+             rows=total_mediciones_cargadas, status=status, resumed=checkpoint.resumed, pages_skipped=pages_skipped)
+    print(f"Estadísticas de clientes: {get_stats()}")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Datos guardados en S3: s3://{bucket_name}'),
+        'size': total_mediciones_cargadas,
+        'sensors': len(sensor_ids),
+        'sensors_up_to_date': len(up_to_date),
+        'sensors_without_data': len(sensors_without_data),
+        'failed_sensors': failed_sensors,
+        # Con status 'partial' la máquina de estados vuelve a invocar el lote
+        # con el mismo run_id para completar los sensores pendientes
+        'status': status,
+        'reason': reason,
+        'pending_sensors': incomplete,
+        'resumed': checkpoint.resumed,
+        'pages_skipped': pages_skipped,
+        'checkpoint': checkpoint.uri,
+    }
@@ -0,0 +1,87 @@
+"""
+División del rango de fechas de un sensor en ventanas fijas (shards) que se
+descargan en paralelo.
+
+Las ventanas son consecutivas y, salvo en los extremos del rango, se piden a
+la API con un periodo de margen a cada lado, de modo que una medición que
+cruza una frontera llega en las dos ventanas vecinas sea cual sea el criterio
+de la API para los límites. Cada ventana se queda solo con las filas cuyo
+`datetimeFrom` cae en su tramo [inicio, fin): al unirlas no hay duplicados ni
+huecos en las fronteras.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Duración de un periodo de cada granularidad (endpoint /measurements/{granularidad})
+PERIODS = {
+    'daily': timedelta(days=1),
+    'hourly': timedelta(hours=1),
+}
+# Días por ventana si no se indica `shard_days`: ~1 página de 1000 resultados
+DEFAULT_SHARD_DAYS = {
+    'daily': 365,
+    'hourly': 30,
+}
+
+
+def parse_utc(value):
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def format_utc(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def split_windows(datetime_from, datetime_to, shard_days, period):
+    """
+    Divide [datetime_from, datetime_to) en ventanas de `shard_days` días.
+
+    Devuelve una lista de dicts con el rango a pedir (`request_from`,
+    `request_to`, en ISO UTC) y el tramo propio de la ventana (`lower`,
+    `upper`, datetime UTC sin zona o None en los extremos del rango). Con
+    `shard_days` 0 o un rango más corto que una ventana devuelve una única
+    ventana con el rango original y sin filtrar.
+    """
+    start, end = parse_utc(datetime_from), parse_utc(datetime_to)
+    if not shard_days or end - start <= timedelta(days=shard_days):
+        return [{'request_from': datetime_from, 'request_to': datetime_to, 'lower': None, 'upper': None}]
+
+    bounds = []
+    cursor = start
+    while cursor < end:
+        bounds.append((cursor, min(cursor + timedelta(days=shard_days), end)))
+        cursor = bounds[-1][1]
+
+    windows = []
+    for i, (lower, upper) in enumerate(bounds):
+        first, last = i == 0, i == len(bounds) - 1
+        windows.append({
+            'request_from': datetime_from if first else format_utc(lower - period),
+            'request_to': datetime_to if last else format_utc(upper + period),
+            'lower': None if first else lower.replace(tzinfo=None),
+            'upper': None if last else upper.replace(tzinfo=None),
+        })
+    return windows
+
+
+def own_rows(table, window):
+    """
+    Filas de `table` cuyo datetimeFrom (UTC sin zona) pertenece al tramo de la
+    ventana. Las filas sin datetimeFrom se quedan en la primera ventana.
+    """
+    mask = None
+    if window['lower'] is not None:
+        mask = pc.greater_equal(table['datetimeFrom'], pa.scalar(window['lower'], table['datetimeFrom'].type))
+    if window['upper'] is not None:
+        condition = pc.less(table['datetimeFrom'], pa.scalar(window['upper'], table['datetimeFrom'].type))
+        mask = condition if mask is None else pc.and_(mask, condition)
+    if mask is None:
+        return table
+    if window['lower'] is None:
+        mask = pc.or_kleene(pc.is_null(table['datetimeFrom']), mask)
+    return table.filter(mask)
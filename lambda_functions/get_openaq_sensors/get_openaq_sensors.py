@@ -3,167 +3,195 @@ import json
 import pandas as pd
 import time
 from datetime import datetime, timezone
-import io
-import awswrangler as wr
-import boto3
-from botocore.exceptions import ClientError
+from tfm_common.clients import get_secret, get_session, get_stats
+from tfm_common.http_cache import NETWORK, ResponseCache
+from tfm_common.rate_limit import openaq_rate_limiter
+from tfm_common.pagination import paginate
+from tfm_common.parquet import write_parquet
+from tfm_common.schemas import OPENAQ_LOCATIONS, OPENAQ_PARAMETERS
+from tfm_common.storage import join_uri, size_of, write_bytes
+from tfm_common.profiling import phase
+from tfm_common.telemetry import annotate, endpoint_of, instrument_handler, record, timed
+from tfm_common.watermarks import WatermarkStore, to_utc_iso
 import os
 
+# URL base de la API (se puede apuntar a un stub local para pruebas y benchmarks)
+OPENAQ_BASE_URL = os.getenv('openaq_base_url', 'https://api.openaq.org').rstrip('/')
+# Páginas del listado de ubicaciones que se piden en paralelo
+PAGE_WORKERS = int(os.getenv('page_workers', 4))
 
-def get_secret(secret_name):
+# Los catálogos de parámetros y ubicaciones cambian poco: se cachean en /tmp
+# (contenedor en caliente) y en S3 (compartido entre invocaciones)
+reference_cache = ResponseCache(
+    shared_prefix=join_uri(os.getenv('bucket_name'), 'cache/http') if os.getenv('bucket_name') else None,
+    local_dir=os.getenv('http_cache_dir', '/tmp/http_cache'),
+    ttl=int(os.getenv('reference_cache_ttl', 86400)),
+    max_local_bytes=int(os.getenv('http_cache_max_bytes', 64 * 1024 * 1024))
+)
 
-    region_name = "us-east-1"
+# Marcas de agua del dataset de la granularidad configurada (ver get_open_aq_data)
+GRANULARITY = os.getenv('measurements_granularity', 'daily')
+OPENAQ_DATASET = 'OpenAQ' if GRANULARITY == 'daily' else f'OpenAQ_{GRANULARITY}'
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+# Motivos por los que un sensor no se envía a get_open_aq_data
+SIN_DATOS = 'no_data'                          # la ubicación no tiene datetimeLast
+TERMINA_ANTES = 'ended_before_window'          # último dato anterior a start_date
+EMPIEZA_DESPUES = 'starts_after_window'        # primer dato posterior a end_date
+AL_DIA = 'up_to_date'                          # la marca de agua ya cubre su último dato
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
 
-    secret = get_secret_value_response['SecretString']
-    secret = json.loads(secret)
-
-    return secret
-
- 
-def make_api_request(url, params, max_retries=5, initial_delay=1):
+def make_api_request(url, params, max_retries=5, initial_delay=1, extra_headers=None, raw=False):
     """
     Realiza una solicitud a la API con manejo de reintentos y límites de tasa.
+    Con `raw` devuelve la respuesta completa (200 o 304) en lugar del JSON,
+    como necesita la caché para guardar ETag/Last-Modified.
     """
     CLAVE_API = get_secret('tfm-ucm').get('openaq')
     headers = {'X-API-Key': CLAVE_API,
         'accept': 'application/json',
-        'content-type': 'application/json'}
+        'content-type': 'application/json',
+        **(extra_headers or {})}
         
     for attempt in range(max_retries):
+        openaq_rate_limiter.acquire()
         try:
-            response = requests.get(url, params=params, headers=headers)
-
-            # Imprimir cabeceras de límite de tasa para depuración (opcional)
-            # print(f"Headers: x-ratelimit-remaining={response.headers.get('x-ratelimit-remaining')}, x-ratelimit-reset={response.headers.get('x-ratelimit-reset')}")
+            with timed('api_request', api='openaq', endpoint=endpoint_of(url), attempt=attempt) as call:
+                response = get_session().get(url, params=params, headers=headers)
+                call.update(status=response.status_code, bytes=len(response.content))
+            openaq_rate_limiter.update(response.headers)
 
             if response.status_code == 200:
-                return response.json()
+                return response if raw else response.json()
+            elif response.status_code == 304 and raw:
+                return response
             elif response.status_code == 410:
                 print(
-                    f"Error 410 Gone: Versión de la API retirada. usar /v3/. Detalles: {response.text}")[2]
+                    f"Error 410 Gone: Versión de la API retirada. usar /v3/. Detalles: {response.text}")
                 return None
             elif response.status_code == 429:
                 reset_time = int(response.headers.get('x-ratelimit-reset', 60))
                 print(
                     f"Error 429 Too Many Requests: Límite de tasa excedido. \
                     Esperando {reset_time} segundos antes de reintentar.")
-                time.sleep(reset_time + 1)  # Esperar el tiempo de reseteo + 1 segundo
+                # El limitador detiene al resto de hilos hasta el reseteo
+                openaq_rate_limiter.block_until_reset(reset_time)
             else:
                 print(
                     f"Error al descargar datos (Intento {attempt + 1}/{max_retries}): {response.status_code} - {response.text}")
+                record('backoff_sleep', api='openaq', reason=response.status_code, sleep_s=initial_delay * (2 ** attempt))
                 time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial [3, 4]
         except requests.exceptions.RequestException as e:
+            openaq_rate_limiter.update()
             print(f"Error de conexión (Intento {attempt + 1}/{max_retries}): {e}")
+            record('backoff_sleep', api='openaq', reason=type(e).__name__, sleep_s=initial_delay * (2 ** attempt))
             time.sleep(initial_delay * (2 ** attempt))  # Retroceso exponencial
     print(f"Fallo después de {max_retries} reintentos para URL: {url} con params: {params}")
     return None
 
 
+def cached_api_request(url, params):
+    """
+    make_api_request a través de reference_cache. Devuelve (JSON, origen).
+    """
+    return reference_cache.fetch(
+        url, params, lambda headers: make_api_request(url, params, extra_headers=headers, raw=True))
+
+
 #============= Parametros de medicion ============
 
 
 def get_parameters():
-    parameters_base_url = 'https://api.openaq.org/v3/parameters'
+    """
+    Devuelve (catálogo de parámetros, True si ha cambiado respecto a la caché).
+    Si la caché devuelve una entrada sin resultados se pide de nuevo a la API;
+    si tampoco la API lo devuelve se lanza RuntimeError.
+    """
+    parameters_base_url = f'{OPENAQ_BASE_URL}/v3/parameters'
     params = {"limit": 1000}
-    data = make_api_request(parameters_base_url, params)
-    if data and 'results' in data:
-        return data
+    data, source = cached_api_request(parameters_base_url, params)
+    if data is not None and 'results' not in data:
+        print("La caché de parámetros no tiene resultados: se piden a la API.")
+        data, source = make_api_request(parameters_base_url, params), NETWORK
+    if not data or 'results' not in data:
+        raise RuntimeError(f"No se pudo obtener el catálogo de parámetros de {parameters_base_url}")
+    return data, source == NETWORK
 
 
 
 def get_locations_in_country(country_code="ES", limit=1000):
     """
     Obtiene todas las ubicaciones (y sus sensores) para un país dado, manejando la paginación.
+    Devuelve (ubicaciones, True si alguna página ha cambiado respecto a la caché).
     """
-    locations_base_url = "https://api.openaq.org/v3/locations"
-    all_locations = []
-    current_page = 1
-    total_pages = 1
-    page_limit = limit
+    locations_base_url = f"{OPENAQ_BASE_URL}/v3/locations"
+    sources = []
 
+    def fetch_page(page):
+        params = {"iso": country_code, "limit": limit, "page": page}
+        data, source = cached_api_request(locations_base_url, params)
+        sources.append(source)
+        return data
 
     print(f"Obteniendo ubicaciones para {country_code}...")
-    while current_page <= total_pages:
-
-        # params = {"iso": country_code, "limit": limit,"page": current_page}
-        params = {"iso": "ES", "limit": limit}
-
-        data = make_api_request(locations_base_url, params)
+    locations = paginate(fetch_page, limit, max_workers=PAGE_WORKERS)
+    return locations, NETWORK in sources
 
-        if data and 'results' in data:
-            locations_page = data['results']
-            all_locations.extend(locations_page)
 
-            total_results = data['meta'].get('found', 0)
-            if total_results == '>1000':
-                total_pages +=1
-            else:
-                total_pages = (total_results + page_limit - 1) // page_limit
-
-            page_limit = data['meta'].get('limit', limit)
-            print(f"Total de ubicaciones encontradas: {total_results}. Total de páginas estimadas: {total_pages}")
 
-            current_page += 1
-            time.sleep(0.5)  # Pequeña pausa entre solicitudes de página [1]
+def prune_sensors(locations_df, start_date, end_date, watermarks):
+    """
+    Separa los sensores que pueden tener datos nuevos en la ventana
+    [start_date, end_date] de los que no, según el datetimeFirst/datetimeLast
+    de su ubicación y su marca de agua (último dato ya ingerido).
+    Devuelve (IDs a descargar, {ID descartado: motivo}).
+
+    datetimeLast es el de la ubicación, nunca anterior al de sus sensores, así
+    que un sensor solo se descarta si ninguno de la ubicación puede tener datos.
+    Con el catálogo en caché puede llegar con hasta `reference_cache_ttl` de
+    retraso: un sensor que reanuda el envío se recoge en la siguiente ejecución.
+    """
+    locations_df = locations_df.dropna(subset=['sensor_id'])
+    history = pd.DataFrame({
+        'sensor_id': locations_df['sensor_id'].astype('Int64').astype(str),
+        'first': pd.to_datetime(locations_df['datetimeFirst'], utc=True, errors='coerce'),
+        'last': pd.to_datetime(locations_df['datetimeLast'], utc=True, errors='coerce'),
+    }).groupby('sensor_id').agg({'first': 'min', 'last': 'max'})
+
+    start = pd.Timestamp(to_utc_iso(start_date))
+    end = pd.Timestamp(to_utc_iso(end_date))
+    to_fetch, skipped = [], {}
+    for sensor_id, first, last in history.itertuples():
+        if pd.isnull(last):
+            skipped[sensor_id] = SIN_DATOS
+        elif last < start:
+            skipped[sensor_id] = TERMINA_ANTES
+        elif pd.notnull(first) and first > end:
+            skipped[sensor_id] = EMPIEZA_DESPUES
+        elif sensor_id in watermarks and pd.Timestamp(watermarks[sensor_id]) >= min(last, end):
+            skipped[sensor_id] = AL_DIA
         else:
-            print(
-                f"No se obtuvieron datos de ubicaciones en la página {current_page}. Terminando la búsqueda de ubicaciones.")
-            break  # Salir si no hay datos o hay un error irrecuperable
+            to_fetch.append(sensor_id)
+    return to_fetch, skipped
 
-    return all_locations
 
-
-
-def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
+def put_s3_object(s3_path, df, schema=None):
     """
-    Esta funcion recibe un dataframe y lo carga en s3 particionado
-    por las columnas indicadas en partition_list
+    Esta funcion recibe un dataframe y lo carga en s3 como un único fichero
+    parquet, sustituyendo al anterior
     :param
         s3_path: path s3 donde se va a cargar
         df: Dataframe
-        partition_cols: lista de columnas por las cuales particionar
+        schema: esquema de tfm_common.schemas con los tipos de cada columna
     :return:
     """
-
-    if partition_cols is not None:
-        resultado = wr.s3.to_parquet(
-            df=df,
-            path=s3_path,
-            dataset=True,  # ¡Esta es la clave para habilitar el particionamiento!
-            partition_cols=partition_cols,
-            mode= "append", # "overwrite_partitions"
-            compression="snappy",
-            filename_prefix=prefix
-        )
-    else:
-        resultado = wr.s3.to_parquet(
-            df=df
-            , path=s3_path
-            # , mode='overwrite'
-        )
-
-    print(f"Resultado de carga en S3: {resultado}")
+    # pyarrow y el cliente de S3 compartido en lugar de awswrangler (ver tfm_common.parquet)
+    resultado = write_parquet(s3_path, df, schema=schema)
 
     return resultado
 
 
 # --- Función Handler para AWS Lambda ---
+@instrument_handler
 def lambda_handler(event, context):
     print("Iniciando ejecución de la función Lambda para descargar lista de sensores disponibles en España...")
 
@@ -172,17 +200,26 @@ def lambda_handler(event, context):
     country_code = os.getenv('country_code', 'ES')
     start_date = os.getenv('start_date', "2024-01-01T00:00:00Z")
     end_date = os.getenv('end_date', datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z'))
+    full_refresh = os.getenv('full_refresh', 'false').lower() in ('true', '1')
+    prune = os.getenv('prune_sensors', 'true').lower() in ('true', '1')
 
     # ======================== Parameters & Locations (Sin cambios) ========================
     # Esta parte generalmente no consume mucha memoria, la dejamos como está.
 
-    # ... (el código para obtener y cargar 'parameters' se queda igual) ...
-    parameters_df = pd.DataFrame(get_parameters()['results'])
-    put_s3_object(s3_path=f'{bucket_name}/staging/OpenAQ/parameters/parameters.parquet', df=parameters_df)
+    # Los catálogos solo se vuelven a subir si la API devolvió algo distinto de
+    # lo que había en caché (o si el fichero aún no existe)
+    phase('fetch')
+    parameters, parameters_changed = get_parameters()
+    parameters_path = join_uri(bucket_name, 'staging/OpenAQ/parameters/parameters.parquet')
+    if parameters_changed or size_of(parameters_path) is None:
+        parameters_df = pd.DataFrame(parameters['results'])
+        put_s3_object(s3_path=parameters_path, df=parameters_df, schema=OPENAQ_PARAMETERS)
+    else:
+        print("Parámetros sin cambios: no se vuelven a subir.")
 
 
-    # ... (el código para obtener y cargar 'locations' se queda igual) ...
-    spain_locations = get_locations_in_country(country_code=country_code)
+    spain_locations, locations_changed = get_locations_in_country(country_code=country_code)
+    phase('transform')
     spain_locations_df = pd.DataFrame(spain_locations)
     # ... (todas tus transformaciones de spain_locations_df se quedan igual) ...
     spain_locations_df['country'] = spain_locations_df['country'].apply(lambda x: x.get('name'))
@@ -199,10 +236,43 @@ def lambda_handler(event, context):
     spain_locations_df.drop(
         columns=['owner', 'provider', 'isMobile', 'instruments', 'sensors', 'licenses', 'distance',
                  'coordinates'], inplace=True)
-    put_s3_object(f'{bucket_name}/staging/OpenAQ/locations/locations.parquet', df=spain_locations_df)
+    phase('write')
+    locations_path = join_uri(bucket_name, 'staging/OpenAQ/locations/locations.parquet')
+    if locations_changed or size_of(locations_path) is None:
+        put_s3_object(locations_path, df=spain_locations_df, schema=OPENAQ_LOCATIONS)
+    else:
+        print("Ubicaciones sin cambios: no se vuelven a subir.")
     
-    sensor_ids_to_fetch = set(spain_locations_df.sensor_id)
-    sensor_ids_to_fetch = [str(sensor_id) for sensor_id in sensor_ids_to_fetch]
-    print(f"Se encontraron {len(sensor_ids_to_fetch)} IDs de sensores únicos.")
-
-    return sensor_ids_to_fetch[:5]
+    # ======================== Sensores a descargar ========================
+    # Solo se envían al Map los sensores que pueden tener datos nuevos; el motivo
+    # de cada descarte queda en state/{OPENAQ_DATASET}/pruned_sensors.json
+    phase('prune')
+    if prune:
+        watermark_store = WatermarkStore(join_uri(bucket_name, 'state', OPENAQ_DATASET, 'watermarks'))
+        watermarks = {} if full_refresh else watermark_store.load()
+        sensor_ids_to_fetch, skipped = prune_sensors(spain_locations_df, start_date, end_date, watermarks)
+    else:
+        sensor_ids_to_fetch = sorted({str(sensor_id) for sensor_id in spain_locations_df.sensor_id.dropna()})
+        skipped = {}
+    reasons = {}
+    for reason in skipped.values():
+        reasons[reason] = reasons.get(reason, 0) + 1
+    write_bytes(join_uri(bucket_name, 'state', OPENAQ_DATASET, 'pruned_sensors.json'), json.dumps({
+        'start_date': start_date,
+        'end_date': end_date,
+        'full_refresh': full_refresh,
+        'sensors_to_fetch': len(sensor_ids_to_fetch),
+        'reasons': reasons,
+        'skipped': skipped,
+    }, sort_keys=True).encode('utf-8'))
+
+    print(f"Se encontraron {len(sensor_ids_to_fetch) + len(skipped)} IDs de sensores únicos: "
+          f"{len(sensor_ids_to_fetch)} a descargar, {len(skipped)} descartados {reasons}.")
+    print(f"Estadísticas de clientes: {get_stats()}")
+    print(f"Estadísticas de la caché de referencia: {reference_cache.stats()}")
+    annotate(sensors=len(sensor_ids_to_fetch), sensors_skipped=len(skipped),
+             **{f'skipped_{reason}': count for reason, count in reasons.items()},
+             parameters_changed=parameters_changed, locations_changed=locations_changed,
+             **{f'cache_{k}': v for k, v in reference_cache.stats().items()})
+
+    return sensor_ids_to_fetch
@@ -1,12 +1,22 @@
 import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-import awswrangler as wr
-import boto3
+from tfm_common.clients import get_session, get_stats
+from tfm_common.parquet import write_parquet
+from tfm_common.storage import join_uri
+from tfm_common.schemas import REE_VALUES
+from tfm_common.profiling import phase
+from tfm_common.telemetry import annotate, instrument_handler, timed
 import json
 import os
 
-def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
+HEADERS = {'Accept': 'application/json',
+           'Content-Type': 'application/json',
+           'Host': 'apidatos.ree.es'}
+BASE_URI = os.getenv('ree_base_url', 'https://apidatos.ree.es').rstrip('/')
+
+def put_s3_object(s3_path, df, partition_cols=None, prefix=None, schema=None):
     """
     Esta funcion recibe un dataframe y lo carga en s3 particionado
     por las columnas indicadas en partition_list
@@ -14,92 +24,139 @@ def put_s3_object(s3_path, df, partition_cols=None, prefix=None):
         s3_path: path s3 donde se va a cargar
         df: Dataframe
         partition_cols: lista de columnas por las cuales particionar
+        schema: esquema de tfm_common.schemas con los tipos de cada columna
     :return:
     """
+    # pyarrow y el cliente de S3 compartido en lugar de awswrangler (ver tfm_common.parquet)
+    resultado = write_parquet(
+        s3_path,
+        df,
+        partition_cols=partition_cols,
+        # Cada mes tocado se reescribe con sus filas y las nuevas, una por
+        # (serie_id, datetime): un reintento o un rango que empieza a mitad
+        # de mes no duplica ni pierde filas
+        mode="upsert",
+        filename_prefix=prefix,
+        schema=schema
+    )
+
+    return resultado
+
+def get_month_windows(fecha_ini, fecha_fin):
+    """
+    Divide el rango en ventanas mensuales: respetan el límite de la API (1 año
+    con time_trunc=day, 1 mes con time_trunc=hour) y coinciden con las
+    particiones year/month de la salida.
+    """
+    ventanas = []
+    actual_inicio = fecha_ini
+    while actual_inicio <= fecha_fin:
+        siguiente_mes = (actual_inicio.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0)
+        actual_fin = min(siguiente_mes - timedelta(minutes=1), fecha_fin)
+        ventanas.append((actual_inicio, actual_fin))
+        actual_inicio = siguiente_mes
+    return ventanas
 
-    if partition_cols is not None:
-        resultado = wr.s3.to_parquet(
-            df=df,
-            path=s3_path,
-            dataset=True,  # ¡Esta es la clave para habilitar el particionamiento!
-            partition_cols=partition_cols,
-            mode="overwrite_partitions",
-            compression="snappy",
-            filename_prefix=prefix
-        )
+
+def get_window(event, now):
+    """
+    Rango a descargar. Por defecto se refresca solo la ventana actual: desde el
+    primer día del mes de (hoy - dias_ventana) hasta hoy, para que se reescriban
+    meses completos. Con `full_refresh` (evento o entorno) se usa el rango
+    completo fecha_ini - fecha_fin; el evento también puede fijar ambas fechas.
+    """
+    event = event if isinstance(event, dict) else {}
+    fecha_fin = pd.to_datetime(event.get('fecha_fin') or os.getenv('fecha_fin') or now)
+    full_refresh = event.get('full_refresh', os.getenv('full_refresh', 'false').lower() in ('true', '1'))
+    if event.get('fecha_ini') or full_refresh:
+        fecha_ini = pd.to_datetime(event.get('fecha_ini') or os.getenv('fecha_ini', '2024-01-01'))
     else:
-        resultado = wr.s3.to_parquet(
-            df=df
-            , path=s3_path
-            # , mode='overwrite'
-        )
+        dias_ventana = int(os.getenv('dias_ventana', 2))
+        fecha_ini = (fecha_fin - timedelta(days=dias_ventana)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return fecha_ini.tz_localize(None).to_pydatetime(), fecha_fin.tz_localize(None).to_pydatetime()
 
-    return resultado
 
-def lambda_handler(event, context):
+def fetch_window(uri_definition, time_trunc, inicio, fin):
+    """
+    Descarga una ventana y devuelve las filas de todas las series de `included`
+    o None si la petición falla.
+    """
+    params = {
+        'start_date': inicio.strftime('%Y-%m-%dT%H:%M'),
+        'end_date': fin.strftime('%Y-%m-%dT%H:%M'),
+        'time_trunc': time_trunc,
+    }
+    try:
+        with timed('api_request', api='ree', endpoint=uri_definition) as call:
+            response = get_session().get(f'{BASE_URI}{uri_definition}', params=params, headers=HEADERS, timeout=30)
+            call.update(status=response.status_code, bytes=len(response.content))
+    except requests.exceptions.RequestException as e:
+        print(f"Error de red en la ventana {params['start_date']} - {params['end_date']}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
 
-    headers = {'Accept': 'application/json',
-    'Content-Type': 'application/json',
-    'Host': 'apidatos.ree.es'}
+    rows = []
+    for serie in response.json().get('included', []):
+        attributes = serie.get('attributes', {})
+        for value in attributes.get('values', []):
+            if value.get('value') is not None:
+                rows.append({'serie_id': serie.get('id'), 'serie': attributes.get('title'), **value})
+    print(f"Ventana {params['start_date']} - {params['end_date']}: {len(rows)} valores")
+    return rows
+
+
+@instrument_handler
+def lambda_handler(event, context):
 
-    fecha_ini = pd.to_datetime(os.getenv('fecha_ini'))
-    fecha_fin = pd.to_datetime(os.getenv('fecha_fin'))
-    time_trunc = os.getenv('time_trunc')
-    base_uri = 'https://apidatos.ree.es'
+    time_trunc = os.getenv('time_trunc', 'day')
     uri_definition = os.getenv('uri_definition')
     bucket_name = os.getenv('bucket_name')
+    max_workers = int(os.getenv('max_workers', 4))
 
-    api_uri = f'{base_uri}{uri_definition}?\
-    start_date={fecha_ini}&\
-    end_date={fecha_fin}&\
-    time_trunc={time_trunc}'
-
-    # Calculamos los dias entre periodos para no exceder el lmite de la API de 1 año
-    bloques = []
-    if (fecha_fin - fecha_ini).days > 365:
-        actual_inicio = fecha_ini
-        while actual_inicio < fecha_fin:
-            # Último día del año actual
-            actual_fin = datetime(actual_inicio.year, 12, 31, 23, 59, 59)
-            # Si el último día del año es mayor que fecha_fin, usamos fecha_fin
-            if actual_fin > fecha_fin:
-                actual_fin = fecha_fin
-            bloques.append((actual_inicio, actual_fin))
-            # Siguiente bloque: primer día del siguiente año
-            actual_inicio = datetime(actual_inicio.year + 1, 1, 1)
-    else:
-        bloques.append((fecha_inicio, fecha_fin))
-
-    all_data = {}
-    for inicio, fin in bloques:
-        print(f"Inicio: {inicio.strftime('%Y-%m-%d')}, Fin: {fin.strftime('%Y-%m-%d')}")
-        api_uri = f'{base_uri}{uri_definition}?\
-            start_date={inicio}&\
-            end_date={fin}&\
-            time_trunc={time_trunc}'
-        
-        response = requests.get(api_uri, headers= headers)
-        if response.status_code == 200:
-            data = response.json()
-            if len(all_data)==0:
-                all_data.update(data)
-            else:
-                all_data = data.copy()
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            continue
-
-    df = pd.DataFrame([x for x in all_data['included'][0]['attributes']['values'] if x['value'] is not None])
-    s3_path = f"s3://{bucket_name}/staging/ree/consumo_energetico_2024_2025.parquet"
+    fecha_ini, fecha_fin = get_window(event, datetime.now())
+    ventanas = get_month_windows(fecha_ini, fecha_fin)
+    print(f"Descargando {fecha_ini} - {fecha_fin} en {len(ventanas)} ventanas con {max_workers} hilos...")
+
+    # Las ventanas se piden en paralelo sobre la sesión HTTP compartida
+    phase('fetch')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda ventana: fetch_window(uri_definition, time_trunc, *ventana), ventanas))
+
+    failed_windows = [f"{inicio:%Y-%m}" for (inicio, _), rows in zip(ventanas, results) if rows is None]
+    all_rows = [row for rows in results if rows for row in rows]
+    if not all_rows:
+        print("No se obtuvieron datos de REE.")
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Sin datos de REE'),
+            'failed_windows': failed_windows
+        }
+
+    phase('transform')
+    df = pd.DataFrame(all_rows).drop_duplicates(subset=['serie_id', 'datetime'], keep='last')
+    # year/month según la hora local de REE, que es la del propio valor
+    fecha_local = pd.to_datetime(df['datetime'].str.slice(0, 19))
+    df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
+    df['year'] = fecha_local.dt.year
+    df['month'] = fecha_local.dt.month
+
+    # Solo se reescriben los meses descargados; las ventanas fallidas no
+    # aportan filas y sus particiones quedan como estaban
+    phase('write')
+    s3_path = join_uri(bucket_name, 'staging/ree/consumo_energetico')
     put_s3_object(s3_path
                   , df
-                #   , partition_cols=['year', 'month', 'day']
-                #   , prefix='measure'
+                  , partition_cols=['year', 'month']
+                  , schema=REE_VALUES
                   )
 
+    print(f"Estadísticas de clientes: {get_stats()}")
+    annotate(windows=len(ventanas), failed_windows=len(failed_windows), rows=len(df))
 
-    # TODO implement
     return {
         'statusCode': 200,
-        'body': json.dumps(f'Datos guardados en: {bucket_name}, df shape: {df.shape}')
+        'body': json.dumps(f'Datos guardados en: {s3_path}, df shape: {df.shape}'),
+        'failed_windows': failed_windows
     }
@@ -0,0 +1,6 @@
+"""
+Utilidades compartidas por las funciones Lambda del pipeline.
+
+Se despliega como Lambda Layer (ver `TfmCommonLayer` en template.yaml), por lo
+que cada función puede importar `tfm_common` sin copiar el código.
+"""
@@ -0,0 +1,177 @@
+"""
+Puntos de control de la ingesta de un lote de sensores, a nivel de página.
+
+Un lote guarda en `{uri}` (JSON en S3 o en local) qué páginas de cada
+ventana de cada sensor están ya escritas en un fichero de datos (segmento),
+qué ventanas están completas y qué segmentos se han publicado en un
+manifiesto. Una página solo cuenta como hecha cuando el segmento que la
+contiene está escrito: hasta entonces está "preparada" y se perdería con la
+invocación.
+
+El punto de control pertenece a una ejecución (`run_id`, p. ej. el Id de la
+ejecución de Step Functions): un reintento o una reanudación de la misma
+ejecución continúa donde se quedó, y una ejecución nueva del mismo lote
+empieza de cero y lo sustituye.
+"""
+import json
+import threading
+from datetime import datetime, timezone
+
+from tfm_common.storage import read_bytes, write_bytes
+
+
+class IngestCheckpoint:
+
+    def __init__(self, uri=None, run_id=None):
+        # Sin uri el estado solo vive en memoria (invocaciones sin run_id)
+        self.uri = uri
+        self.run_id = run_id
+        self.state = None
+        self.resumed = False
+        self._staged = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------ ciclo de vida
+    def load(self):
+        """
+        Recupera el estado guardado de la misma ejecución. Devuelve True si lo hay.
+        """
+        if not self.uri or not self.run_id:
+            return False
+        data = read_bytes(self.uri)
+        if not data:
+            return False
+        state = json.loads(data)
+        if state.get('run_id') != self.run_id:
+            return False
+        self.state = state
+        self.resumed = True
+        return True
+
+    def start(self, name, ranges, end_date, ingest_date):
+        """
+        Estado nuevo: nombre base de los ficheros, rango pedido de cada sensor y
+        fecha de ingesta (la partición de los ficheros de todas las invocaciones).
+        """
+        self.state = {
+            'run_id': self.run_id,
+            'name': name,
+            'end_date': end_date,
+            'ingest_date': ingest_date,
+            'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'attempts': 0,
+            'ranges': dict(ranges),
+            'sensors': {},
+            'segments': [],
+            'manifests': 0,
+        }
+
+    def save(self):
+        if not self.uri or not self.run_id:
+            return
+        with self._lock:
+            data = json.dumps(self.state, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        write_bytes(self.uri, data)
+
+    # --------------------------------------------------------------- consultas
+    def _sensor(self, sensor_id):
+        return self.state['sensors'].setdefault(sensor_id, {'windows': {}, 'rows': 0, 'watermark': None,
+                                                            'watermark_committed': False})
+
+    def _window(self, sensor_id, window_key):
+        return self._sensor(sensor_id)['windows'].setdefault(window_key, {'pages': [], 'meta': None,
+                                                                          'complete': False})
+
+    def window(self, sensor_id, window_key):
+        """
+        (páginas ya escritas, meta de la página 1, completa) de una ventana.
+        """
+        with self._lock:
+            window = self._window(sensor_id, window_key)
+            return set(window['pages']), window['meta'], window['complete']
+
+    def sensor_complete(self, sensor_id, window_keys):
+        with self._lock:
+            windows = self.state['sensors'].get(sensor_id, {}).get('windows', {})
+            return all(windows.get(key, {}).get('complete') for key in window_keys)
+
+    def sensor(self, sensor_id):
+        with self._lock:
+            return dict(self.state['sensors'].get(sensor_id) or {})
+
+    # ------------------------------------------------------------ progreso
+    def stage_page(self, sensor_id, window_key, page, rows, watermark, meta=None):
+        """
+        Anota una página escrita en el segmento en curso (aún no persistida).
+        """
+        with self._lock:
+            staged = self._staged.setdefault((sensor_id, window_key), {'pages': [], 'rows': 0, 'watermark': None,
+                                                                       'meta': None, 'complete': False})
+            staged['pages'].append(page)
+            staged['rows'] += rows
+            if watermark and (staged['watermark'] is None or watermark > staged['watermark']):
+                staged['watermark'] = watermark
+            if meta is not None:
+                staged['meta'] = meta
+
+    def stage_window_complete(self, sensor_id, window_key, meta=None):
+        """
+        La ventana no tiene más páginas: queda completa al escribirse el segmento en curso.
+        """
+        with self._lock:
+            staged = self._staged.setdefault((sensor_id, window_key), {'pages': [], 'rows': 0, 'watermark': None,
+                                                                       'meta': None, 'complete': False})
+            staged['complete'] = True
+            if meta is not None:
+                staged['meta'] = meta
+
+    def commit_segment(self, entry):
+        """
+        El segmento en curso se ha escrito (`entry` con uri, rows y bytes, o
+        None si no tenía filas): sus páginas pasan a estar hechas.
+        """
+        with self._lock:
+            staged, self._staged = self._staged, {}
+            if entry is not None:
+                self.state['segments'].append(dict(entry, published=False))
+            for (sensor_id, window_key), progress in staged.items():
+                sensor = self._sensor(sensor_id)
+                window = self._window(sensor_id, window_key)
+                window['pages'] = sorted(set(window['pages']) | set(progress['pages']))
+                window['meta'] = window['meta'] or progress['meta']
+                window['complete'] = window['complete'] or progress['complete']
+                sensor['rows'] += progress['rows']
+                if progress['watermark'] and (sensor['watermark'] is None
+                                              or progress['watermark'] > sensor['watermark']):
+                    sensor['watermark'] = progress['watermark']
+        self.save()
+
+    def next_segment_index(self):
+        with self._lock:
+            return len(self.state['segments'])
+
+    def take_unpublished(self):
+        """
+        Segmentos escritos que aún no están en ningún manifiesto; se marcan como publicados.
+        """
+        with self._lock:
+            segments = [segment for segment in self.state['segments'] if not segment['published']]
+            for segment in segments:
+                segment['published'] = True
+            index = self.state['manifests']
+            if segments:
+                self.state['manifests'] += 1
+        return [{key: segment[key] for key in ('uri', 'rows', 'bytes')} for segment in segments], index
+
+    def take_watermarks(self, complete_sensors):
+        """
+        Marcas de agua de los sensores completos que aún no se han confirmado.
+        """
+        with self._lock:
+            watermarks = {}
+            for sensor_id in complete_sensors:
+                sensor = self.state['sensors'].get(sensor_id)
+                if sensor and sensor['watermark'] and not sensor['watermark_committed']:
+                    watermarks[sensor_id] = sensor['watermark']
+                    sensor['watermark_committed'] = True
+            return watermarks
@@ -0,0 +1,152 @@
+"""
+Clientes reutilizables entre invocaciones en caliente de una misma Lambda.
+
+Todo lo que se crea aquí vive a nivel de módulo, de modo que una invocación
+en caliente reutiliza los secretos ya descargados, los clientes de boto3 y las
+conexiones HTTP abiertas en invocaciones anteriores.
+"""
+import json
+import os
+import threading
+import time
+
+import boto3
+import requests
+from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tfm_common.telemetry import timed
+
+REGION_NAME = os.getenv('secrets_region', 'us-east-1')
+SECRET_TTL_SECONDS = int(os.getenv('secret_ttl_seconds', 900))
+HTTP_POOL_SIZE = int(os.getenv('http_pool_size', 16))
+
+_lock = threading.Lock()
+_secrets = {}
+_clients = {}
+_boto3_session = None
+_http_session = None
+_stats = {
+    'secret_cache_hits': 0,
+    'secret_cache_misses': 0,
+    'boto3_clients_created': 0,
+    'boto3_clients_reused': 0,
+}
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def get_boto3_session():
+    """
+    Sesión de boto3 única por contenedor (también válida para awswrangler).
+    """
+    global _boto3_session
+    with _lock:
+        if _boto3_session is None:
+            _boto3_session = boto3.session.Session(region_name=REGION_NAME)
+        return _boto3_session
+
+
+def get_client(service_name):
+    """
+    Devuelve un cliente de boto3 cacheado a nivel de módulo por servicio.
+    """
+    session = get_boto3_session()
+    with _lock:
+        client = _clients.get(service_name)
+        if client is not None:
+            _stats['boto3_clients_reused'] += 1
+            return client
+        client = session.client(service_name=service_name)
+        _clients[service_name] = client
+        _stats['boto3_clients_created'] += 1
+        return client
+
+
+def get_secret(secret_name, ttl=SECRET_TTL_SECONDS):
+    """
+    Obtiene un secreto de Secrets Manager con caché en memoria de `ttl` segundos.
+    """
+    now = time.monotonic()
+    with _lock:
+        cached = _secrets.get(secret_name)
+        if cached is not None and cached[1] > now:
+            _stats['secret_cache_hits'] += 1
+            return cached[0]
+
+    _count('secret_cache_misses')
+    client = get_client('secretsmanager')
+    try:
+        with timed('secret_fetch', secret=secret_name):
+            get_secret_value_response = client.get_secret_value(
+                SecretId=secret_name
+            )
+    except ClientError as e:
+        # For a list of exceptions thrown, see
+        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
+        raise e
+
+    secret = json.loads(get_secret_value_response['SecretString'])
+    with _lock:
+        _secrets[secret_name] = (secret, now + ttl)
+    return secret
+
+
+def get_session():
+    """
+    Sesión HTTP compartida con keep-alive y reintentos a nivel de transporte.
+
+    Los reintentos de urllib3 cubren errores de conexión y 5xx; los 429 se dejan
+    pasar para que `make_api_request` aplique su propia espera por límite de tasa.
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def _http_pool_stats():
+    requests_sent = 0
+    connections_opened = 0
+    if _http_session is None:
+        return requests_sent, connections_opened
+    for adapter in set(_http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+    return requests_sent, connections_opened
+
+
+def get_stats():
+    """
+    Contadores acumulados en el contenedor: aciertos/fallos de la caché de
+    secretos, clientes de boto3 y reutilización de conexiones HTTP.
+    """
+    requests_sent, connections_opened = _http_pool_stats()
+    with _lock:
+        stats = dict(_stats)
+    stats['http_requests'] = requests_sent
+    stats['http_connections_opened'] = connections_opened
+    stats['http_connections_reused'] = max(requests_sent - connections_opened, 0)
+    return stats
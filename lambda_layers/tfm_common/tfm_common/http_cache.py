@@ -0,0 +1,173 @@
+"""
+Caché de respuestas JSON de la API para endpoints de referencia que cambian
+poco (catálogo de parámetros y ubicaciones de OpenAQ).
+
+Tiene dos niveles, ambos con la misma entrada por clave (URL + parámetros),
+guardada como JSON comprimido con gzip:
+
+- disco local (`/tmp` en Lambda): lo reutilizan las invocaciones en caliente
+  del mismo contenedor. Está acotado en bytes y expulsa primero las entradas
+  usadas hace más tiempo (LRU por fecha de modificación, que se actualiza en
+  cada acierto).
+- un prefijo (S3 o local) compartido entre invocaciones y contenedores. Solo
+  caduca por TTL: una entrada vencida se sobrescribe al refrescarla.
+
+Una entrada dentro de su TTL se sirve sin llamar a la API. Si ha vencido y la
+API dio `ETag` o `Last-Modified`, se revalida con una petición condicional: un
+304 renueva la entrada sin descargar el cuerpo. Si la API falla se sirve la
+entrada vencida antes que nada.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from tfm_common.storage import read_bytes, write_bytes
+
+# Origen de una respuesta devuelta por `fetch`. Solo NETWORK indica un contenido
+# distinto del que ya había en caché (UNCHANGED: descargado de nuevo, pero igual)
+LOCAL, SHARED, REVALIDATED, UNCHANGED, NETWORK, STALE = \
+    'local', 'shared', 'revalidated', 'unchanged', 'network', 'stale'
+
+
+def cache_key(url, params=None):
+    canonical = json.dumps({'url': url, 'params': params or {}}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caché de dos niveles; una instancia a nivel de módulo conserva sus
+    estadísticas entre invocaciones en caliente.
+    """
+
+    def __init__(self, shared_prefix=None, local_dir='/tmp/http_cache', ttl=86400,
+                 max_local_bytes=64 * 1024 * 1024):
+        self.shared_prefix = shared_prefix.rstrip('/') if shared_prefix else None
+        self.local_dir = local_dir
+        self.ttl = ttl
+        self.max_local_bytes = max_local_bytes
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'shared_hits': 0, 'revalidated': 0, 'misses': 0, 'stale_served': 0,
+                       'evictions': 0}
+
+    # ------------------------------------------------------------ niveles
+    def _local_path(self, key):
+        return os.path.join(self.local_dir, f'{key}.json.gz')
+
+    def _read_local(self, key):
+        path = self._local_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(gzip.decompress(f.read()))
+        except (OSError, ValueError, EOFError):
+            return None
+        os.utime(path)  # uso reciente para el LRU
+        return entry
+
+    def _write_local(self, key, data):
+        os.makedirs(self.local_dir, exist_ok=True)
+        path = self._local_path(key)
+        tmp_path = f'{path}.tmp-{threading.get_ident()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        """
+        Borra las entradas locales menos usadas hasta quedar por debajo de max_local_bytes.
+        """
+        with self._lock:
+            entries = []
+            for item in os.scandir(self.local_dir):
+                if item.name.endswith('.json.gz'):
+                    stat = item.stat()
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_local_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self._stats['evictions'] += 1
+
+    def _read_shared(self, key):
+        if not self.shared_prefix:
+            return None
+        data = read_bytes(f'{self.shared_prefix}/{key}.json.gz')
+        return json.loads(gzip.decompress(data)) if data else None
+
+    def _store(self, key, entry, shared=True):
+        data = gzip.compress(json.dumps(entry, separators=(',', ':')).encode('utf-8'))
+        self._write_local(key, data)
+        if shared and self.shared_prefix:
+            write_bytes(f'{self.shared_prefix}/{key}.json.gz', data)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    # -------------------------------------------------------------- API
+    def is_fresh(self, entry, now=None):
+        return (now or time.time()) - entry['stored_at'] < self.ttl
+
+    def fetch(self, url, params, request):
+        """
+        Devuelve (respuesta JSON, origen). `request(headers)` hace la petición
+        con las cabeceras condicionales indicadas y devuelve el
+        `requests.Response` (200 o 304) o None si falla.
+        """
+        key = cache_key(url, params)
+        entry = self._read_local(key)
+        if entry is not None and self.is_fresh(entry):
+            self._count('local_hits')
+            return entry['body'], LOCAL
+
+        shared = self._read_shared(key)
+        if shared is not None and (entry is None or shared['stored_at'] > entry['stored_at']):
+            entry = shared
+            if self.is_fresh(entry):
+                self._store(key, entry, shared=False)
+                self._count('shared_hits')
+                return entry['body'], SHARED
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = request(headers)
+        if response is None:
+            if entry is None:
+                return None, NETWORK
+            self._count('stale_served')
+            return entry['body'], STALE
+        if response.status_code == 304 and entry is not None:
+            entry['stored_at'] = time.time()
+            self._store(key, entry)
+            self._count('revalidated')
+            return entry['body'], REVALIDATED
+
+        body = response.json()
+        source = UNCHANGED if entry is not None and entry['body'] == body else NETWORK
+        self._store(key, {
+            'url': url,
+            'params': params,
+            'stored_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body': body,
+        })
+        self._count('misses')
+        return body, source
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
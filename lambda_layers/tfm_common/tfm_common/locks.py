@@ -0,0 +1,69 @@
+"""
+Bloqueo de un único escritor sobre un objeto (S3 o local) con caducidad.
+
+El bloqueo es un objeto pequeño que se crea solo si no existe
+(`storage.create_exclusive`) con un token propio y la hora a la que caduca.
+Quien lo encuentra ocupado espera hasta `wait_s` segundos; si el del otro
+escritor ha caducado (la función que lo tenía se interrumpió sin liberarlo)
+lo borra y lo vuelve a intentar. Tras crearlo se relee para confirmar que el
+token es el propio.
+"""
+import json
+import time
+import uuid
+
+from tfm_common.storage import create_exclusive, delete_uri, read_bytes
+from tfm_common.telemetry import record
+
+
+class LockTimeout(RuntimeError):
+    pass
+
+
+class LeaseLock:
+
+    def __init__(self, uri, ttl_s=900, wait_s=120, poll_s=1.0):
+        self.uri = uri
+        self.ttl_s = ttl_s
+        self.wait_s = wait_s
+        self.poll_s = poll_s
+        self._body = None
+
+    def acquire(self):
+        """
+        Bloquea hasta tener el bloqueo; lanza LockTimeout si no se consigue en `wait_s`.
+        """
+        give_up_at = time.monotonic() + self.wait_s
+        waited = 0.0
+        while True:
+            body = json.dumps({'owner': uuid.uuid4().hex, 'expires_at': time.time() + self.ttl_s}).encode('utf-8')
+            if create_exclusive(self.uri, body) and read_bytes(self.uri) == body:
+                self._body = body
+                break
+            current = read_bytes(self.uri)
+            if current is None:
+                continue
+            if json.loads(current).get('expires_at', 0) < time.time():
+                print(f"Bloqueo caducado en {self.uri}: se libera")
+                delete_uri(self.uri)
+                continue
+            if time.monotonic() >= give_up_at:
+                raise LockTimeout(f"{self.uri} sigue ocupado tras {self.wait_s} s")
+            time.sleep(self.poll_s)
+            waited += self.poll_s
+        if waited:
+            record('lock_wait', uri=self.uri, sleep_s=round(waited, 3))
+
+    def release(self):
+        # Solo se borra si sigue siendo el propio (no ha caducado y otro lo ha tomado)
+        if self._body is not None and read_bytes(self.uri) == self._body:
+            delete_uri(self.uri)
+        self._body = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
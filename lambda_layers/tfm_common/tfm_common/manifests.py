@@ -0,0 +1,45 @@
+"""
+Manifiestos de los ficheros escritos en staging.
+
+Cada escritor publica `{prefijo}/_manifests/{nombre}.json` con el esquema
+declarado y la lista exacta de ficheros (URI, filas y bytes). Los consumidores
+(compactación y job de Glue) leen esos ficheros directamente, sin listar el
+prefijo de datos ni inferir el esquema.
+"""
+import json
+from datetime import datetime, timezone
+
+from tfm_common.storage import list_uris, read_bytes, write_bytes
+
+MANIFESTS_DIR = '_manifests'
+
+
+def manifest_uri(prefix_uri, name):
+    return f"{prefix_uri.rstrip('/')}/{MANIFESTS_DIR}/{name}.json"
+
+
+def publish_manifest(prefix_uri, name, schema, files, created_at=None):
+    """
+    Publica el manifiesto. `files` es una lista de {'uri', 'rows', 'bytes'}.
+    Un nombre determinista hace que un reintento sobrescriba el mismo manifiesto.
+    """
+    manifest = {
+        'name': name,
+        'created_at': created_at or datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'schema': schema,
+        'files': files,
+    }
+    uri = manifest_uri(prefix_uri, name)
+    write_bytes(uri, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    return uri
+
+
+def list_manifests(prefix_uri):
+    """
+    Devuelve [(uri, manifiesto)] de los manifiestos pendientes, del más antiguo al más reciente.
+    """
+    manifests = []
+    for uri, _ in list_uris(f"{prefix_uri.rstrip('/')}/{MANIFESTS_DIR}/"):
+        if uri.endswith('.json'):
+            manifests.append((uri, json.loads(read_bytes(uri) or b'{}')))
+    return sorted(manifests, key=lambda item: (item[1].get('created_at', ''), item[0]))
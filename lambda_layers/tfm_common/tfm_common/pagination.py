@@ -0,0 +1,118 @@
+"""
+Paginación concurrente de los endpoints de OpenAQ v3.
+
+La primera página se pide sola para conocer `meta.found` y `meta.limit`. Si
+`found` es un número, el resto de páginas se piden en paralelo; si es abierto
+(p. ej. '>1000') se piden por adelantado en ventanas de `max_workers` páginas
+hasta recibir una página vacía o incompleta. El presupuesto de peticiones lo
+controla el limitador de tasa que use `fetch_page`, no pausas fijas.
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_total_pages(meta, page_limit):
+    """
+    Número de páginas según `meta.found`, o None si el total es abierto ('>1000').
+    """
+    found = meta.get('found', 0)
+    if isinstance(found, str):
+        if not found.isdigit():
+            return None
+        found = int(found)
+    return max(math.ceil(found / page_limit), 1)
+
+
+def iter_pages(fetch_page, limit, max_workers=4, description='', max_pending=None, skip_pages=None, meta=None,
+               on_missing=None):
+    """
+    Genera (número de página, resultados) en orden.
+
+    :param
+        fetch_page: función que recibe el número de página y devuelve la
+            respuesta JSON de la API o None si la petición falló
+        limit: tamaño de página solicitado
+        max_workers: páginas en vuelo a la vez
+        description: texto para los mensajes de log
+        max_pending: páginas pedidas y aún no consumidas como máximo. Por
+            defecto, con total conocido se piden todas de una vez; al limitarlo
+            la memoria no depende del número de páginas
+        skip_pages: páginas ya procesadas (p. ej. en un punto de control) que
+            no se piden ni se devuelven; cuentan como páginas completas
+        meta: `meta` de la página 1 guardado junto a esas páginas; si se da y
+            la página 1 está en skip_pages tampoco se pide
+        on_missing: función que recibe el número de la página sin datos que
+            termina la descarga. Solo se llama con páginas que la paginación
+            necesitaba, no con las pedidas por adelantado tras la última
+    """
+    skip_pages = set(skip_pages or ())
+    first_results = None
+    if 1 not in skip_pages or meta is None:
+        data = fetch_page(1)
+        if not data or 'results' not in data:
+            print(f"{description}No se obtuvieron datos en la página 1. Terminando la descarga.")
+            if on_missing is not None:
+                on_missing(1)
+            return
+        meta = data.get('meta') or {}
+        first_results = data['results']
+        if 1 not in skip_pages:
+            yield 1, first_results
+
+    page_limit = meta.get('limit') or limit
+    total_pages = get_total_pages(meta, page_limit)
+    print(f"{description}Total de resultados encontrados: {meta.get('found')}. "
+          f"Total de páginas estimadas: {total_pages if total_pages is not None else 'abierto'}")
+    if total_pages == 1 or (first_results is not None and len(first_results) < page_limit):
+        return
+
+    window = max_workers if total_pages is None else max(total_pages - 1, 1)
+    if max_pending:
+        window = min(window, max(max_pending, 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        next_page = 2
+        current_page = 2
+        exhausted = False
+        while True:
+            while (not exhausted and len(pending) < window
+                   and (total_pages is None or next_page <= total_pages)):
+                if next_page not in skip_pages:
+                    pending[next_page] = executor.submit(fetch_page, next_page)
+                next_page += 1
+            if current_page in skip_pages:
+                current_page += 1
+                continue
+            if current_page not in pending:
+                break
+
+            data = pending.pop(current_page).result()
+            if not data or 'results' not in data:
+                print(f"{description}No se obtuvieron datos en la página {current_page}. "
+                      f"Terminando la descarga.")
+                if on_missing is not None:
+                    on_missing(current_page)
+                exhausted = True
+            else:
+                results = data['results']
+                if results:
+                    yield current_page, results
+                # En listados abiertos, la primera página incompleta marca el final
+                if total_pages is None and len(results) < page_limit:
+                    exhausted = True
+
+            if exhausted:
+                for future in pending.values():
+                    future.cancel()
+                break
+            current_page += 1
+
+
+def paginate(fetch_page, limit, max_workers=4, description=''):
+    """
+    Devuelve todos los resultados de todas las páginas en una única lista.
+    """
+    all_results = []
+    for _, results in iter_pages(fetch_page, limit, max_workers, description):
+        all_results.extend(results)
+    return all_results
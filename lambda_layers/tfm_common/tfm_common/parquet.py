@@ -0,0 +1,338 @@
+"""
+Lectura y escritura de parquet con pyarrow sobre tfm_common.storage.
+
+Sustituye a `wr.s3.to_parquet` / `wr.s3.read_parquet` en las Lambdas:
+awswrangler añade segundos de importación y mucha memoria en el arranque en
+frío para escribir, en la mayoría de funciones, un único fichero pequeño. Aquí
+se serializa en memoria y se sube con el cliente de S3 compartido de
+tfm_common.clients. pandas solo se importa si se recibe un DataFrame.
+
+Los datasets particionados siguen el formato de awswrangler (`col=valor/`,
+ficheros `{prefijo}{uuid}.snappy.parquet` sin las columnas de partición) para
+que Glue y los lectores existentes no noten el cambio.
+"""
+import io
+import os
+import threading
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from tfm_common.locks import LeaseLock
+from tfm_common.schemas import apply_schema, conform_table
+from tfm_common.storage import delete_uri, list_uris, open_output, read_bytes, size_of, write_bytes
+from tfm_common.telemetry import record, timed
+
+# Spark (Glue 3.0) no lee timestamps en nanosegundos
+TIMESTAMP_UNIT = 'us'
+# Espera máxima por el bloqueo de 'upsert' de otro escritor; el bloqueo caduca
+# a los 15 minutos, la duración máxima de una Lambda
+UPSERT_LOCK_WAIT_S = float(os.getenv('upsert_lock_wait_s', 120))
+UPSERT_LOCK_TTL_S = 900
+
+
+def to_table(data, schema=None):
+    """
+    Convierte un DataFrame de pandas o una tabla de Arrow a tabla de Arrow,
+    aplicando el esquema de tfm_common.schemas si se indica.
+    """
+    if isinstance(data, pa.Table):
+        if schema is None:
+            return data
+        if schema.get('strict', True):
+            return conform_table(data, schema)
+        data = data.to_pandas()
+    if schema is not None:
+        data = apply_schema(data, schema)
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+
+def serialize(table, compression='snappy'):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=compression, coerce_timestamps=TIMESTAMP_UNIT,
+                   allow_truncated_timestamps=True)
+    return buffer.getvalue()
+
+
+def _partition_values(table, partition_cols):
+    """
+    Combinaciones distintas de valores de las columnas de partición.
+    """
+    keys = table.select(partition_cols).group_by(partition_cols).aggregate([])
+    return keys.to_pylist()
+
+
+def _partition_filter(table, values):
+    mask = None
+    for name, value in values.items():
+        condition = pc.is_null(table[name]) if value is None else pc.equal(table[name], value)
+        mask = condition if mask is None else pc.and_(mask, condition)
+    return table.filter(mask)
+
+
+def deduplicate(table, key_cols):
+    """
+    Elimina las filas repetidas por `key_cols` quedándose con la última
+    aparición de cada clave; el resto de filas conserva su orden.
+    """
+    if table.num_rows == 0:
+        return table
+    keys = {}
+    for name in key_cols:
+        column = table[name]
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        keys[name] = column
+    keys['_row'] = pa.array(range(table.num_rows), pa.int64())
+    last_rows = pa.table(keys).group_by(list(key_cols)).aggregate([('_row', 'max')])
+    return table.filter(pc.is_in(keys['_row'], value_set=last_rows['_row_max']))
+
+
+def _align(table, like):
+    """
+    Ajusta una tabla leída de un fichero existente a las columnas y tipos de `like`.
+    """
+    columns = []
+    for field in like.schema:
+        if field.name not in table.column_names:
+            columns.append(pa.nulls(table.num_rows, field.type))
+            continue
+        column = table[field.name]
+        if pa.types.is_dictionary(column.type) and not pa.types.is_dictionary(field.type):
+            column = column.cast(column.type.value_type)
+        columns.append(column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=like.schema)
+
+
+def _merge_existing(table, uris, key_cols):
+    """
+    Une las filas de los ficheros `uris` con `table` y deja una fila por
+    clave; ante una clave repetida gana la de `table`.
+    """
+    existing = [_align(read_parquet(existing_uri), table) for existing_uri in uris]
+    return deduplicate(pa.concat_tables(existing + [table]), key_cols)
+
+
+def write_parquet(uri, data, partition_cols=None, mode='append', filename_prefix=None, schema=None,
+                  compression='snappy', key_cols=None):
+    """
+    Escribe `data` (DataFrame o tabla de Arrow) en `uri`.
+
+    Sin `partition_cols` escribe un único fichero en `uri`. Con ellas, `uri` es
+    la raíz del dataset y se escribe un fichero nuevo por partición; `mode`
+    admite 'append', 'overwrite_partitions' (sustituye las particiones que se
+    escriben), 'overwrite' (borra todo el dataset) y 'upsert'.
+
+    Con 'upsert' cada partición tocada (o el fichero, sin `partition_cols`) se
+    reescribe como un único fichero con sus filas y las nuevas, una por cada
+    clave `key_cols` (por defecto la `key` del esquema); ante una clave
+    repetida ganan las nuevas. Al sustituir una partición el fichero nuevo se
+    escribe antes de borrar los anteriores: un lector nunca ve la partición
+    vacía o a medias, y si la función se interrumpe entre medias el siguiente
+    'upsert' elimina el duplicado.
+
+    Los 'upsert' de un mismo dataset (o fichero) van en serie: cada uno toma
+    un bloqueo (`_upsert.lock` en la raíz, o `_{fichero}.upsert.lock` junto al
+    fichero; los lectores de Glue y Athena ignoran los nombres con `_`) y el
+    siguiente espera hasta `UPSERT_LOCK_WAIT_S` segundos, así que nunca se
+    pierden las filas de un escritor concurrente.
+
+    El cambio sigue sin ser atómico para los lectores: entre la escritura y
+    el borrado quien liste la partición ve los ficheros antiguos y el nuevo,
+    con las claves repetidas. Un intercambio atómico (directorio versionado y
+    un puntero a la versión vigente) exigiría que Glue y Athena resolvieran el
+    puntero en lugar de listar `col=valor/`, y queda fuera de esta función.
+
+    Devuelve, como awswrangler, {'paths': [...], 'partitions_values': {...}}.
+    """
+    key_cols = key_cols or (schema or {}).get('key')
+    if mode == 'upsert' and not key_cols:
+        raise ValueError("mode='upsert' necesita key_cols o un esquema con 'key'")
+    with timed('parquet_write', uri=uri, mode=mode) as call:
+        if mode == 'upsert':
+            with LeaseLock(_upsert_lock_uri(uri, partition_cols), ttl_s=UPSERT_LOCK_TTL_S,
+                           wait_s=UPSERT_LOCK_WAIT_S):
+                result = _write_parquet(uri, data, partition_cols, mode, filename_prefix, schema, compression,
+                                        key_cols, call)
+        else:
+            result = _write_parquet(uri, data, partition_cols, mode, filename_prefix, schema, compression,
+                                    key_cols, call)
+        call['files'] = len(result['paths'])
+    return result
+
+
+def _upsert_lock_uri(uri, partition_cols):
+    if partition_cols:
+        return uri.rstrip('/') + '/_upsert.lock'
+    parent, _, name = uri.rpartition('/')
+    return f'{parent}/_{name}.upsert.lock' if parent else f'_{name}.upsert.lock'
+
+
+def _write_parquet(uri, data, partition_cols, mode, filename_prefix, schema, compression, key_cols, call):
+    table = to_table(data, schema)
+    call['rows'] = table.num_rows
+    if not partition_cols:
+        if mode == 'upsert':
+            table = _merge_existing(table, [uri] if size_of(uri) is not None else [], key_cols)
+            call['rows'] = table.num_rows
+        body = serialize(table, compression)
+        call['bytes'] = len(body)
+        write_bytes(uri, body)
+        return {'paths': [uri], 'partitions_values': {}}
+
+    root = uri.rstrip('/')
+    if mode == 'overwrite':
+        for existing, _ in list_uris(root + '/'):
+            delete_uri(existing)
+
+    paths, partitions_values = [], {}
+    data_cols = [name for name in table.column_names if name not in partition_cols]
+    for values in _partition_values(table, partition_cols):
+        partition = root + '/' + '/'.join(f'{name}={values[name]}' for name in partition_cols) + '/'
+        replaced = []
+        partition_table = _partition_filter(table, values).select(data_cols)
+        if mode in ('overwrite_partitions', 'upsert'):
+            replaced = [existing for existing, _ in list_uris(partition)]
+        if mode == 'upsert':
+            partition_table = _merge_existing(partition_table, [existing for existing in replaced
+                                                                if existing.endswith('.parquet')], key_cols)
+            call['rows_merged'] = call.get('rows_merged', 0) + partition_table.num_rows
+        extension = f'.{compression}.parquet' if compression else '.parquet'
+        path = f"{partition}{filename_prefix or ''}{uuid.uuid4().hex}{extension}"
+        body = serialize(partition_table, compression)
+        call['bytes'] = call.get('bytes', 0) + len(body)
+        write_bytes(path, body)
+        # Los ficheros sustituidos se borran cuando el nuevo ya está escrito
+        for existing in replaced:
+            delete_uri(existing)
+        call['files_replaced'] = call.get('files_replaced', 0) + len(replaced)
+        paths.append(path)
+        partitions_values[partition] = [str(values[name]) for name in partition_cols]
+    return {'paths': paths, 'partitions_values': partitions_values}
+
+
+class ParquetStreamWriter:
+    """
+    Escribe un único fichero parquet por trozos: cada `write` añade las filas
+    recibidas como uno o más grupos de filas y el fichero se sube por partes
+    mientras se escribe (tfm_common.storage.open_output), así que la memoria
+    no depende del total de filas sino del trozo y del tamaño de parte.
+
+    Las tablas se ajustan al esquema estricto indicado antes de escribirse,
+    con lo que el fichero es equivalente al de `write_parquet` con las mismas
+    filas (el orden de las filas es el de llegada). Admite llamadas a `write`
+    desde varios hilos. Si no se escribe ninguna fila, `close` no crea el
+    fichero.
+    """
+
+    def __init__(self, uri, schema, compression='snappy', part_size=8 * 1024 * 1024):
+        self.uri = uri
+        self.schema = schema
+        self.compression = compression
+        self.part_size = part_size
+        self.rows = 0
+        self.row_groups = 0
+        self._sink = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        table = to_table(data, self.schema)
+        if table.num_rows == 0:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._sink = open_output(self.uri, self.part_size)
+                self._writer = pq.ParquetWriter(self._sink, table.schema, compression=self.compression,
+                                                coerce_timestamps=TIMESTAMP_UNIT, allow_truncated_timestamps=True)
+            self._writer.write_table(table)
+            self.rows += table.num_rows
+            self.row_groups += 1
+
+    def close(self):
+        """
+        Termina el fichero. Devuelve {'uri', 'rows', 'bytes'} o None si no hay filas.
+        """
+        with self._lock:
+            if self._writer is None:
+                return None
+            with timed('parquet_write', uri=self.uri, rows=self.rows, files=1, streaming=True) as call:
+                self._writer.close()
+                size = self._sink.tell()
+                self._sink.close()
+                call['bytes'] = size
+            self._writer = None
+            return {'uri': self.uri, 'rows': self.rows, 'bytes': size}
+
+    def abort(self):
+        """
+        Descarta lo escrito hasta ahora; el fichero no llega a publicarse.
+        """
+        with self._lock:
+            if self._writer is None:
+                return
+            try:
+                self._writer.close()
+            finally:
+                self._sink.abort()
+                self._writer = None
+            record('parquet_abort', uri=self.uri, rows=self.rows)
+
+
+class ParquetBufferWriter:
+    """
+    Misma interfaz que ParquetStreamWriter, pero acumula las tablas en memoria
+    y escribe el fichero completo al cerrar (opcionalmente ordenado por
+    `sort_by`, una lista de (columna, 'ascending'|'descending')).
+    """
+
+    def __init__(self, uri, schema, compression='snappy', sort_by=None):
+        self.uri = uri
+        self.schema = schema
+        self.compression = compression
+        self.sort_by = sort_by
+        self.rows = 0
+        self._tables = []
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        table = data if isinstance(data, pa.Table) else to_table(data)
+        if table.num_rows == 0:
+            return
+        with self._lock:
+            self._tables.append(table)
+            self.rows += table.num_rows
+
+    def close(self):
+        """
+        Escribe el fichero. Devuelve {'uri', 'rows', 'bytes'} o None si no hay filas.
+        """
+        with self._lock:
+            tables, self._tables = self._tables, []
+        if not tables:
+            return None
+        table = pa.concat_tables(tables)
+        if self.sort_by:
+            # Antes de ajustar al esquema: sort_by no admite columnas diccionario
+            table = table.sort_by(self.sort_by)
+        with timed('parquet_write', uri=self.uri, rows=table.num_rows, files=1) as call:
+            body = serialize(to_table(table, self.schema), self.compression)
+            call['bytes'] = len(body)
+            write_bytes(self.uri, body)
+        return {'uri': self.uri, 'rows': table.num_rows, 'bytes': len(body)}
+
+    def abort(self):
+        with self._lock:
+            self._tables = []
+
+
+def read_parquet(uri, columns=None):
+    """
+    Lee un fichero parquet como tabla de Arrow. Devuelve None si no existe.
+    """
+    data = read_bytes(uri)
+    if data is None:
+        return None
+    return pq.read_table(io.BytesIO(data), columns=columns)
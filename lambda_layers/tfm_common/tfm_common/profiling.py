@@ -0,0 +1,305 @@
+"""
+Perfilado opcional de los handlers de las Lambdas.
+
+Se activa con la variable de entorno `profiling`, una lista separada por comas:
+
+- `cpu`: perfil de CPU con cProfile de todos los hilos de la invocación (o con
+  pyinstrument, solo del hilo principal, si se pide `pyinstrument` y está instalado).
+- `memory`: tracemalloc; asignaciones principales al final y crecimiento por fase.
+- `rss`: muestreo del RSS del proceso cada `profiling_interval_ms` ms y pico por fase.
+- `true` o `all`: cpu, memory y rss.
+
+Las fases (`phase('fetch')`, `phase('transform')`, `phase('write')`...) las
+marca cada handler: una fase dura hasta que empieza la siguiente. Sin
+`profiling`, `phase` solo comprueba que no hay sesión activa, así que las
+marcas pueden quedarse en el código de producción.
+
+Los resultados se escriben en `profiling_uri` (por defecto
+`s3://{bucket_name}/profiles`, o ./profiles sin bucket) bajo
+`{función}/{run_id}/`: summary.json con las fases, y cpu.pstats y cpu.txt con
+el perfil de CPU. El run_id empieza por la hora UTC e incluye el request id
+de Lambda. `instrument_handler` (tfm_common.telemetry) abre y cierra la sesión.
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+MODES = ('cpu', 'memory', 'rss')
+
+
+def _parse_modes(value):
+    modes = {mode.strip().lower() for mode in (value or '').split(',') if mode.strip()}
+    if modes & {'true', '1', 'all'}:
+        modes = (modes - {'true', '1', 'all'}) | set(MODES)
+    if 'pyinstrument' in modes:
+        modes.add('cpu')
+    return modes - {'false', '0', 'off'}
+
+
+PROFILING = _parse_modes(os.getenv('profiling'))
+INTERVAL_S = float(os.getenv('profiling_interval_ms', 10)) / 1000
+# Filas de los informes (funciones de CPU y líneas de tracemalloc)
+TOP = int(os.getenv('profiling_top', 25))
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+_session = None
+
+
+def current_rss():
+    """
+    RSS actual del proceso en bytes (en Linux; en otros sistemas, el pico).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _mb(value):
+    return round(value / (1024 * 1024), 2)
+
+
+def _top_allocations(stats):
+    return [{'where': str(stat.traceback[0]), 'size_mb': _mb(stat.size),
+             'size_diff_mb': _mb(getattr(stat, 'size_diff', stat.size)), 'count': stat.count}
+            for stat in stats[:TOP]]
+
+
+class ProfileSession:
+    """
+    Perfil de una invocación: fases, perfil de CPU, tracemalloc y muestreo del RSS.
+    """
+
+    def __init__(self, function, run_id, modes):
+        self.function = function
+        self.run_id = run_id
+        self.modes = set(modes)
+        self.started_at = datetime.now(timezone.utc)
+        self.phases = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._profilers = []
+        self._pyinstrument = None
+        self._snapshot = None
+        self.overhead_s = 0.0
+
+    # ---------------------------------------------------------------- arranque
+    def start(self):
+        if 'memory' in self.modes:
+            import tracemalloc
+            tracemalloc.start()
+        self._enter('setup')
+        if 'rss' in self.modes:
+            # Antes de instalar el perfilador de hilos: el muestreador no se perfila
+            self._sampler = threading.Thread(target=self._sample, name='profiling-rss', daemon=True)
+            self._sampler.start()
+        if 'cpu' in self.modes:
+            self._start_cpu()
+
+    def _start_cpu(self):
+        if 'pyinstrument' in self.modes:
+            try:
+                from pyinstrument import Profiler
+                self._pyinstrument = Profiler()
+                self._pyinstrument.start()
+                return
+            except ImportError:
+                print("profiling: pyinstrument no está instalado; se usa cProfile")
+        import cProfile
+        self._new_profiler(cProfile)
+        # Cada hilo nuevo (pools de descarga, escritura...) crea su propio perfilador
+        threading.setprofile(lambda frame, event, arg: self._new_profiler(cProfile))
+
+    def _new_profiler(self, cProfile):
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+: un único perfilador activo por proceso
+            return
+        with self._lock:
+            self._profilers.append(profiler)
+
+    def _sample(self):
+        while not self._stop.wait(INTERVAL_S):
+            rss = current_rss()
+            with self._lock:
+                phase = self.phases[-1]
+                # Entre dos fases la última ya está cerrada
+                if 'rss_peak' in phase:
+                    phase['rss_peak'] = max(phase['rss_peak'], rss)
+
+    # ------------------------------------------------------------------ fases
+    def _enter(self, name):
+        rss = current_rss()
+        now = time.perf_counter()
+        snapshot = None
+        if 'memory' in self.modes:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            if self.phases:
+                self._close(self.phases[-1], now, rss, snapshot)
+            self._snapshot = snapshot
+        if 'memory' in self.modes:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        # La fase nueva empieza después de la instantánea, que no es suya
+        start = time.perf_counter()
+        self.overhead_s += start - now
+        with self._lock:
+            self.phases.append({'name': name, 'start': start, 'rss_start': rss, 'rss_peak': rss})
+
+    def _close(self, phase, now, rss, snapshot):
+        phase['duration_s'] = round(now - phase.pop('start'), 4)
+        phase['rss_end'] = rss
+        phase['rss_peak'] = max(phase['rss_peak'], rss)
+        if snapshot is not None:
+            import tracemalloc
+            phase['traced_peak_mb'] = _mb(tracemalloc.get_traced_memory()[1])
+            if self._snapshot is not None:
+                growth = snapshot.compare_to(self._snapshot, 'lineno')
+                phase['allocations'] = _top_allocations([stat for stat in growth if stat.size_diff > 0])
+        for key in ('rss_start', 'rss_end', 'rss_peak'):
+            phase[f'{key}_mb'] = _mb(phase.pop(key))
+
+    def enter(self, name):
+        if self.phases and self.phases[-1]['name'] == name:
+            return
+        self._enter(name)
+
+    # ------------------------------------------------------------------ cierre
+    def stop(self, error=None):
+        """
+        Cierra la última fase, detiene los perfiladores y devuelve el resumen
+        y los ficheros a escribir ({nombre: bytes}).
+        """
+        threading.setprofile(None)
+        sys.setprofile(None)
+        cpu_files, cpu_top = self._stop_cpu()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        snapshot = None
+        if 'memory' in self.modes:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            self._close(self.phases[-1], time.perf_counter(), current_rss(), snapshot)
+        summary = {
+            'function': self.function,
+            'run_id': self.run_id,
+            'started_at': self.started_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'modes': sorted(self.modes),
+            'error': error,
+            'duration_s': round(sum(phase['duration_s'] for phase in self.phases), 4),
+            # Tiempo de las instantáneas de tracemalloc entre fases, fuera de las fases
+            'overhead_s': round(self.overhead_s, 4),
+            'rss_peak_mb': max(phase['rss_peak_mb'] for phase in self.phases),
+            'phases': self.phases,
+        }
+        if snapshot is not None:
+            import tracemalloc
+            summary['allocations'] = _top_allocations(snapshot.statistics('lineno'))
+            tracemalloc.stop()
+        if cpu_top is not None:
+            summary['cpu_top'] = cpu_top
+        files = dict(cpu_files)
+        files['summary.json'] = json.dumps(summary, indent=1, default=str).encode('utf-8')
+        return summary, files
+
+    def _stop_cpu(self):
+        if self._pyinstrument is not None:
+            self._pyinstrument.stop()
+            return {'cpu.txt': self._pyinstrument.output_text().encode('utf-8'),
+                    'cpu.html': self._pyinstrument.output_html().encode('utf-8')}, None
+        if not self._profilers:
+            return {}, None
+        import marshal
+        import pstats
+        with self._lock:
+            profilers, self._profilers = self._profilers, []
+        stats = None
+        for profiler in profilers:
+            profiler.disable()
+            stats = pstats.Stats(profiler) if stats is None else stats.add(profiler)
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(TOP * 2)
+        cpu_top = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP]:
+            cpu_top.append({'function': f'{os.path.basename(filename)}:{line}({function})', 'calls': calls,
+                            'own_s': round(own, 4), 'cumulative_s': round(cumulative, 4)})
+        return {'cpu.pstats': marshal.dumps(stats.stats), 'cpu.txt': text.getvalue().encode('utf-8')}, cpu_top
+
+
+def phase(name):
+    """
+    Marca el comienzo de una fase del handler (la anterior termina aquí).
+    """
+    if _session is not None:
+        _session.enter(name)
+
+
+def _output_uri():
+    uri = os.getenv('profiling_uri')
+    if uri:
+        return uri
+    bucket_name = os.getenv('bucket_name')
+    if bucket_name:
+        from tfm_common.storage import join_uri
+        return join_uri(bucket_name, 'profiles')
+    return os.path.join('.', 'profiles')
+
+
+def start(function, context=None):
+    """
+    Abre la sesión de perfilado de la invocación si `profiling` está activo.
+    """
+    global _session
+    if not PROFILING:
+        return None
+    request_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex[:12]
+    run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{request_id}"
+    _session = ProfileSession(function, run_id, PROFILING)
+    _session.start()
+    return _session
+
+
+def finish(error=None):
+    """
+    Cierra la sesión activa y escribe sus ficheros. Devuelve la URI del
+    directorio del perfil, o None. Un fallo al escribir no afecta al handler.
+    """
+    global _session
+    session, _session = _session, None
+    if session is None:
+        return None
+    summary, files = session.stop(error)
+    prefix = '/'.join([_output_uri().rstrip('/'), session.function, session.run_id])
+    try:
+        from tfm_common.storage import write_bytes
+        for name, body in files.items():
+            write_bytes(f'{prefix}/{name}', body)
+    except Exception as e:
+        print(f"profiling: no se pudo escribir el perfil en {prefix}: {e}")
+        return None
+    phases = ', '.join(f"{phase['name']} {phase['duration_s']:.2f} s / {phase['rss_peak_mb']:.0f} MB"
+                       for phase in summary['phases'])
+    print(f"profiling: perfil en {prefix} ({phases})")
+    return prefix
@@ -0,0 +1,83 @@
+"""
+Limitador de tasa (token bucket) compartido entre hilos.
+"""
+import os
+import threading
+import time
+
+from tfm_common.telemetry import record
+
+
+class RateLimiter:
+    """
+    Token bucket compartido por todos los hilos de una invocación.
+
+    La capacidad se recalibra con las cabeceras `x-ratelimit-remaining` y
+    `x-ratelimit-reset` de cada respuesta de OpenAQ, descontando las peticiones
+    que siguen en vuelo (su consumo aún no aparece en la cabecera). Sin
+    cabeceras se repone a razón de `rate` peticiones por `period` segundos.
+    """
+
+    def __init__(self, rate=60, period=60):
+        self.rate = rate
+        self.period = period
+        self.tokens = rate
+        self.reset_at = time.monotonic() + period
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now >= self.reset_at:
+            self.tokens = self.rate
+            self.reset_at = now + self.period
+
+    def acquire(self):
+        """
+        Bloquea hasta disponer de un token y lo consume. Las esperas se anotan
+        en la telemetría como `rate_limit_wait`.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens > 0:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    break
+                wait = self.reset_at - now
+            time.sleep(max(wait, 0.05))
+            waited += max(wait, 0.05)
+        if waited:
+            record('rate_limit_wait', sleep_s=round(waited, 3))
+
+    def update(self, headers=None):
+        """
+        Libera la petición en vuelo y ajusta el cubo a las cabeceras recibidas.
+        """
+        with self.lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if not headers:
+                return
+            remaining = headers.get('x-ratelimit-remaining')
+            reset = headers.get('x-ratelimit-reset')
+            if remaining is not None:
+                self.tokens = max(int(remaining) - self.in_flight, 0)
+            if reset is not None:
+                self.reset_at = time.monotonic() + int(reset)
+
+    def block_until_reset(self, reset_time):
+        """
+        Tras un 429 vacía el cubo para que ningún hilo envíe hasta el reseteo.
+        """
+        with self.lock:
+            self.tokens = 0
+            self.reset_at = max(self.reset_at, time.monotonic() + reset_time + 1)
+
+
+# A nivel de módulo para que todos los hilos (y las invocaciones en caliente)
+# compartan el mismo presupuesto de peticiones a la API de OpenAQ
+openaq_rate_limiter = RateLimiter(
+    rate=int(os.getenv('openaq_rate_limit', 60)),
+    period=int(os.getenv('openaq_rate_period', 60))
+)
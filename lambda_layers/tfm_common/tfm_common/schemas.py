@@ -0,0 +1,211 @@
+"""
+Registro de esquemas declarados de los ficheros que las Lambdas escriben en staging.
+
+Los tipos usan los nombres de Spark SQL (`double`, `float`, `int`, `smallint`,
+`string`, `timestamp`...) para que el job de Glue pueda construir el esquema de
+lectura a partir del manifiesto sin inferirlo de los ficheros. `dictionary`
+marca columnas de baja cardinalidad que se guardan como categóricas
+(diccionario en Arrow/parquet): es solo una pista de codificación y no cambia
+el tipo lógico.
+
+`key` es la clave natural del dataset (una fila por clave): la usan la
+compactación y `write_parquet(mode='upsert')` para eliminar duplicados.
+
+Los esquemas `strict` rechazan columnas no declaradas y rellenan con nulos las
+que falten. Los no estrictos (catálogos de OpenAQ con columnas variables)
+convierten las declaradas que lleguen y dejan el resto como venga: su tipo no
+se deduce de los datos, para que un lote no pueda cambiar el tipo de una
+columna respecto al anterior.
+
+pandas se importa dentro de las funciones que trabajan con DataFrames: las
+Lambdas que solo usan Arrow no pagan su importación en el arranque en frío.
+"""
+import pyarrow as pa
+
+SUMMARY_FIELDS = ('min', 'q02', 'q25', 'median', 'q75', 'q98', 'max', 'avg', 'sd')
+
+OPENAQ_MEASUREMENTS = {
+    'name': 'openaq_measurements',
+    'version': 1,
+    'strict': True,
+    'key': ['sensor_id', 'datetimeFrom'],
+    'fields': [
+        {'name': 'value', 'type': 'double'},
+        {'name': 'sensor_id', 'type': 'string', 'dictionary': True},
+        {'name': 'datetimeFrom', 'type': 'timestamp'},
+        {'name': 'datetimeTo', 'type': 'timestamp'},
+    ] + [{'name': name, 'type': 'double'} for name in SUMMARY_FIELDS],
+}
+
+OPENAQ_LOCATIONS = {
+    'name': 'openaq_locations',
+    'version': 1,
+    'strict': False,
+    'key': ['id', 'sensor_id'],
+    'fields': [
+        {'name': 'id', 'type': 'bigint'},
+        {'name': 'name', 'type': 'string'},
+        {'name': 'locality', 'type': 'string', 'dictionary': True},
+        {'name': 'timezone', 'type': 'string', 'dictionary': True},
+        {'name': 'country', 'type': 'string', 'dictionary': True},
+        {'name': 'isMonitor', 'type': 'boolean'},
+        {'name': 'latitud', 'type': 'double'},
+        {'name': 'longitud', 'type': 'double'},
+        {'name': 'datetimeFirst', 'type': 'timestamp'},
+        {'name': 'datetimeLast', 'type': 'timestamp'},
+        {'name': 'sensor_id', 'type': 'bigint'},
+        {'name': 'parameter_id', 'type': 'int'},
+    ],
+}
+
+OPENAQ_PARAMETERS = {
+    'name': 'openaq_parameters',
+    'version': 1,
+    'strict': False,
+    'fields': [
+        {'name': 'id', 'type': 'int'},
+        {'name': 'name', 'type': 'string', 'dictionary': True},
+        {'name': 'units', 'type': 'string', 'dictionary': True},
+        {'name': 'displayName', 'type': 'string'},
+        {'name': 'description', 'type': 'string'},
+    ],
+}
+
+REE_VALUES = {
+    'name': 'ree_values',
+    'version': 1,
+    'strict': True,
+    'key': ['serie_id', 'datetime'],
+    'fields': [
+        {'name': 'serie_id', 'type': 'string', 'dictionary': True},
+        {'name': 'serie', 'type': 'string', 'dictionary': True},
+        {'name': 'value', 'type': 'double'},
+        {'name': 'percentage', 'type': 'float'},
+        {'name': 'datetime', 'type': 'timestamp'},
+        {'name': 'year', 'type': 'smallint'},
+        {'name': 'month', 'type': 'tinyint'},
+    ],
+}
+
+INCLASNS_DATOS = {
+    'name': 'inclasns_datos',
+    'version': 2,
+    'strict': True,
+    'fields': [
+        {'name': 'anio', 'type': 'smallint'},
+        {'name': 'ccaa', 'type': 'string', 'dictionary': True},
+        {'name': 'sexo', 'type': 'string', 'dictionary': True},
+        {'name': 'valor', 'type': 'double'},
+        {'name': 'codigo', 'type': 'int'},
+        {'name': 'nombre', 'type': 'string', 'dictionary': True},
+    ],
+}
+
+ARROW_TYPES = {
+    'double': pa.float64(),
+    'float': pa.float32(),
+    'bigint': pa.int64(),
+    'int': pa.int32(),
+    'smallint': pa.int16(),
+    'tinyint': pa.int8(),
+    'string': pa.string(),
+    'boolean': pa.bool_(),
+    'timestamp': pa.timestamp('us'),
+}
+
+# Tipos nullable de pandas para que los enteros con nulos no pasen a float64
+PANDAS_DTYPES = {
+    'double': 'float64',
+    'float': 'float32',
+    'bigint': 'Int64',
+    'int': 'Int32',
+    'smallint': 'Int16',
+    'tinyint': 'Int8',
+    'string': 'string',
+    'boolean': 'boolean',
+    'timestamp': 'datetime64[ns]',
+}
+
+class SchemaError(ValueError):
+    pass
+
+
+def to_arrow_schema(schema):
+    return pa.schema([(field['name'], ARROW_TYPES[field['type']]) for field in schema['fields']])
+
+
+def conform_table(table, schema):
+    """
+    Ajusta una tabla de Arrow a un esquema estricto: mismas columnas y en el
+    mismo orden, con las que falten como nulos. Lanza SchemaError si sobra
+    alguna columna o si un valor no se puede convertir al tipo declarado.
+    """
+    arrow_schema = to_arrow_schema(schema)
+    extra = [name for name in table.column_names if name not in arrow_schema.names]
+    if extra:
+        raise SchemaError(f"Columnas no declaradas en {schema['name']} v{schema['version']}: {extra}")
+
+    columns = []
+    for field, declared in zip(arrow_schema, schema['fields']):
+        if field.name not in table.column_names:
+            column = pa.nulls(table.num_rows, field.type)
+        else:
+            column = table[field.name]
+            if pa.types.is_dictionary(column.type):
+                # ChunkedArray no tiene dictionary_decode; el cast al tipo de los valores lo decodifica
+                column = column.cast(column.type.value_type)
+            if pa.types.is_timestamp(column.type) and column.type.tz is not None:
+                # Se guardan como UTC sin zona horaria
+                column = column.cast(pa.timestamp(column.type.unit))
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise SchemaError(f"La columna {field.name} ({column.type}) no se puede convertir a "
+                                  f"{field.type}: {e}") from e
+        if declared.get('dictionary'):
+            column = column.dictionary_encode()
+        columns.append(column)
+    return pa.Table.from_arrays(columns, names=arrow_schema.names)
+
+
+def _cast_series(series, field):
+    import pandas as pd
+    kind = field['type']
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(series.cat.categories.dtype)
+    if kind == 'timestamp':
+        series = pd.to_datetime(series, utc=True)
+        return series.dt.tz_convert(None)
+    if kind in ('double', 'float', 'bigint', 'int', 'smallint', 'tinyint'):
+        series = pd.to_numeric(series)
+    elif kind == 'string':
+        series = series.astype('string')
+        return series.astype('category') if field.get('dictionary') else series
+    return series.astype(PANDAS_DTYPES[kind])
+
+
+def apply_schema(df, schema):
+    """
+    Devuelve una copia del DataFrame con los tipos del esquema (ver docstring
+    del módulo). Lanza SchemaError si algún valor no se puede convertir.
+    """
+    import pandas as pd
+    declared = {field['name']: field for field in schema['fields']}
+    extra = [column for column in df.columns if column not in declared]
+    if extra and schema.get('strict', True):
+        raise SchemaError(f"Columnas no declaradas en {schema['name']} v{schema['version']}: {extra}")
+
+    columns = {}
+    for name, field in declared.items():
+        if name not in df.columns:
+            if schema.get('strict', True):
+                columns[name] = pd.Series(None, index=df.index, dtype=PANDAS_DTYPES[field['type']])
+            continue
+        try:
+            columns[name] = _cast_series(df[name], field)
+        except (ValueError, TypeError) as e:
+            raise SchemaError(f"La columna {name} no se puede convertir a {field['type']} "
+                              f"({schema['name']} v{schema['version']}): {e}") from e
+    for name in extra:
+        columns[name] = df[name]
+    return pd.DataFrame(columns, index=df.index)
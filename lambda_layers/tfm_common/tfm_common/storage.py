@@ -0,0 +1,271 @@
+"""
+Acceso mínimo a objetos por URI, en S3 (`s3://bucket/clave`) o en disco local.
+
+Las rutas locales (absolutas, relativas o `file://`) permiten ejecutar las
+funciones y sus estados auxiliares (marcas de agua, manifiestos...) sin AWS.
+"""
+import os
+
+from botocore.exceptions import ClientError, ParamValidationError
+
+from tfm_common.clients import get_client
+from tfm_common.telemetry import timed
+
+
+def join_uri(bucket_name, *parts):
+    """
+    Construye una URI a partir del nombre del bucket (con o sin `s3://`) o de un
+    directorio local y las partes de la clave.
+    """
+    base = bucket_name.rstrip('/')
+    if not (base.startswith('s3://') or base.startswith('file://') or base.startswith('/')
+            or base.startswith('.')):
+        base = f's3://{base}'
+    return '/'.join([base] + [str(part).strip('/') for part in parts])
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _local_path(uri):
+    return uri[len('file://'):] if uri.startswith('file://') else uri
+
+
+def read_bytes(uri):
+    """
+    Devuelve el contenido del objeto o None si no existe.
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        try:
+            with timed('s3_get', key=key) as call:
+                data = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+                call['bytes'] = len(data)
+            return data
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+    path = _local_path(uri)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_bytes(uri, data):
+    """
+    Escribe el objeto completo. En local se escribe en un temporal y se renombra
+    para que un lector nunca vea un fichero a medias (en S3 el PUT ya es atómico).
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        with timed('s3_put', key=key, bytes=len(data)):
+            get_client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+        return
+    path = _local_path(uri)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def create_exclusive(uri, data):
+    """
+    Crea el objeto solo si no existe y devuelve True; si ya existía no lo toca
+    y devuelve False. En S3 es una escritura condicional (`If-None-Match: *`);
+    con un botocore anterior a las escrituras condicionales se comprueba antes
+    con un HEAD, lo que deja una pequeña carrera que el llamante debe cubrir
+    releyendo el objeto. En local, `O_EXCL`.
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        try:
+            with timed('s3_put', key=key, bytes=len(data)):
+                get_client('s3').put_object(Bucket=bucket, Key=key, Body=data, IfNoneMatch='*')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+                return False
+            raise
+        except ParamValidationError:
+            if size_of(uri) is not None:
+                return False
+            write_bytes(uri, data)
+            return True
+    path = _local_path(uri)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def size_of(uri):
+    """
+    Tamaño del objeto en bytes o None si no existe.
+    """
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        try:
+            return get_client('s3').head_object(Bucket=bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+    path = _local_path(uri)
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+
+def list_uris(prefix_uri):
+    """
+    Lista recursivamente los objetos bajo un prefijo con su tamaño en bytes.
+    """
+    if prefix_uri.startswith('s3://'):
+        bucket, prefix = split_s3_uri(prefix_uri)
+        paginator = get_client('s3').get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects.append((f"s3://{bucket}/{obj['Key']}", obj['Size']))
+        return objects
+    root = _local_path(prefix_uri)
+    objects = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            objects.append((path, os.path.getsize(path)))
+    return sorted(objects)
+
+
+def delete_uri(uri):
+    if uri.startswith('s3://'):
+        bucket, key = split_s3_uri(uri)
+        get_client('s3').delete_object(Bucket=bucket, Key=key)
+        return
+    path = _local_path(uri)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class S3MultipartWriter:
+    """
+    Fichero de solo escritura que sube a S3 por partes (multipart upload) a
+    medida que se escribe, de modo que nunca guarda en memoria más de una
+    parte. El objeto solo aparece en S3 al cerrar; `abort` descarta lo subido.
+    Si todo cabe en una parte se sube con un único PUT.
+    """
+    # S3 exige al menos 5 MiB en todas las partes salvo la última
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, uri, part_size=8 * 1024 * 1024):
+        self.bucket, self.key = split_s3_uri(uri)
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body):
+        client = get_client('s3')
+        if self.upload_id is None:
+            self.upload_id = client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        with timed('s3_upload_part', key=self.key, part=number, bytes=len(body)):
+            response = client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          PartNumber=number, Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            write_bytes(f's3://{self.bucket}/{self.key}', bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            get_client('s3').complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                       MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            get_client('s3').abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class LocalAtomicWriter:
+    """
+    Equivalente local de S3MultipartWriter: escribe en un temporal que se
+    renombra al cerrar y se borra con `abort`.
+    """
+
+    def __init__(self, uri):
+        self.path = _local_path(uri)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.tmp_path = f'{self.path}.tmp-{os.getpid()}-{id(self)}'
+        self.file = open(self.tmp_path, 'wb')
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.file.tell()
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+def open_output(uri, part_size=8 * 1024 * 1024):
+    """
+    Abre `uri` para escritura secuencial (S3MultipartWriter o LocalAtomicWriter).
+    """
+    if uri.startswith('s3://'):
+        return S3MultipartWriter(uri, part_size)
+    return LocalAtomicWriter(uri)
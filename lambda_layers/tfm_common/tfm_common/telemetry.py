@@ -0,0 +1,252 @@
+"""
+Telemetría de rendimiento en líneas JSON compatibles con CloudWatch Embedded
+Metric Format (EMF).
+
+Cada llamada externa (API, Secrets Manager, S3) se mide con `timed` y las
+esperas (límite de tasa, retrocesos) se anotan con `record`. Con
+`telemetry_level=events` cada una se emite además como una línea EMF con las
+dimensiones Function y Operation, de las que CloudWatch saca percentiles; no
+es el valor por defecto porque una invocación con miles de páginas escribiría
+miles de líneas de log. Al final de la invocación, con `summary` (por
+defecto) o `events`, el decorador `instrument_handler` emite un resumen por
+operación (recuento, errores, reintentos, percentiles e histograma de
+latencia, filas, bytes y tiempo dormido) y una línea de la invocación.
+
+Con la variable `profiling` el decorador también perfila la invocación (CPU,
+memoria y RSS por fase, ver tfm_common.profiling) y añade la ubicación del
+perfil a la línea de la invocación.
+
+Las líneas se escriben con `print` (CloudWatch Logs las convierte en
+métricas); `capture()` las recoge en una lista para inspeccionarlas en local.
+"""
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from tfm_common import profiling
+
+NAMESPACE = os.getenv('telemetry_namespace', 'TFM/Pipeline')
+# events: una línea por llamada y el resumen; summary: solo el resumen; off: nada
+LEVEL = os.getenv('telemetry_level', 'summary')
+# Límites superiores (ms) de los cubos del histograma de latencia
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Campos numéricos de un evento que se publican como métricas
+EVENT_UNITS = {
+    'duration_ms': 'Milliseconds',
+    'bytes': 'Bytes',
+    'rows': 'Count',
+    'sleep_s': 'Seconds',
+}
+SUMMARY_UNITS = {
+    'count': 'Count',
+    'errors': 'Count',
+    'retries': 'Count',
+    'duration_total_ms': 'Milliseconds',
+    'duration_p50_ms': 'Milliseconds',
+    'duration_p90_ms': 'Milliseconds',
+    'duration_p99_ms': 'Milliseconds',
+    'duration_max_ms': 'Milliseconds',
+    'rows': 'Count',
+    'bytes': 'Bytes',
+    'sleep_s': 'Seconds',
+    'rows_per_s': 'Count/Second',
+    'bytes_per_s': 'Bytes/Second',
+}
+
+_lock = threading.Lock()
+_events = []
+_properties = {}
+_function = None
+_sink = print
+
+
+def endpoint_of(url):
+    """
+    Ruta de la URL con los identificadores numéricos sustituidos por `{id}`,
+    para agrupar las llamadas de todos los sensores en una misma operación.
+    """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlparse(url).path)
+
+
+def _emf(operation, values, units):
+    metrics = [{'Name': name, 'Unit': unit} for name, unit in units.items()
+               if isinstance(values.get(name), (int, float)) and not isinstance(values.get(name), bool)]
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': NAMESPACE, 'Dimensions': [['Function', 'Operation']],
+                                   'Metrics': metrics}],
+        },
+        'Function': _function or os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+        'Operation': operation,
+    }
+    document.update(values)
+    return json.dumps(document, default=str, separators=(',', ':'))
+
+
+def record(operation, **values):
+    """
+    Anota un evento ya medido (p. ej. `record('backoff_sleep', sleep_s=2)`).
+    """
+    if LEVEL == 'off':
+        return
+    with _lock:
+        _events.append((operation, values))
+    if LEVEL == 'events':
+        _sink(_emf(operation, values, EVENT_UNITS))
+
+
+@contextmanager
+def timed(operation, **values):
+    """
+    Mide la duración del bloque. El diccionario que devuelve admite campos
+    adicionales (status, rows, bytes...); si el bloque lanza una excepción se
+    anota su tipo en `error` y se relanza.
+    """
+    event = dict(values)
+    start = time.perf_counter()
+    try:
+        yield event
+    except Exception as e:
+        event['error'] = type(e).__name__
+        raise
+    finally:
+        event['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        record(operation, **event)
+
+
+def annotate(**properties):
+    """
+    Añade propiedades (sensores del lote, filas escritas...) a la línea de la invocación.
+    """
+    with _lock:
+        _properties.update(properties)
+
+
+def _percentile(values, fraction):
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(events=None):
+    """
+    Agrega los eventos por operación.
+    """
+    if events is None:
+        with _lock:
+            events = list(_events)
+    summary = {}
+    for operation, values in events:
+        entry = summary.setdefault(operation, {'count': 0, 'errors': 0, 'retries': 0, 'rows': 0, 'bytes': 0,
+                                               'sleep_s': 0.0, 'durations': [], 'status': {}})
+        entry['count'] += 1
+        entry['errors'] += 1 if values.get('error') else 0
+        entry['retries'] += 1 if values.get('attempt', 0) > 0 else 0
+        entry['rows'] += values.get('rows') or 0
+        entry['bytes'] += values.get('bytes') or 0
+        entry['sleep_s'] += values.get('sleep_s') or 0
+        if 'duration_ms' in values:
+            entry['durations'].append(values['duration_ms'])
+        if 'status' in values:
+            status = str(values['status'])
+            entry['status'][status] = entry['status'].get(status, 0) + 1
+
+    for entry in summary.values():
+        durations = sorted(entry.pop('durations'))
+        entry['sleep_s'] = round(entry['sleep_s'], 3)
+        if not durations:
+            continue
+        total = sum(durations)
+        entry.update({
+            'duration_total_ms': round(total, 3),
+            'duration_p50_ms': _percentile(durations, 0.5),
+            'duration_p90_ms': _percentile(durations, 0.9),
+            'duration_p99_ms': _percentile(durations, 0.99),
+            'duration_max_ms': durations[-1],
+            'histogram_ms': _histogram(durations),
+        })
+        if total > 0:
+            entry['rows_per_s'] = round(entry['rows'] / (total / 1000), 1)
+            entry['bytes_per_s'] = round(entry['bytes'] / (total / 1000), 1)
+    return summary
+
+
+def _histogram(durations):
+    """
+    Recuento por cubo de HISTOGRAM_BUCKETS_MS ('<=100', ..., '>10000').
+    """
+    histogram = {}
+    for duration in durations:
+        bucket = next((f'<={limit}' for limit in HISTOGRAM_BUCKETS_MS if duration <= limit),
+                      f'>{HISTOGRAM_BUCKETS_MS[-1]}')
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return histogram
+
+
+def emit_summary(duration_s, error=None):
+    """
+    Emite una línea EMF por operación y una de la invocación; devuelve el resumen.
+    """
+    summary = summarize()
+    if LEVEL == 'off':
+        return summary
+    for operation, entry in summary.items():
+        _sink(_emf(operation, dict(entry, type='summary'), SUMMARY_UNITS))
+    with _lock:
+        properties = dict(_properties)
+    invocation = dict(properties, type='invocation', duration_ms=round(duration_s * 1000, 3),
+                      operations=sorted(summary))
+    if error:
+        invocation['error'] = error
+    _sink(_emf('invocation', invocation, {'duration_ms': 'Milliseconds'}))
+    return summary
+
+
+def instrument_handler(handler):
+    """
+    Decorador de `lambda_handler`: reinicia los eventos (el contenedor se reutiliza
+    entre invocaciones) y emite el resumen al terminar, también si falla. Con
+    `profiling` activo abre y cierra además la sesión de perfilado.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _function
+        with _lock:
+            _events.clear()
+            _properties.clear()
+        _function = getattr(context, 'function_name', None) or os.getenv('AWS_LAMBDA_FUNCTION_NAME') \
+            or handler.__module__
+        start = time.perf_counter()
+        error = None
+        if profiling.PROFILING:
+            profiling.start(_function, context)
+        try:
+            return handler(event, context)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if profiling.PROFILING:
+                annotate(profile=profiling.finish(error))
+            emit_summary(time.perf_counter() - start, error)
+    return wrapper
+
+
+@contextmanager
+def capture():
+    """
+    Recoge las líneas emitidas en una lista en lugar de imprimirlas.
+    """
+    global _sink
+    lines = []
+    previous, _sink = _sink, lines.append
+    try:
+        yield lines
+    finally:
+        _sink = previous
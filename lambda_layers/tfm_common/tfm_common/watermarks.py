@@ -0,0 +1,92 @@
+"""
+Marcas de agua de ingesta incremental por sensor.
+
+Cada lote guarda en su propio segmento JSON (`{base_uri}/{segmento}.json`) el
+último `datetimeTo` (UTC) ingerido de cada uno de sus sensores. Así los lotes
+que se ejecutan en paralelo nunca escriben el mismo objeto; al leer se combinan
+todos los segmentos quedándose con la marca más reciente de cada sensor.
+
+Como los segmentos se nombran por lote, `compact` los consolida en un único
+objeto (`{base_uri}/_compacted.json`) y borra los que ha fusionado, de modo
+que cada lectura solo abre el consolidado y los segmentos de la última
+ejecución. Debe llamarse cuando ningún lote está escribiendo marcas (antes de
+repartir los lotes), porque borrar un segmento mientras otro lote lo reescribe
+perdería esa escritura.
+"""
+import json
+from datetime import datetime, timezone
+
+from tfm_common.storage import delete_uri, list_uris, read_bytes, write_bytes
+
+COMPACTED = '_compacted'
+
+
+def to_utc_iso(value):
+    """
+    Normaliza una fecha ISO 8601 a `YYYY-MM-DDTHH:MM:SSZ` para poder compararlas.
+    """
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class WatermarkStore:
+
+    def __init__(self, base_uri):
+        self.base_uri = base_uri.rstrip('/')
+
+    def _read_segments(self):
+        """
+        Devuelve ({sensor_id: marca}, [uris de segmentos]) combinando el
+        consolidado y todos los segmentos.
+        """
+        watermarks = {}
+        segments = []
+        for uri, _ in list_uris(self.base_uri + '/'):
+            if not uri.endswith('.json'):
+                continue
+            if uri.rsplit('/', 1)[-1] != f'{COMPACTED}.json':
+                segments.append(uri)
+            segment = json.loads(read_bytes(uri) or b'{}')
+            for sensor_id, watermark in segment.items():
+                if watermark > watermarks.get(sensor_id, ''):
+                    watermarks[sensor_id] = watermark
+        return watermarks, segments
+
+    def _compacted_uri(self):
+        return f'{self.base_uri}/{COMPACTED}.json'
+
+    def load(self):
+        """
+        Devuelve {sensor_id: marca} combinando todos los segmentos.
+        """
+        return self._read_segments()[0]
+
+    def compact(self):
+        """
+        Escribe todas las marcas en el consolidado, borra los segmentos
+        fusionados y devuelve {sensor_id: marca}. No debe coincidir con ningún
+        `commit` (ver el docstring del módulo).
+        """
+        watermarks, segments = self._read_segments()
+        if segments:
+            # Primero el consolidado: si se interrumpe a medias, los segmentos
+            # que queden se vuelven a fusionar en la siguiente llamada
+            write_bytes(self._compacted_uri(), json.dumps(watermarks, sort_keys=True).encode('utf-8'))
+            for uri in segments:
+                delete_uri(uri)
+        return watermarks
+
+    def commit(self, segment, updates):
+        """
+        Fusiona `updates` en el segmento indicado sin retroceder ninguna marca.
+        """
+        uri = f'{self.base_uri}/{segment}.json'
+        current = json.loads(read_bytes(uri) or b'{}')
+        for sensor_id, watermark in updates.items():
+            watermark = to_utc_iso(watermark)
+            if watermark > current.get(str(sensor_id), ''):
+                current[str(sensor_id)] = watermark
+        write_bytes(uri, json.dumps(current, sort_keys=True).encode('utf-8'))
+        return current
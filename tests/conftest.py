@@ -0,0 +1,16 @@
+"""
+Configuración común de las pruebas: las Lambdas y la capa tfm_common se
+importan desde el árbol, como en benchmarks/, y la telemetría no emite nada.
+"""
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('telemetry_level', 'off')
+sys.path[:0] = [os.path.join(ROOT, 'lambda_layers', 'tfm_common'),
+                os.path.join(ROOT, 'lambda_functions', 'CompactarMediciones'),
+                os.path.join(ROOT, 'lambda_functions', 'DividirSensoresEnLotes'),
+                os.path.join(ROOT, 'lambda_functions', 'getHealthData'),
+                os.path.join(ROOT, 'lambda_functions', 'get_ree_data'),
+                os.path.join(ROOT, 'lambda_functions', 'get_open_aq_data')]
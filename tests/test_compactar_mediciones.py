@@ -0,0 +1,60 @@
+"""
+Selección de manifiestos de CompactarMediciones.
+"""
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+
+import CompactarMediciones
+from tfm_common.manifests import list_manifests, publish_manifest
+from tfm_common.parquet import read_parquet, write_parquet
+from tfm_common.schemas import OPENAQ_MEASUREMENTS, SUMMARY_FIELDS
+from tfm_common.storage import join_uri, size_of
+
+
+def measurements(sensor_id, value, days=3):
+    start = datetime(2024, 1, 1)
+    columns = {
+        'value': [value] * days,
+        'sensor_id': [sensor_id] * days,
+        'datetimeFrom': [start + timedelta(days=d) for d in range(days)],
+        'datetimeTo': [start + timedelta(days=d + 1) for d in range(days)],
+    }
+    columns.update({name: [value] * days for name in SUMMARY_FIELDS})
+    return pa.table(columns)
+
+
+def publish(prefix, name, created_at, tables):
+    files = []
+    for n, table in enumerate(tables):
+        uri = f'{prefix}/measurements/{name}-{n}.parquet'
+        write_parquet(uri, table, schema=OPENAQ_MEASUREMENTS)
+        files.append({'uri': uri, 'rows': table.num_rows, 'bytes': size_of(uri)})
+    publish_manifest(prefix, name, OPENAQ_MEASUREMENTS, files, created_at=created_at)
+
+
+def test_skipped_manifest_stops_selection(tmp_path, monkeypatch):
+    bucket = str(tmp_path)
+    prefix = join_uri(bucket, 'staging/OpenAQ')
+    monkeypatch.setenv('bucket_name', bucket)
+
+    # El manifiesto intermedio tiene un fichero "grande" y no se compacta
+    publish(prefix, 'antiguo', '2024-01-01T00:00:00Z', [measurements('1', 1.0), measurements('2', 1.0)])
+    publish(prefix, 'grande', '2024-01-02T00:00:00Z', [measurements('1', 2.0, days=200)])
+    publish(prefix, 'reciente', '2024-01-03T00:00:00Z', [measurements('1', 3.0), measurements('3', 3.0)])
+    large = list_manifests(prefix)[1][1]['files'][0]['bytes']
+    monkeypatch.setattr(CompactarMediciones, 'SMALL_FILE_BYTES', large)
+
+    CompactarMediciones.lambda_handler({}, None)
+
+    pending = [(manifest['name'], manifest['created_at']) for _, manifest in list_manifests(prefix)]
+    names = [name for name, _ in pending]
+    # Solo se compacta el prefijo anterior al manifiesto grande, que conserva su
+    # posición: las filas más recientes siguen detrás de las antiguas
+    assert names[1:] == ['grande', 'reciente']
+    assert names[0].startswith(CompactarMediciones.COMPACTED_DIR)
+    assert pending[0][1] == '2024-01-01T00:00:00Z'
+
+    compacted = list_manifests(prefix)[0][1]['files']
+    values = {row['value'] for entry in compacted for row in read_parquet(entry['uri']).to_pylist()}
+    assert values == {1.0}
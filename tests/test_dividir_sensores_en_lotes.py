@@ -0,0 +1,37 @@
+"""
+Reparto de sensores en lotes de coste similar (LPT).
+"""
+import json
+
+import pytest
+
+import DividirSensoresEnLotes
+from DividirSensoresEnLotes import plan_batches
+
+
+def test_expensive_sensors_are_spread_across_batches():
+    costs = {'1': 10.0, '2': 9.0, '3': 1.0, '4': 1.0, '5': 1.0, '6': 1.0}
+    batches = plan_batches(costs, max_batch_size=4, max_payload_bytes=10000)
+    assert len(batches) == 2
+    assert sorted(batch['estimated_cost'] for batch in batches) == [11.0, 12.0]
+    assert {'1', '2'} - set(batches[0]['sensors']) and {'1', '2'} - set(batches[1]['sensors'])
+    assert sorted(s for batch in batches for s in batch['sensors']) == sorted(costs)
+
+
+def test_limits_on_sensors_and_bytes_open_new_batches():
+    costs = {str(sensor_id): 1.0 for sensor_id in range(100, 110)}
+    batches = plan_batches(costs, max_batch_size=3, max_payload_bytes=10000)
+    assert len(batches) == 4
+    assert all(len(batch['sensors']) <= 3 for batch in batches)
+
+    batches = plan_batches(costs, max_batch_size=100, max_payload_bytes=20)
+    assert all(len(json.dumps(batch['sensors'])) <= 20 for batch in batches)
+    assert sorted(s for batch in batches for s in batch['sensors']) == sorted(costs)
+
+
+def test_output_over_the_step_functions_limit_fails(tmp_path, monkeypatch):
+    monkeypatch.setenv('bucket_name', str(tmp_path))
+    monkeypatch.setattr(DividirSensoresEnLotes, 'STEP_FUNCTIONS_LIMIT_BYTES', 1000)
+    with pytest.raises(ValueError, match='límite de Step Functions'):
+        DividirSensoresEnLotes.lambda_handler([str(sensor_id) for sensor_id in range(1000)], None)
+    assert len(DividirSensoresEnLotes.lambda_handler(['1', '2'], None)) == 1
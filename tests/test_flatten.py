@@ -0,0 +1,22 @@
+"""
+Conversión de las fechas locales de OpenAQ a UTC sin zona.
+"""
+from datetime import datetime
+
+import flatten
+
+
+def test_local_offsets_are_converted_to_naive_utc():
+    values = ['2024-01-01T02:00:00+02:00', '2023-12-31T19:00:00-05:00', None]
+    assert flatten._to_naive_utc(values).to_pylist() == [datetime(2024, 1, 1), datetime(2024, 1, 1), None]
+
+
+def test_values_arrow_cannot_parse_fall_back_to_pandas(monkeypatch):
+    # Fracciones de segundo: no encajan en LOCAL_FORMAT y Arrow las deja nulas
+    values = ['2024-01-01T02:00:00+02:00', '2024-01-01T00:00:00.5+00:00', 'no es una fecha']
+    assert flatten._to_naive_utc(values).to_pylist() == [datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 0, 0, 500000),
+                                                          None]
+
+    # Un formato que Arrow no admite tampoco lanza excepción con error_is_null
+    monkeypatch.setattr(flatten, 'LOCAL_FORMAT', '%Y-%m-%d')
+    assert flatten._to_naive_utc(['2024-01-01T02:00:00+02:00']).to_pylist() == [datetime(2024, 1, 1)]
@@ -0,0 +1,47 @@
+"""
+Descarga de indicadores de INCLASNS que solo reescribe los que han cambiado.
+"""
+import os
+
+import getHealthData
+
+CATALOGO = [{'codigo': 1, 'nombre': 'Tasa de EPOC'}, {'codigo': 2, 'nombre': 'Prevalencia de asma'},
+            {'codigo': 3, 'nombre': 'Otro indicador'}]
+
+
+def fake_api(valores):
+    def make_api_request(url, params=None, **_):
+        if url.endswith('/indicador'):
+            return CATALOGO
+        codigo = int(params['indicador'])
+        rows = [{'anio': 2020, 'ccaa': 'Madrid', 'sexo': 'Total', 'valor': valores[codigo]}]
+        return [{'codigo': codigo, 'datos': rows}]
+    return make_api_request
+
+
+def run(monkeypatch, bucket, valores, full_refresh=False):
+    monkeypatch.setattr(getHealthData, 'get_secret', lambda name: {'inclasns': 'clave'})
+    monkeypatch.setattr(getHealthData, 'make_api_request', fake_api(valores))
+    monkeypatch.setenv('bucket_name', bucket)
+    return getHealthData.lambda_handler({'full_refresh': full_refresh}, None)
+
+
+def test_only_changed_indicators_are_rewritten(tmp_path, monkeypatch):
+    bucket = str(tmp_path)
+    first = run(monkeypatch, bucket, {1: 1.5, 2: 2.5})
+    assert (first['rewritten'], first['unchanged']) == (2, 0)
+    written = os.path.join(bucket, 'staging', 'inclasns', 'Tasa_de_EPOC.parquet')
+    mtime = os.path.getmtime(written)
+
+    second = run(monkeypatch, bucket, {1: 1.5, 2: 3.0})
+    assert (second['rewritten'], second['unchanged']) == (1, 1)
+    assert os.path.getmtime(written) == mtime
+
+    # full_refresh no tiene en cuenta las huellas guardadas
+    third = run(monkeypatch, bucket, {1: 1.5, 2: 3.0}, full_refresh=True)
+    assert (third['rewritten'], third['unchanged']) == (2, 0)
+
+
+def test_fingerprint_ignores_key_order():
+    assert getHealthData.get_fingerprint({'a': 1, 'b': [1, 2]}) == getHealthData.get_fingerprint({'b': [1, 2], 'a': 1})
+    assert getHealthData.get_fingerprint({'a': 1}) != getHealthData.get_fingerprint({'a': 2})
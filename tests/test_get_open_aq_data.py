@@ -0,0 +1,119 @@
+"""
+Paginación de una ventana de get_open_aq_data, punto de control (en memoria
+y reanudado desde disco) y marca de agua de las páginas.
+"""
+import glob
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+
+import get_open_aq_data
+from flatten import flatten_daily_measurements, max_datetime_to
+from shards import split_windows
+from tfm_common.checkpoints import IngestCheckpoint
+from tfm_common.parquet import read_parquet
+
+LIMIT = 2
+START = datetime(2024, 1, 1)
+
+
+def local(moment):
+    # La API da la hora local del sensor con su desplazamiento (aquí UTC+2)
+    return (moment + timedelta(hours=2)).strftime('%Y-%m-%dT%H:%M:%S+02:00')
+
+
+def measurement(day):
+    moment = START + timedelta(days=day)
+    period = {'datetimeFrom': {'local': local(moment)},
+              'datetimeTo': {'local': local(moment + timedelta(days=1))}}
+    return {'value': float(day), 'period': period, 'summary': {'min': 0.0, 'max': float(day)}}
+
+
+def fake_fetcher(days, fail_pages, requested=None):
+    """
+    API con total abierto ('>2') y `days` mediciones; las páginas de
+    `fail_pages` fallan (None, como make_api_request tras los reintentos).
+    Las páginas pedidas se anotan en `requested`.
+    """
+    def fetcher(sensor_id, datetime_from=None, datetime_to=None, limit=1000):
+        def fetch_page(page):
+            if requested is not None:
+                requested.add(page)
+            if page in fail_pages:
+                return None
+            results = [measurement(day) for day in range((page - 1) * LIMIT, min(page * LIMIT, days))]
+            return {'meta': {'found': f'>{LIMIT}', 'limit': LIMIT}, 'results': results}
+        return fetch_page
+    return fetcher
+
+
+def run_window(tmp_path, monkeypatch, days, fail_pages, checkpoint=None, requested=None):
+    monkeypatch.setattr(get_open_aq_data, 'measurements_fetcher', fake_fetcher(days, fail_pages, requested))
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint()
+        checkpoint.start('lote', {'1': '2024-01-01T00:00:00Z'}, '2024-02-01T00:00:00Z', '2024-02-01')
+    segments = get_open_aq_data.SegmentWriter(str(tmp_path / 'lote'), checkpoint)
+    window = split_windows('2024-01-01T00:00:00Z', '2024-02-01T00:00:00Z', 0, timedelta(days=1))[0]
+    status = get_open_aq_data.fetch_window('1', window, segments, get_open_aq_data.Deadline(None, 0), LIMIT)
+    segments.flush()
+    return status, checkpoint
+
+
+def written(tmp_path):
+    tables = [read_parquet(path) for path in sorted(glob.glob(str(tmp_path / 'lote*.parquet')))]
+    return pa.concat_tables(tables).sort_by('datetimeFrom') if tables else None
+
+
+def test_failed_prefetch_after_last_page_keeps_window_complete(tmp_path, monkeypatch):
+    # 5 mediciones: páginas 1 y 2 llenas y la 3 incompleta (la última). Las
+    # páginas 4 y siguientes se piden por adelantado y fallan
+    status, checkpoint = run_window(tmp_path, monkeypatch, days=5, fail_pages=set(range(4, 20)))
+    assert status['complete']
+    assert status['failed_page'] is None
+    assert status['rows'] == 5
+
+    # Las horas locales (+02:00) se guardan como UTC sin zona
+    table = written(tmp_path)
+    assert table['datetimeFrom'].to_pylist() == [START + timedelta(days=day) for day in range(5)]
+    assert table['datetimeTo'].to_pylist()[-1] == datetime(2024, 1, 6)
+    assert checkpoint.take_watermarks(['1']) == {'1': '2024-01-06T00:00:00Z'}
+
+
+def test_failed_page_before_the_end_leaves_window_pending(tmp_path, monkeypatch):
+    status, checkpoint = run_window(tmp_path, monkeypatch, days=5, fail_pages={2})
+    assert not status['complete']
+    assert status['failed_page'] == 2
+    assert status['rows'] == 2
+    assert checkpoint.sensor('1')['watermark'] == '2024-01-03T00:00:00Z'
+    # El handler solo confirma las marcas de los sensores completos
+    assert not checkpoint.sensor_complete('1', [get_open_aq_data.window_key(
+        split_windows('2024-01-01T00:00:00Z', '2024-02-01T00:00:00Z', 0, timedelta(days=1))[0])])
+
+
+def test_resume_skips_the_pages_already_written(tmp_path, monkeypatch):
+    uri = str(tmp_path / 'checkpoint.json')
+    checkpoint = IngestCheckpoint(uri, run_id='ejecucion-1')
+    checkpoint.start('lote', {'1': '2024-01-01T00:00:00Z'}, '2024-02-01T00:00:00Z', '2024-02-01')
+    status, _ = run_window(tmp_path, monkeypatch, days=5, fail_pages={3}, checkpoint=checkpoint)
+    assert not status['complete']
+
+    # Otra ejecución no reutiliza el estado; la misma sí, y no vuelve a pedir las páginas 1 y 2
+    assert not IngestCheckpoint(uri, run_id='ejecucion-2').load()
+    resumed = IngestCheckpoint(uri, run_id='ejecucion-1')
+    assert resumed.load()
+    requested = set()
+    status, resumed = run_window(tmp_path, monkeypatch, days=5, fail_pages=set(), checkpoint=resumed,
+                                 requested=requested)
+    assert status['complete']
+    assert status['pages_skipped'] == 2
+    assert not requested & {1, 2}
+    assert written(tmp_path)['value'].to_pylist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert resumed.take_watermarks(['1']) == {'1': '2024-01-06T00:00:00Z'}
+
+
+def test_watermark_stops_at_the_open_period():
+    results = [measurement(day) for day in range(3)]
+    table = flatten_daily_measurements([results], '1')
+    # El 3 de enero a mediodía el agregado de ese día aún es parcial
+    assert max_datetime_to(table, now=datetime(2024, 1, 3, 12)) == '2024-01-03T00:00:00Z'
+    assert max_datetime_to(table, now=datetime(2024, 1, 4)) == '2024-01-04T00:00:00Z'
@@ -0,0 +1,24 @@
+"""
+Ventana de refresco de get_ree_data: solo se vuelven a pedir los meses recientes.
+"""
+from datetime import datetime
+
+from get_ree_data import get_month_windows, get_window
+
+
+def test_default_window_starts_at_the_first_day_of_the_month(monkeypatch):
+    monkeypatch.setenv('dias_ventana', '2')
+    monkeypatch.delenv('full_refresh', raising=False)
+    assert get_window({}, datetime(2024, 3, 1, 10, 30)) == (datetime(2024, 2, 1), datetime(2024, 3, 1, 10, 30))
+    assert get_window({}, datetime(2024, 3, 15)) == (datetime(2024, 3, 1), datetime(2024, 3, 15))
+
+
+def test_full_refresh_uses_the_whole_range(monkeypatch):
+    monkeypatch.setenv('fecha_ini', '2023-06-01')
+    assert get_window({'full_refresh': True}, datetime(2024, 3, 15))[0] == datetime(2023, 6, 1)
+
+
+def test_month_windows_match_the_output_partitions():
+    windows = get_month_windows(datetime(2024, 1, 20), datetime(2024, 3, 5))
+    assert [(start.month, end) for start, end in windows] == [
+        (1, datetime(2024, 1, 31, 23, 59)), (2, datetime(2024, 2, 29, 23, 59)), (3, datetime(2024, 3, 5))]
@@ -0,0 +1,61 @@
+"""
+Caché de respuestas de referencia de tfm_common.http_cache.
+"""
+from tfm_common.http_cache import LOCAL, NETWORK, REVALIDATED, SHARED, STALE, UNCHANGED, ResponseCache
+
+URL = 'https://api.example/v3/parameters'
+
+
+class Response:
+
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'ETag': etag} if etag else {}
+
+    def json(self):
+        return self.body
+
+
+def server(*responses):
+    """
+    `request(headers)` que devuelve las respuestas en orden y anota las cabeceras recibidas.
+    """
+    sent = []
+    pending = list(responses)
+
+    def request(headers):
+        sent.append(dict(headers))
+        return pending.pop(0)
+    return request, sent
+
+
+def test_fresh_entry_is_served_without_calling_the_api(tmp_path):
+    cache = ResponseCache(local_dir=str(tmp_path / 'local'), ttl=3600)
+    request, sent = server(Response(200, {'results': [1]}, etag='"v1"'))
+    assert cache.fetch(URL, {'limit': 10}, request) == ({'results': [1]}, NETWORK)
+    assert cache.fetch(URL, {'limit': 10}, request) == ({'results': [1]}, LOCAL)
+    assert len(sent) == 1
+
+
+def test_expired_entry_is_revalidated_with_its_etag(tmp_path):
+    cache = ResponseCache(local_dir=str(tmp_path / 'local'), ttl=0)
+    request, sent = server(Response(200, {'results': [1]}, etag='"v1"'), Response(304),
+                           Response(200, {'results': [1]}, etag='"v2"'), None)
+    cache.fetch(URL, None, request)
+    assert cache.fetch(URL, None, request) == ({'results': [1]}, REVALIDATED)
+    assert sent[1] == {'If-None-Match': '"v1"'}
+    # Descargado de nuevo pero igual; y si la API falla se sirve lo guardado
+    assert cache.fetch(URL, None, request) == ({'results': [1]}, UNCHANGED)
+    assert cache.fetch(URL, None, request) == ({'results': [1]}, STALE)
+    assert cache.stats()['revalidated'] == 1
+
+
+def test_shared_prefix_serves_other_containers(tmp_path):
+    shared = str(tmp_path / 'shared')
+    request, sent = server(Response(200, {'results': [2]}))
+    ResponseCache(shared, local_dir=str(tmp_path / 'contenedor_a')).fetch(URL, None, request)
+    other = ResponseCache(shared, local_dir=str(tmp_path / 'contenedor_b'))
+    assert other.fetch(URL, None, request) == ({'results': [2]}, SHARED)
+    assert other.fetch(URL, None, request) == ({'results': [2]}, LOCAL)
+    assert len(sent) == 1
@@ -0,0 +1,62 @@
+"""
+Paginación concurrente de tfm_common.pagination.
+"""
+import threading
+
+from tfm_common.pagination import iter_pages
+
+
+def api(total, limit, found=None, fail_pages=()):
+    """
+    Endpoint con `total` resultados numerados; `found` sustituye al total
+    informado en meta (p. ej. '>2'). Devuelve (fetch_page, páginas pedidas).
+    """
+    requested = []
+    lock = threading.Lock()
+
+    def fetch_page(page):
+        with lock:
+            requested.append(page)
+        if page in fail_pages:
+            return None
+        results = list(range((page - 1) * limit, min(page * limit, total)))
+        return {'meta': {'found': total if found is None else found, 'limit': limit}, 'results': results}
+    return fetch_page, requested
+
+
+def results_of(pages):
+    return [value for _, results in pages for value in results]
+
+
+def test_known_total_fetches_every_page_once_in_order():
+    fetch_page, requested = api(total=7, limit=2)
+    pages = list(iter_pages(fetch_page, 2, max_workers=3))
+    assert [page for page, _ in pages] == [1, 2, 3, 4]
+    assert results_of(pages) == list(range(7))
+    assert sorted(requested) == [1, 2, 3, 4]
+
+
+def test_open_total_stops_at_the_first_incomplete_page():
+    missing = []
+    fetch_page, requested = api(total=5, limit=2, found='>2', fail_pages=set(range(4, 20)))
+    pages = list(iter_pages(fetch_page, 2, max_workers=4, on_missing=missing.append))
+    assert results_of(pages) == list(range(5))
+    # Se han pedido páginas por adelantado, pero fallar tras la última no cuenta
+    assert max(requested) > 3
+    assert missing == []
+
+
+def test_failed_page_ends_the_download_and_is_reported():
+    missing = []
+    fetch_page, _ = api(total=9, limit=2, fail_pages={3})
+    pages = list(iter_pages(fetch_page, 2, max_workers=2, on_missing=missing.append))
+    assert [page for page, _ in pages] == [1, 2]
+    assert missing == [3]
+
+
+def test_skipped_pages_are_neither_fetched_nor_returned():
+    fetch_page, requested = api(total=7, limit=2)
+    meta = {'found': 7, 'limit': 2}
+    pages = list(iter_pages(fetch_page, 2, max_workers=2, skip_pages={1, 3}, meta=meta))
+    assert [page for page, _ in pages] == [2, 4]
+    assert sorted(requested) == [2, 4]
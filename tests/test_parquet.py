@@ -0,0 +1,77 @@
+"""
+write_parquet(mode='upsert') y su bloqueo de escritor.
+"""
+import json
+import os
+import threading
+import time
+
+import pyarrow as pa
+import pytest
+
+from tfm_common import parquet
+from tfm_common.locks import LeaseLock, LockTimeout
+from tfm_common.parquet import read_parquet, write_parquet
+from tfm_common.storage import list_uris
+
+KEY = ['serie_id', 'day']
+
+
+def rows(serie_id, days, value):
+    return pa.table({'serie_id': [serie_id] * len(days), 'day': list(days), 'value': [value] * len(days),
+                     'month': [1] * len(days)})
+
+
+def dataset(root):
+    files = [uri for uri, _ in list_uris(root + '/') if uri.endswith('.parquet')]
+    table = pa.concat_tables([read_parquet(uri) for uri in files])
+    return files, sorted(zip(table['serie_id'].to_pylist(), table['day'].to_pylist(), table['value'].to_pylist()))
+
+
+def test_upsert_keeps_one_file_per_partition_and_the_newest_rows(tmp_path):
+    root = str(tmp_path / 'ree')
+    write_parquet(root, rows('a', [1, 2, 3], 1.0), partition_cols=['month'], mode='upsert', key_cols=KEY)
+    write_parquet(root, rows('a', [3, 4], 2.0), partition_cols=['month'], mode='upsert', key_cols=KEY)
+    files, values = dataset(root)
+    assert len(files) == 1
+    assert values == [('a', 1, 1.0), ('a', 2, 1.0), ('a', 3, 2.0), ('a', 4, 2.0)]
+    assert not os.path.exists(os.path.join(root, '_upsert.lock'))
+
+
+def test_upsert_of_a_single_file(tmp_path):
+    uri = str(tmp_path / 'serie.parquet')
+    write_parquet(uri, rows('a', [1, 2], 1.0), mode='upsert', key_cols=KEY)
+    write_parquet(uri, rows('a', [2], 3.0), mode='upsert', key_cols=KEY)
+    assert read_parquet(uri)['value'].to_pylist() == [1.0, 3.0]
+    assert os.listdir(tmp_path) == ['serie.parquet']
+
+
+def test_concurrent_upserts_do_not_lose_rows(tmp_path):
+    root = str(tmp_path / 'ree')
+    threads = [threading.Thread(target=write_parquet, args=(root, rows(serie_id, range(50), 1.0)),
+                                kwargs={'partition_cols': ['month'], 'mode': 'upsert', 'key_cols': KEY})
+               for serie_id in 'abcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    files, values = dataset(root)
+    assert len(files) == 1
+    assert len(values) == 200
+
+
+def test_lock_held_by_another_writer_times_out(tmp_path, monkeypatch):
+    root = str(tmp_path / 'ree')
+    monkeypatch.setattr(parquet, 'UPSERT_LOCK_WAIT_S', 0.2)
+    with LeaseLock(os.path.join(root, '_upsert.lock'), poll_s=0.05):
+        with pytest.raises(LockTimeout):
+            write_parquet(root, rows('a', [1], 1.0), partition_cols=['month'], mode='upsert', key_cols=KEY)
+
+
+def test_expired_lock_is_taken_over(tmp_path):
+    uri = str(tmp_path / '_upsert.lock')
+    with open(uri, 'w') as f:
+        json.dump({'owner': 'otro', 'expires_at': time.time() - 1}, f)
+    with LeaseLock(uri, wait_s=0):
+        assert json.loads(open(uri).read())['owner'] != 'otro'
+    assert not os.path.exists(uri)
@@ -0,0 +1,34 @@
+"""
+Limitador de tasa compartido de tfm_common.rate_limit.
+"""
+import time
+
+from tfm_common.rate_limit import RateLimiter
+
+
+def test_acquire_waits_for_the_reset_once_the_bucket_is_empty():
+    limiter = RateLimiter(rate=2, period=0.3)
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.1
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.25
+
+
+def test_headers_recalibrate_the_bucket_discounting_requests_in_flight():
+    limiter = RateLimiter(rate=10, period=60)
+    limiter.acquire()
+    limiter.acquire()
+    # La respuesta de la primera aún no descuenta la segunda, que sigue en vuelo
+    limiter.update({'x-ratelimit-remaining': '1', 'x-ratelimit-reset': '5'})
+    assert limiter.in_flight == 1
+    assert limiter.tokens == 0
+    assert 4 < limiter.reset_at - time.monotonic() <= 5
+
+
+def test_block_until_reset_empties_the_bucket():
+    limiter = RateLimiter(rate=10, period=60)
+    limiter.block_until_reset(2)
+    assert limiter.tokens == 0
+    assert limiter.reset_at - time.monotonic() > 2
@@ -0,0 +1,22 @@
+"""
+Consolidación de las marcas de agua por sensor.
+"""
+import os
+
+from tfm_common.watermarks import WatermarkStore
+
+
+def test_compact_merges_segments_and_keeps_the_newest_mark(tmp_path):
+    store = WatermarkStore(str(tmp_path / 'watermarks'))
+    store.commit('lote_a', {1: '2024-01-02T00:00:00+00:00', 2: '2024-01-05T00:00:00Z'})
+    store.commit('lote_b', {1: '2024-01-03T00:00:00Z'})
+
+    expected = {'1': '2024-01-03T00:00:00Z', '2': '2024-01-05T00:00:00Z'}
+    assert store.compact() == expected
+    assert os.listdir(tmp_path / 'watermarks') == ['_compacted.json']
+
+    store.commit('lote_c', {2: '2024-01-04T00:00:00Z', 3: '2024-01-01T00:00:00Z'})
+    assert store.load() == dict(expected, **{'3': '2024-01-01T00:00:00Z'})
+    store.compact()
+    assert os.listdir(tmp_path / 'watermarks') == ['_compacted.json']
+    assert store.load() == dict(expected, **{'3': '2024-01-01T00:00:00Z'})